@@ -10,17 +10,16 @@ __email__ = "rocky.craig@hpe.com, zakhar.volchak@hpe.com"
 
 
 import collections
-from debian.deb822 import Packages as debPackages
 import flask
-import gzip
-import io
 import logging
 import os
 from pdb import set_trace
-import requests as HTTP_REQUESTS
 import sys
+import threading
+import time
 
-from tmms.utils import core_utils
+from tmms.utils import dependency_graph
+from tmms.utils import package_index
 
 
 _ERS_element = 'package'
@@ -82,7 +81,7 @@ def _api(name=None):
             tmpdict = {
                 'package': pkg['Package'],
                 'version': pkg['Version'],
-                'description': pkg['Description']
+                'description': pkg.get('Description', '')
             }
             packages.append(tmpdict)
 
@@ -100,66 +99,131 @@ def _api(name=None):
         if tag in pkg and False:
             pkg[tag] = pkg[tag].split(', ')
 
-    #at this point, pkg is of type debian.deb822.Packages, instead of dict.
-    #that would make jsonify flip out as a TypeError. Therefore - make it dict.
-    pkg = dict(pkg)
     return flask.make_response(flask.jsonify(pkg), status_code)
 
+
+@BP.route('/api/%ss/refresh' % _ERS_element, methods=('POST', ))
+def _api_refresh():
+    """Wake the refresher.  ?force=1 ignores ETags and Release hashes."""
+    global _force
+    if _data is None:
+        _load_data()
+    if flask.request.args.get('force', '').lower() in ('1', 'true', 'yes'):
+        _force = True
+    _wakeup.set()
+    return flask.make_response(flask.jsonify(_status()), 202)
+
+
+@BP.route('/api/%ss/status' % _ERS_element, methods=('GET', ))
+def _api_status():
+    if _data is None:
+        _load_data()
+    return flask.make_response(flask.jsonify(_status()), 200)
+
+
+def _status():
+    now = time.time()
+    status = {
+        'packages':         len(_data),
+        'refreshing':       _data.refreshing or _wakeup.is_set(),
+        'refresh_interval': _interval,
+        'last_refresh':     _last_refresh,
+    }
+    for key in ('built', 'build_seconds', 'refreshed', 'refresh_seconds'):
+        val = _data.meta(key, None)
+        status[key] = None if val is None else float(val)
+    status['age_seconds'] = None if status['built'] is None else \
+        round(now - status['built'], 3)
+    return status
+
 ###########################################################################
 
 _data = None
+_graph = None       # DependencyGraph of _data, see _dependency_graph()
+
+# Background refresher state, see _refresher()
+_wakeup = threading.Event()
+_force = False
+_interval = None
+_last_refresh = None
 
 
 def _load_data():
+    """
+        Open the on-disk package index.  Only a brand new index is filled
+    before returning; otherwise the server starts with what it has and
+    _refresher() catches up with the mirrors.
+    """
     global _data
 
     logging.info('Proxy settings\n%s' % '\n'.join(
         sorted(('%s=%s' % (p, os.environ[p])
             for p in os.environ if 'proxy' in p))))
 
-    all_mirrors = get_all_mirrors()
-
-    _data = {}
-    for full_source in all_mirrors:
-        _read_packages(full_source)
+    index = package_index.PackageIndex(
+        BP.config.package_index, logger=BP.logger)
+    if not len(index):
+        index.refresh(get_all_mirrors(), BP.config.arch)
+    _data = index
+
+
+def _refresh(force=False):
+    """Conditional refresh against the mirrors' Release files."""
+    global _last_refresh
+    try:
+        stats = _data.refresh(get_all_mirrors(), BP.config.arch, force=force)
+    except Exception as err:
+        BP.logger.error('Package index refresh failed: %s' % str(err))
+        stats = { 'errors': [ str(err) ] }
+    stats['finished'] = time.time()
+    _last_refresh = stats
+    try:
+        _dependency_graph()     # Rebuild now rather than at the next upload
+    except Exception as err:
+        BP.logger.error('Dependency graph failed: %s' % str(err))
+
+
+def _dependency_graph():
+    """
+        Current graph, rebuilt only when the index has been rebuilt.  Only
+    the refresher thread calls this: building takes seconds.
+    """
+    global _graph
+    built = _data.meta('built', None)
+    graph = _graph
+    if graph is None or graph.built != built:
+        graph = dependency_graph.DependencyGraph(_data.values())
+        graph.built = built
+        _graph = graph
+    return graph
 
 
-def _read_packages(full_source):
-    """ Get Packages.gz of the sources.list entry and extract all of its pks.
-    Packages are saved into _data variable and will be accessed by _filter()
-    function.
+def _resolve(names):
+    """
+        Depends/Pre-Depends closure of a list of package names, with
+    missing and conflicting packages and the sizes, see
+    DependencyGraph.resolve().  Uses the graph the refresher last built,
+    never builds one on a request thread.
+    """
+    graph = _graph
+    if graph is None:
+        raise RuntimeError('Package dependencies not indexed yet')
+    return graph.resolve(names)
 
-    @param full_source: sources.list entry (deb http//url release area1 ...)
 
-    return: None. Content is saved into _data directly.
+def _refresher():
     """
-    components = core_utils.deb_components(full_source)  # it leaves blanks...
-    components.areas = [ a for a in components.areas if a.strip() ]
-    if not components.url:
-        msg = ' - Wrong mirror format!\n'
-        msg += '  - Expected "deb http://mirror.url release ares"\n'
-        msg += '  - Mirror provided: %s' % (full_source)
-        raise RuntimeError(msg)
-    # Reference:
-    # https://github.com/raumkraut/python-debian/blob/master/README.deb822
-    repo = '%s/dists/%s/%%s/%%s/Packages.gz' % (components.url, components.release)
-    for area in components.areas:
-        for arch in ('binary-all', 'binary-' + BP.config.arch):
-            retrieveURL = repo % (area, arch)
-            BP.logger.info('Loading/processing "%s"' % retrieveURL)
-            pkgresp = HTTP_REQUESTS.get(retrieveURL)
-            if pkgresp.status_code != 200:
-                BP.logger.error('%s not found' % arch)
-                continue
-            BP.logger.debug('Uncompressing %s bytes' % pkgresp.headers['content-length'])
-
-            unzipped = gzip.decompress(pkgresp.content) # bytes all around
-            BP.logger.debug('Parsing %d bytes of package data' % len(unzipped))
-            unzipped = io.BytesIO(unzipped)    # the next step needs read()
-            deb_packages_iter = debPackages.iter_paragraphs(unzipped)
-            tmp = [ src for src in deb_packages_iter ]
-
-            _data.update(dict((pkg['Package'], pkg) for pkg in tmp))
+        Thread body: refresh now, then every _interval seconds (never if
+    it's 0) or when the API sets _wakeup.  Readers keep using the index
+    during a refresh; it commits as one transaction.
+    """
+    global _force
+    while True:
+        _wakeup.clear()     # First, or a wakeup in between would be lost
+        force, _force = _force, False
+        _refresh(force)
+        _wakeup.wait(_interval or None)
+
 
 def get_all_mirrors():
     """
@@ -195,5 +259,9 @@ def _filter(packages):    # Maybe it's time for a class
 
 def register(url_prefix):
     BP.filter = _filter     # So manifest can see it
+    BP.resolve = _resolve
     BP.mainapp.register_blueprint(BP, url_prefix=url_prefix)
     _load_data()
+    global _interval
+    _interval = int(BP.config.get('PACKAGES_REFRESH_SECONDS', 3600))
+    threading.Thread(target=_refresher, name='package_index', daemon=True).start()
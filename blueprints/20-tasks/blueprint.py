@@ -10,6 +10,7 @@ __maintainer__ = "Rocky Craig, Zakhar Volchak"
 __email__ = "rocky.craig@hpe.com, zakhar.volchak@hpe.com"
 
 
+import collections
 from debian.deb822 import Packages as debPackages
 import flask
 import os
@@ -30,6 +31,7 @@ BP = flask.Blueprint(_ERS_element, __name__)
 @BP.route('/%ss/' % _ERS_element)       # Plural form of element name to query all tasks
 @BP.route('/%s/<name>' % _ERS_element)  # Singular - to get one task.
 def webpage(name=None):
+    _load_data()
     if name is None:
         return flask.render_template(
             _ERS_element + '_all.tpl',
@@ -73,39 +75,73 @@ def api(name=None):
             task[tag] = task[tag].split(', ')
     return flask.jsonify(task)
 
+
+@BP.route('/api/%ss/packages/' % _ERS_element)      # Every package
+@BP.route('/api/%ss/packages/<name>' % _ERS_element)
+def api_by_package(name=None):
+    '''The tasks that install a package: the reverse of "Key".'''
+    _load_data()
+    if name is None:
+        return flask.jsonify({ 'packages': _tasks_of })
+    return flask.jsonify({ 'package': name,
+                           'tasks': _tasks_of.get(name, ()) })
+
 ###########################################################################
 
 _data = None
+_packages_of = None     # task: (package, ...) from its Key field
+_tasks_of = None        # package: (task, ...), the reverse index
+_mtime = None
+
 
 def _load_data():
-    '''Parse the actual tasksel description file.'''
-    global _data
+    '''
+        Parse the actual tasksel description file, unless it hasn't changed
+    since the last parse.  Every lookup calls this, and the stat() is all
+    it costs until the file is edited.
+    '''
+    global _data, _packages_of, _tasks_of, _mtime
+
+    mtime = os.stat(BP.tasks_file).st_mtime_ns
+    if mtime == _mtime:
+        return
 
-    _data = {}
-    task_content = None
     with open(BP.tasks_file, 'r') as file_obj:
         task_content = file_obj.read()
 
-    deb_packages_iter = debPackages.iter_paragraphs(task_content)
-    tmp = [ task for task in deb_packages_iter ]
-    _data.update(dict((task['Task'], task) for task in tmp))
+    data = collections.OrderedDict(
+        (task['Task'], task)
+        for task in debPackages.iter_paragraphs(task_content))
+    # Key is one package per line after a newline: strip the whitespace.
+    packages_of = dict(
+        (name, tuple(pkg.strip() for pkg in task.get('Key', '').split('\n')
+                     if pkg.strip()))
+        for name, task in data.items())
+    tasks_of = collections.defaultdict(list)
+    for name, packages in packages_of.items():
+        for pkg in packages:
+            tasks_of[pkg].append(name)
+    tasks_of = dict((pkg, tuple(tasks)) for pkg, tasks in tasks_of.items())
+
+    # Readers on other threads may see a mix of old and new for an
+    # instant, but never a half-built index.
+    _data, _packages_of, _tasks_of = data, packages_of, tasks_of
+    _mtime = mtime
 
 
 def _lookup(task_name, key=None):
+    _load_data()
     return _data.get(task_name, None)
 
 
 def _packages(task_name):
-    task = _lookup(task_name)
-    if not task:
-        return None
-    # Clean out new line in the beginning and end of the task['Key'] string.
-    # Strip each package name of the task['Key'] list...
-    packages = [pkg.strip() for pkg in task['Key'].strip().split('\n')]
-    return packages
+    '''Tuple of the packages named by the task, or None for no such task.'''
+    _load_data()
+    return _packages_of.get(task_name, None)
 
 
 def _filter(tasks):    # Maybe it's time for a class
+    _load_data()
     return [ task for task in tasks if task not in _data ]
 
 
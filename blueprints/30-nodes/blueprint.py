@@ -15,15 +15,23 @@ import errno
 import flask
 import glob
 import json
+import logging
 import os
 from pdb import set_trace
+import shutil
 import sys
+import tempfile
+import threading
 import time
 import werkzeug
 
+from tmms.utils import build_profile
+from tmms.utils import build_scheduler
 from tmms.utils import core_utils
 from tmms.utils import customize_node
 from tmms.utils import file_utils
+from tmms.utils import http_utils
+from tmms.utils import status_cache
 
 
 _ERS_element = 'node'
@@ -73,19 +81,28 @@ def web_node_status(name=None):
     name = '/' + name
     try:
         node = BP.nodes[name][0]
-        ESPURL = None    # testable value in Jinja2
-        ESPsizeMB = 0
+        ESPURL = ESPgzURL = None    # testable values in Jinja2
+        ESPsizeMB = ESPgzsizeMB = 0
         installsh = installlog = None
         status = get_node_status(name)
         if status is not None:
             if status['status'] == 'ready':
+                # Size 0 means it gets built when first downloaded.
                 ESPpath = '%s/%s/%s.ESP' % (
                     BP.config['TFTP_IMAGES'], node.hostname, node.hostname)
-                if os.path.isfile(ESPpath):
-                    prefix = flask.request.url.split(_ERS_element)[0]
+                prefix = flask.request.url.split(_ERS_element)[0]
+                if os.path.isfile(ESPpath) or _ESP_bootfiles(node.hostname):
                     ESPURL = '%s%s/ESP/%s' % (
                         prefix, _ERS_element, node.hostname)
-                    ESPsizeMB = os.stat(ESPpath).st_size >> 20
+                    if os.path.isfile(ESPpath):
+                        ESPsizeMB = os.stat(ESPpath).st_size >> 20
+                if os.path.isfile(ESPpath + '.gz'):
+                    ESPgzURL = '%s%s/ESPgz/%s' % (
+                        prefix, _ERS_element, node.hostname)
+                    ESPgzsizeMB = os.stat(ESPpath + '.gz').st_size >> 20
+                elif ESPURL and BP.config.get('ESP_GZIP', False):
+                    ESPgzURL = '%s%s/ESPgz/%s' % (
+                        prefix, _ERS_element, node.hostname)
 
             if status['status'] in ('building', 'ready'):
                 installpath = '%s/%s/untar/root' % (
@@ -110,6 +127,8 @@ def web_node_status(name=None):
             base_url=flask.request.url.split(name)[0],
             ESPURL=ESPURL,
             ESPsizeMB=ESPsizeMB,
+            ESPgzURL=ESPgzURL,
+            ESPgzsizeMB=ESPgzsizeMB,
             installsh=installsh,
             installlog=installlog
         )
@@ -117,17 +136,156 @@ def web_node_status(name=None):
         return flask.make_response('Kaboom: %s' % str(e), 404)
 
 
-@BP.route('/%s/ESP/<path:hostname>' % _ERS_element)
+@BP.route('/%s/ESP/<path:hostname>' % _ERS_element, methods=('GET', 'HEAD'))
 def web_node_send_ESP(hostname):
-    filename = hostname + '.ESP'
-    ESPdir = '%s/%s' % (BP.config['TFTP_IMAGES'], hostname)
+    """
+        Download the SDHC/USB image of a node.  The first request starts
+    building it and gets 202 and a Retry-After until it's done; 500 if the
+    build failed.  Supports Range/If-Range (resume) and If-None-Match, see
+    http_utils.send_artifact().
+    """
+    filename = werkzeug.utils.secure_filename(hostname + '.ESP')
+    ESPpath = '%s/%s/%s' % (BP.config['TFTP_IMAGES'],
+                            werkzeug.utils.secure_filename(hostname), filename)
+    if not os.path.isfile(ESPpath):
+        response = _build_ESP(hostname)
+        if response is not None:
+            return response
+    try:
+        return http_utils.send_artifact(
+            ESPpath,
+            'application/x-raw-disk-image',     # dialogs say "ESP file"
+            download_name=filename)
+    except FileNotFoundError:
+        flask.abort(404)
+
+
+@BP.route('/%s/ESPgz/<path:hostname>' % _ERS_element, methods=('GET', 'HEAD'))
+def web_node_send_ESPgz(hostname):
+    """The same image gzipped, when ESP_GZIP made one."""
+    filename = werkzeug.utils.secure_filename(hostname + '.ESP.gz')
+    ESPpath = '%s/%s/%s' % (BP.config['TFTP_IMAGES'],
+                            werkzeug.utils.secure_filename(hostname), filename)
+    if not os.path.isfile(ESPpath) and BP.config.get('ESP_GZIP', False):
+        response = _build_ESP(hostname)
+        if response is not None:
+            return response
+    try:
+        return http_utils.send_artifact(
+            ESPpath, 'application/gzip', download_name=filename)
+    except FileNotFoundError:
+        flask.abort(404)
+
+
+_ESP_lock = threading.Lock()
+_ESP_builds = {}    # hostname: None while building, else why it failed
+_ESP_RETRY = 15     # seconds, Retry-After while an image builds
+
+
+def _ESP_bootfiles(hostname):
+    '''(vmlinuz, cpio) of a built node as compress_bootfiles() left them.'''
+    tftp_dir = BP.config['TFTP_IMAGES'] + '/' + hostname
+    bootfiles = ('%s/%s.vmlinuz.gz' % (tftp_dir, hostname),
+                 '%s/%s.cpio.gz' % (tftp_dir, hostname))
+    if all(os.path.isfile(f) for f in bootfiles):
+        return bootfiles
+    return None
+
+
+def _ESP_source(hostname):
+    '''
+        What an image of a node is built from: the status version and the
+    boot files of a ready node.  A rebind or unbind changes it.
+    :return: (version, bootfiles, stats) or None if the node isn't ready.
+    '''
+    BP.status_cache.reload(hostname)
+    version, status = BP.status_cache.lookup(hostname)
+    if status is None or status['status'] != 'ready':
+        return None
+    bootfiles = _ESP_bootfiles(hostname)
+    if bootfiles is None:
+        return None
+    try:
+        stats = tuple((st.st_ino, st.st_size, st.st_mtime_ns)
+                      for st in map(os.stat, bootfiles))
+    except OSError:
+        return None
+    return (version, bootfiles, stats)
 
-    return flask.send_from_directory(
-        ESPdir,                                     # required #1
-        filename,                                   # required #2
-        as_attachment=True,                         # os.path.basename
-        mimetype='application/x-raw-disk-image',    # dialogs say "ESP file"
-        cache_timeout=0)                            # Not in mainapp.config
+
+def _build_ESP(hostname):
+    '''
+        Start building the SDHC/USB image of a ready node in a thread of
+    its own: it takes minutes and SERVER_THREADS are few.
+    :return: the response for a download of the image while it builds or
+             after the build failed, None to go ahead and send the file.
+    '''
+    if hostname not in [ node.hostname for node in BP.nodes ]:
+        return None
+    tftp_dir = BP.config['TFTP_IMAGES'] + '/' + hostname
+    ESPpath = '%s/%s.ESP' % (tftp_dir, hostname)
+    esp_gzip = bool(BP.config.get('ESP_GZIP', False))
+    with _ESP_lock:
+        if hostname in _ESP_builds:
+            error = _ESP_builds[hostname]
+            if error is not None:
+                del _ESP_builds[hostname]   # Once, the next request retries
+                response_msg = 'Building %s.ESP failed: %s' % (hostname, error)
+                response = flask.make_response(response_msg, 500)
+                BP.logger(response)
+                return response
+        elif os.path.isfile(ESPpath) and (
+                not esp_gzip or os.path.isfile(ESPpath + '.gz')):
+            return None     # Another build just finished
+        else:
+            source = _ESP_source(hostname)
+            if source is None:
+                return None
+            _ESP_builds[hostname] = None
+            threading.Thread(target=_ESP_builder,
+                             args=(hostname, esp_gzip, source),
+                             name='ESP %s' % hostname, daemon=True).start()
+    response_msg = 'Building %s.ESP, try again in a minute' % hostname
+    response = flask.make_response(response_msg, 202)
+    response.headers['Retry-After'] = str(_ESP_RETRY)
+    return response
+
+
+def _ESP_builder(hostname, esp_gzip, source):
+    '''
+        Thread body of _build_ESP().  The node may be rebound meanwhile,
+    so the image is only published if its source is unchanged.
+    '''
+    tftp_dir = BP.config['TFTP_IMAGES'] + '/' + hostname
+    # Same file system as the target so publish_ESP() just renames.
+    build_dir = tempfile.mkdtemp(prefix='.ESP.', dir=tftp_dir)
+    build_args = argparse.Namespace(
+        hostname=hostname,
+        tftp_dir=tftp_dir,
+        build_dir=build_dir,
+        esp_gzip=esp_gzip,
+        compress_threads=int(BP.config.get('COMPRESS_THREADS', 4)),
+        no_status=True,     # The node is ready, leave status.json be
+        logger=BP.logger)
+    BP.logger.info('%s: building SDHC/USB image on demand' % hostname)
+    error = None
+    try:
+        ESP_img = customize_node.build_SNBU_image(build_args, *source[1])
+        with _ESP_lock:
+            if _ESP_source(hostname) != source:
+                raise RuntimeError('node was rebuilt or unbound meanwhile')
+            customize_node.publish_ESP(
+                build_args, ESP_img, '%s/%s.ESP' % (tftp_dir, hostname))
+    except Exception as err:
+        error = str(err)
+        BP.logger.error('%s: SDHC/USB image: %s' % (hostname, error))
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        with _ESP_lock:
+            if error is None:
+                _ESP_builds.pop(hostname, None)
+            else:
+                _ESP_builds[hostname] = error
 
 ###########################################################################
 # API
@@ -193,7 +351,15 @@ def _resolve_node_coord(nodespec):
 @BP.route('/api/%s//<path:nodespec>' % _ERS_element, methods=('GET', ))
 def get_node_bind_info(nodespec=None):
     """
-        List status json of the manifest bound to the node.
+        List status json of the manifest bound to the node.  The
+    X-Status-Version header changes with every status change.
+
+    :param '?wait=N': (optional) long poll: answer when the status changes,
+                      or after N seconds (at most _MAX_WAIT).  If too many
+                      long polls are waiting already, answer at once with
+                      a Retry-After header; see _long_poll().
+    :param '?since=V': (optional) with wait, answer at once unless the
+                       version is still V.  Default: the current version.
     """
     # Two rules invoke Postel's Law of liberal reception.  Either way,
     # we need to add leading /.
@@ -203,16 +369,128 @@ def get_node_bind_info(nodespec=None):
         response = flask.make_response(response_msg,404)
         BP.logger.error(response)
         return response
+    hostname = BP.nodes[node_coord][0].hostname
+    waited = True
+    try:
+        since = flask.request.args.get('since', None)
+        if since is not None:
+            since = [ int(since) ]
+        waited = _long_poll([ hostname ], since)
+    except ValueError as err:
+        response_msg = flask.jsonify({ 'status' : 'Bad wait/since: %s' % err })
+        return flask.make_response(response_msg, 400)
+    version, _ = BP.status_cache.lookup(hostname)
     result = get_node_status(node_coord)
     if result is None:
         response_msg = flask.jsonify({'status' : 'No Content'})
         response = flask.make_response(response_msg, 204)
     else:
         response = flask.make_response(flask.jsonify(result), 200)
+    response.headers['X-Status-Version'] = str(version)
+    if not waited:
+        response.headers['Retry-After'] = str(_BUSY_RETRY)
     BP.logger(response)
     return response
 
 
+@BP.route('/api/%ss/status' % _ERS_element, methods=('GET', ))
+def get_nodes_status():
+    """
+        Status of several nodes in one request, so one client watches all
+    the nodes it waits for with a single long poll.
+
+    :param '?node=C': node coordinate or number, repeated for each node.
+    :param '?since=V': (optional) status versions, one per node in the same
+                       order, as returned by the previous call.
+    :param '?wait=N': (optional) long poll as in get_node_bind_info(): answer
+                      when any of the nodes changes, or after N seconds.
+    :return: { 'nodes': [ { 'node': C, 'coordinate': ..., 'version': V,
+             'status': {...} }, ... ] } in the order asked for, with
+             status None for an unbound node.
+    """
+    nodespecs = flask.request.args.getlist('node')
+    node_coords = [ _resolve_node_coord(n) for n in nodespecs ]
+    unknown = [ n for n, c in zip(nodespecs, node_coords) if c is None ]
+    if unknown or not node_coords:
+        response_msg = flask.jsonify({ 'status' :
+            'No such node(s): %s' % ', '.join(unknown) if unknown else
+            'No node= given' })
+        return flask.make_response(response_msg, 404 if unknown else 400)
+
+    hostnames = [ BP.nodes[c][0].hostname for c in node_coords ]
+    try:
+        since = flask.request.args.getlist('since')
+        if since:
+            since = [ int(s) for s in since ]
+            assert len(since) == len(hostnames), 'one since= per node='
+        waited = _long_poll(hostnames, since or None)
+    except (AssertionError, ValueError) as err:
+        response_msg = flask.jsonify({ 'status' : 'Bad wait/since: %s' % err })
+        return flask.make_response(response_msg, 400)
+
+    nodes = []
+    for nodespec, node_coord, hostname in zip(
+            nodespecs, node_coords, hostnames):
+        nodes.append({
+            'node': nodespec,
+            'coordinate': node_coord,
+            'version': BP.status_cache.lookup(hostname)[0],
+            'status': get_node_status(node_coord) })
+    response = flask.make_response(flask.jsonify({ 'nodes': nodes }), 200)
+    if not waited:
+        response.headers['Retry-After'] = str(_BUSY_RETRY)
+    return response
+
+
+def _long_poll(hostnames, since):
+    '''
+        Handle ?wait=: block until one of the nodes' status version is not
+    in "since" (default: their current versions) or the wait is over.  Each
+    waiter holds a server thread, so only BP.waiters of them may wait at
+    once; the rest get False and answer at once.
+    :return: [bool] False if the wait was refused.
+    '''
+    wait = flask.request.args.get('wait', None)
+    if wait is None:
+        return True
+    wait = min(float(wait), _MAX_WAIT)
+    if since is None:
+        since = [ BP.status_cache.lookup(h)[0] for h in hostnames ]
+    if not BP.waiters.acquire(blocking=False):
+        return False
+    try:
+        BP.status_cache.wait_any(dict(zip(hostnames, since)), wait)
+    finally:
+        BP.waiters.release()
+    return True
+
+
+@BP.route('/api/%s/<path:nodespec>/profile' % _ERS_element, methods=('GET', ))
+@BP.route('/api/%s//<path:nodespec>/profile' % _ERS_element, methods=('GET', ))
+def get_node_profile(nodespec=None):
+    """
+        Stage timings (wall, CPU, I/O bytes, child peak RSS) of the last
+    build of the node, as written by customize_node.write_build_report().
+    """
+    node_coord = _resolve_node_coord(nodespec)
+    if node_coord is None:
+        response_msg = flask.jsonify({ 'status' : 'No such node "%s"' % nodespec})
+        return flask.make_response(response_msg, 404)
+    report = '%s/%s/%s' % (BP.config['TFTP_IMAGES'],
+        BP.nodes[node_coord][0].hostname, build_profile.REPORT)
+    try:
+        with open(report, 'r') as f:
+            profile = json.loads(f.read())
+    except FileNotFoundError:
+        response_msg = flask.jsonify({ 'status' : 'No build profile' })
+        return flask.make_response(response_msg, 404)
+    except Exception as err:
+        response_msg = flask.jsonify({
+            'status' : 'Unreadable build profile: %s' % str(err) })
+        return flask.make_response(response_msg, 500)
+    return flask.make_response(flask.jsonify(profile), 200)
+
+
 def node_coord2image_dir(node_coord):
     '''Calculate TFTP directory for kernel/FS from node coordinate/'''
     node_image_dir = BP.config['TFTP_IMAGES'] + '/' + \
@@ -231,6 +509,7 @@ def delete_node_binding(nodespec):
     reboot will fail.
 
     :param 'nodespec': full node's coordinate to unbind Manifest from.
+    :param '?cancel=1': (optional) cancel a build in progress first.
     """
     # Two rules invoke Postel's Law of liberal reception.  Either way,
     # we need to add leading /.
@@ -243,9 +522,13 @@ def delete_node_binding(nodespec):
 
     node_status = get_node_status(node_coord)
     if node_status and node_status['status'] == 'building':
-        msg = 'Cant delete binding - node is busy.'
-        response_msg = flask.jsonify({'status' : msg})
-        return flask.make_response(response_msg, 409)
+        # ?cancel=1 stops a queued or running build, then unbinds.
+        cancel = flask.request.args.get('cancel', '').lower()
+        if cancel not in ('1', 'true', 'yes'):
+            msg = 'Cant delete binding - node is busy.'
+            response_msg = flask.jsonify({'status' : msg})
+            return flask.make_response(response_msg, 409)
+        BP.scheduler.cancel(node_coord)
 
     response_msg = flask.jsonify({'status' : 'Successful cleanup.'})
     response = flask.make_response(response_msg, 204)
@@ -261,6 +544,7 @@ def delete_node_binding(nodespec):
         if not BP.DEBUG: # keep previous build while debugging.
             for to_remove in files_to_clean:
                 file_utils.remove_target(to_remove)
+            BP.status_cache.reload(node_name)
 
     except AssertionError as e:     # no such dir, no such binding
         pass
@@ -310,7 +594,10 @@ def bind_node_to_manifest(nodespec=None):
 
         manifest.validate_packages_tasks()
 
-        response = build_node(manifest, node_coord)
+        resp_status = 400
+        priority = int(req_body.get('priority', 0))
+
+        response = build_node(manifest, node_coord, priority)
     except werkzeug.exceptions.BadRequest as e:
         response_msg = flask.jsonify({'status' : e.get_response()})
         response = flask.make_response(response_msg, resp_status)
@@ -323,12 +610,14 @@ def bind_node_to_manifest(nodespec=None):
 ###########################################################################
 
 
-def build_node(manifest, node_coord):
+def build_node(manifest, node_coord, priority=0):
     """
         Generate a custom filesystem image based on the provided manifset.
+    The build itself is queued on BP.scheduler.
 
     :param 'manifest': [cls] manifest class of the 99-manifest/blueprint.py
     :param 'node_coord': [int\str] node number or name.
+    :param 'priority': [int] lower numbers leave the build queue first.
     :return: flask's response data.
     """
     golden_tar = BP.config['GOLDEN_TAR']
@@ -336,6 +625,16 @@ def build_node(manifest, node_coord):
         response_msg = flask.jsonify({'status' : 'Missing "Golden Image"!' })
         return flask.make_response(response_msg, 505)
 
+    # Start from the newest pre-upgraded snapshot, if any, and skip the
+    # apt-get update/upgrade while it's fresh.  See refresh_golden().
+    skip_upgrade = False
+    golden_snapshot = BP.config.golden_snapshot
+    if golden_snapshot is not None:
+        golden_tar = golden_snapshot
+        age = time.time() - os.path.getmtime(golden_snapshot)
+        skip_upgrade = age < float(
+            BP.config.get('GOLDEN_REFRESH_HOURS', 24)) * 3600
+
     # Each node gets its own set of dirs.  'nodes[]' matches snippets.
     hostname = BP.nodes[node_coord][0].hostname
     node_id = BP.nodes[node_coord][0].node_id
@@ -354,6 +653,16 @@ def build_node(manifest, node_coord):
     else:
         tasks = None     # sentinel for following loop
 
+    # One apt transaction for packages and tasks, see install_packages()
+    apt_single = bool(BP.config.get('APT_SINGLE_TRANSACTION', True))
+    task_packages = None
+    if apt_single and tasks:
+        task_packages = []
+        for task in manifest.thedict['tasks']:
+            task_packages.extend(
+                BP.mainapp.blueprints['task'].get_packages(task) or [])
+        task_packages = ' '.join(task_packages)
+
     DhcpClientId = BP.config['tmconfig'].allNodes[node_coord][0].DhcpClientId
 
     # Optional manifest fields not in the ERS but useful during bringup and
@@ -378,11 +687,22 @@ def build_node(manifest, node_coord):
         'other_mirrors': BP.config.get('OTHER_MIRRORS', None), #NEW (08-28-17)
         'packages':      packages,
         'tasks':         tasks,
+        'apt_single':    apt_single,
+        'task_packages': task_packages,
         'privkey':       privkey,
         'pubkey':        pubkey,
         'postinst':      postinst,
         'rclocal':       rclocal,
         'golden_tar':    golden_tar,
+        'skip_upgrade':  skip_upgrade,
+        'golden_cache':  BP.config.golden_cache_dir,
+        'apt_cache':     BP.config.apt_cache_dir,
+        'apt_cache_max': int(BP.config.get('APT_CACHE_MB', 2048)) << 20,
+        'image_cache':   BP.config.image_cache_dir,
+        'image_cache_entries': int(BP.config.get('IMAGE_CACHE_ENTRIES', 4)),
+        'compress_threads': int(BP.config.get('COMPRESS_THREADS', 4)),
+        'esp_gzip':      bool(BP.config.get('ESP_GZIP', False)),
+        'esp_image':     manifest.thedict.get('esp_image', False),
         'build_dir':     build_dir,
         'tftp_dir':      tftp_dir,
         'status_file':   tftp_dir + '/status.json',
@@ -399,7 +719,7 @@ def build_node(manifest, node_coord):
     cmd = os.path.dirname(__file__) + \
         '/node_builder/customize_node.py ' + ' '.join(cmd_args)
 
-    msg = '%s manifest set; image build initiated.' % hostname
+    msg = '%s manifest set; image build queued.' % hostname
     response_msg = flask.jsonify({'status' : msg})
     response = flask.make_response(response_msg, 201)
 
@@ -427,35 +747,46 @@ def build_node(manifest, node_coord):
         response_msg = flask.jsonify({'status' : msg})
         return flask.make_response(response_msg, 505)
 
-    # Before the child, to eliminate race condition if returning from
-    # here to web-based actions.
-    customize_node.update_status(
-        build_args, 'Preparing to build PXE images.', status='building')
-
     if BP.DEBUG:
+        customize_node.update_status(
+            build_args, 'Preparing to build PXE images.', status='building')
         set_trace()
         customize_node.execute(build_args)      # SHOULD return
         return response
 
+    # Before the queue, to eliminate race condition if returning from
+    # here to web-based actions.  Waiting jobs get renumbered from there.
     try:
-        forked = os.fork()
-    except OSError as err:
-        msg = 'AYE! Took an arrow to the knee! [%s]' % err
-        response_msg = flask.jsonify({'status' : msg})
-        return flask.make_response(response_msg, 505)
+        BP.scheduler.submit(node_coord, build_args, priority)
+    except ValueError as err:
+        response_msg = flask.jsonify({'status' : str(err)})
+        return flask.make_response(response_msg, 409)
+    return response
+
+
+def _build_queued(node_coord, build_args, position):
+    '''BuildScheduler notify: the node is waiting, get_node_status() says
+    where it is in the queue from then on.'''
+    build_args.queue_position = position
+    customize_node.update_status(
+        build_args, 'Waiting for a build worker', status='building')
+    BP.status_cache.reload(build_args.hostname)
 
-    if forked > 0:  # wait for the child1 to exit.
-        try:
-            pid, retval = os.waitpid(forked, 0)
-            if retval:
-                response.status_code = 500
-        except OSError as e:
-            response.status_code = 500
-        return response
 
-    # The child makes a grandchild to build the node.  Close the flask socket.
-    # Yes there's a window on multiple requestors, but I'm not ready for
-    # eventlets yet.
+def _build_failed(node_coord, build_args, reason):
+    '''BuildScheduler failed: don't leave a dead build at "building".'''
+    BP.status_cache.reload(build_args.hostname)
+    status = BP.status_cache.get(build_args.hostname)
+    if status is None or status.get('status') != 'building':
+        return      # Unbound, or execute() said what went wrong itself
+    build_args.queue_position = None
+    customize_node.update_status(build_args, reason, status='error')
+    BP.status_cache.reload(build_args.hostname)
+
+
+def _build_child(build_args):
+    '''BuildScheduler runner, in a forked child.  Returns exit status.'''
+    # Don't hold the flask listening socket open for the whole build.
     for i in range(3, 20):
         try:
             os.close(i)
@@ -463,20 +794,24 @@ def build_node(manifest, node_coord):
             if err.errno != errno.EBADF:
                 BP.logger.warning('Could not close(%d): %s' % (i, str(err)))
 
-    customize_node.execute(build_args)      # should NOT return
-    BP.logger.critical('Unexpected return to child1')
-    raise SystemExit('Unexpected return to child1')
+    build_args.queue_position = None
+    build_args.detach = False
+    response = customize_node.execute(build_args)
+    return 0 if response['status'] == 200 else 1
 
 ###########################################################################
 
 
 _data = None    # node <-> manifest bindings
 
+_MAX_WAIT = 30      # seconds, longest ?wait= a long poll may ask for
+_BUSY_RETRY = 5     # seconds, Retry-After when too many are waiting
+
 
 def get_node_status(node_coord):
     """
-        Scan tftp/images/{hostname} folder for "status.json" that is generated
-    by node_builder/customize_node.py script. This file contatins information
+        Look up tftp/images/{hostname}/status.json, generated by
+    node_builder/customize_node.py script, in BP.status_cache. This file contatins information
     about the Node binding status that complies with ERS specs (Section 8.6)
 
     :param 'node_coord': [str] node full coordinate string.
@@ -484,25 +819,24 @@ def get_node_status(node_coord):
              (status, message, manifest)  (ERS document section 8.6)
              None no status file (ie, node is unbound)
     """
-    try:
-        assert node_coord in BP.node_coords, 'Unknown node coordinate'
-        node_image_dir = node_coord2image_dir(node_coord)   # can raise
-        with open(node_image_dir + '/status.json', 'r') as file_obj:
-            status = json.loads(file_obj.read())
-    except (FileNotFoundError) as err:    # Unbound
-        BP.logger.debug('<get_node_status> for %s: unbound' % (node_coord))
+    if node_coord not in BP.node_coords:
+        BP.logger.error('%s: Unknown node coordinate' % node_coord)
         return None
-    except (AssertionError) as err:
-        BP.logger.error('%s: %s' % (node_coord, str(err)))
+    status = BP.status_cache.get(BP.nodes[node_coord][0].hostname)
+    if BP.logger.isEnabledFor(logging.DEBUG):
+        BP.logger.debug('<get_node_status> for %s: %s' % (node_coord,
+            'unbound' if status is None else json.dumps(status, indent=4)))
+    if status is None:
         return None
-    except Exception as err:       # TCNH =)
-        status = {
-            'message':  'Failed to parse status file: %s ' % str(err),
-            'manifest': 'unknown',
-            'status':   'error'
-        }
-    BP.logger.debug('<get_node_status> for %s: %s' % (
-        node_coord, json.dumps(status, indent=4)))
+    status = dict(status)
+    if 'queue_position' in status:      # Live, not as of _build_queued()
+        position = BP.scheduler.position(node_coord)
+        if position:
+            status['queue_position'] = position
+            status['message'] = 'Waiting for a build worker (position %d)' \
+                % position
+        else:
+            del status['queue_position']
     return status
 
 
@@ -515,12 +849,13 @@ def _load_data():
         current status of the nodes.
     """
     global _data
-    _data = {}
+    data = {}
     for node in BP.nodes:
         node_status = get_node_status(node.coordinate)
         if node_status:
-            _data[node.coordinate] = node_status
-    return _data
+            data[node.coordinate] = node_status
+    _data = data    # one assignment, for concurrent request threads
+    return data
 
 
 def _manifest_lookup(name):
@@ -536,5 +871,16 @@ def register(url_prefix):
     BP.nodes = BP.config['tmconfig'].allNodes
     BP.node_coords = list([node.coordinate for node in BP.nodes])  # ordered
     BP.manifest_lookup = _manifest_lookup
+    BP.scheduler = build_scheduler.BuildScheduler(
+        int(BP.config.get('BUILD_WORKERS', 4)),
+        _build_child,
+        notify=_build_queued,
+        failed=_build_failed,
+        logger=BP.logger)
+    BP.status_cache = status_cache.StatusCache(
+        BP.config['TFTP_IMAGES'], logger=BP.logger)
+    # Long polls may tie up a quarter of the server threads, see serve().
+    BP.waiters = threading.BoundedSemaphore(
+        max(1, int(BP.config.get('SERVER_THREADS', 8)) // 4))
     BP.mainapp.register_blueprint(BP, url_prefix=url_prefix)
     _load_data()
@@ -10,12 +10,16 @@ __maintainer__ = "Rocky Craig, Zakhar Volchak"
 __email__ = "rocky.craig@hpe.com, zakhar.volchak@hpe.com"
 
 import flask
+import io
 import json
 import os
 from pdb import set_trace
 import sys
+import tarfile
+import time
 import werkzeug
 
+from tmms.utils import http_utils
 from tmms.utils import manifest_cfg
 
 _ERS_element = 'manifest'
@@ -37,7 +41,7 @@ def render_all(okmsg='', errmsg=''):
         _ERS_element + '_all.tpl',
         errmsg=errmsg,
         label=__doc__,
-        keys=sorted(_data.keys()),
+        keys=_store.names(),
         okmsg=okmsg,
         base_url=flask.request.url)
 
@@ -49,14 +53,14 @@ def webpage(name=None):
     if name is None:
         return render_all()     # Is this still showing "key"?
 
-    if name not in _data:
+    this = _lookup(name)
+    if this is None:
         return flask.render_template(
             _ERS_element + '_all.tpl',
             label=__doc__,
-            keys=sorted(_data.keys()),
+            keys=_store.names(),
             base_url=flask.request.url.split(name)[0])
 
-    this = _data[name]
     return flask.render_template(
         _ERS_element + '.tpl',
         label=__doc__,
@@ -82,31 +86,59 @@ def webpage_upload():
         contentstr = file.read().decode()
         m = manifest_cfg.ManifestDestiny('', '', BP, contentstr)
         msg = m.response.data.decode()
-        _load_data()
+        _store.update(m.namespace)
         return render_all(okmsg=msg + ': ' + file.filename)
 
     except Exception as e:
         return render_all(errmsg='Upload("%s") failed: %s' % (
             file.filename, str(e)))
 
-    _load_data()
-    return render_all(okmsg='Upload %s complete' % file.filename)
-
 
 ###########################################################################
 # API
 # See blueprint registration in manifest_api.py, these are relative paths
 
+def _manifest_page(prefix=''):
+    """
+        The list endpoints' answer for <prefix>, one page of it with
+    ?limit=N, the page after the name given in ?after=.
+
+    :return: [dict] 'manifests' (the page), 'count' (all matches),
+        'prefixes' (manifests per sub-namespace), and 'next' (the ?after=
+        for the next page) if there is more.  ValueError on bad arguments.
+    """
+    limit = flask.request.args.get('limit', None)
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit must be at least 1')
+    after = flask.request.args.get('after', None)
+    manifests, cursor = _store.page(prefix, after, limit)
+    result = {
+        'manifests': manifests,
+        'count': _store.count(prefix),
+        'prefixes': _store.children(prefix),
+    }
+    if cursor is not None:
+        result['next'] = cursor
+    return result
+
+
 @BP.route('/api/%s/' % _ERS_element)
 def listall():
     """
         GET request that returns a JSON response of all the manifests
-    uploaded to the server.
+    uploaded to the server.  See _manifest_page() for ?limit= and ?after=.
     """
-    all_manifests = sorted(list(_data.keys()))
-    msg = json.dumps({'manifests': all_manifests}, indent=4)
+    try:
+        result = _manifest_page()
+    except ValueError as e:
+        response = flask.make_response('Bad list request: %s' % str(e), 400)
+        BP.logger(response)
+        return response
+    msg = json.dumps(result, indent=4)
     status_code = 200
-    if not all_manifests:
+    if not result['count']:
         status_code = 204
     response = flask.make_response(msg, status_code)
     BP.logger(response)    # level based on response status code
@@ -118,7 +150,9 @@ def listall():
 def show_manifest_json(manname='/'):
     """
         Find a specific manifest with respect to <prefix> and a <manifest name>
-    and return a manifest contents in the response body.
+    and return a manifest contents in the response body.  The ETag is the
+    SHA256 of that canonical JSON, so If-None-Match gets a 304 until the
+    manifest changes.
 
     :param <prefix>: [str] full path to a user's manifesting folder.
     :return: json string with the full contents of the manifest,
@@ -135,7 +169,17 @@ def show_manifest_json(manname='/'):
             response = flask.make_response(
                 'The specified manifest does not exist.', 404)
         else:
-            response = flask.make_response(flask.jsonify(found_manifest.thedict), 200)
+            headers = {
+                'ETag': found_manifest.etag,
+                'Cache-Control': 'no-cache',    # Revalidate; it's cheap
+            }
+            if http_utils.etag_matches(
+                    flask.request.headers.get('If-None-Match'),
+                    found_manifest.etag):
+                response = flask.Response(status=304, headers=headers)
+            else:
+                response = flask.Response(found_manifest.body, status=200,
+                    headers=headers, mimetype='application/json')
 
     BP.logger(response)    # level based on response status code
     return response
@@ -143,30 +187,31 @@ def show_manifest_json(manname='/'):
 
 def list_manifests_by_prefix(prefix=None):
     """
-        This function loops throw _data.items() and for each element in it,
-    finds match with the provided <prefix>. Note: the comparison is happening
-    between _data's known manifests and provided <prefix> with a .startswith()
-    function.
+        All the manifests whose namespace starts with <prefix>, from the
+    sorted index of the manifest store.  See _manifest_page() for paging
+    with ?limit= and ?after=.
 
     :param <prefix>: [str] full path to user's manifesting folder e.g.
         "funutarama/" or "my/futurama/manifests/"
 
-    :return: json string of { 'manifests' : ['prefix/manifest_name']
+    :return: json string of { 'manifests' : ['prefix/manifest_name'], ...
         Example: if there is a "futurama/" folder on the server that has
         'bender' and 'fry' manifests, then request to ../manifest/futurama/
         will result a response of
-        "{ 'manifests' : ['futurama/bender', 'futurama/fry'] }".
+        "{ 'manifests' : ['futurama/bender', 'futurama/fry'], 'count': 2,
+           'prefixes': {} }".
     """
-    result = {'manifests': []}
-
-    for man_path, man_obj in _data.items():
-        if man_path.startswith(prefix) or not prefix:
-            result['manifests'].append(man_path)
+    try:
+        result = _manifest_page(prefix or '')
+    except ValueError as e:
+        response = flask.make_response('Bad list request: %s' % str(e), 400)
+        BP.logger(response)
+        return response
 
-    if not result['manifests']:
+    if not result['count']:
         response = flask.make_response('No Manifests are available.', 204)
     else:
-        response = flask.make_response(jsonify(result), 200)
+        response = flask.make_response(flask.jsonify(result), 200)
 
     BP.logger(response)    # level based on status code
     return response
@@ -188,6 +233,8 @@ def api_upload(prefix=''):
                     uploaded into that provided folder on the server.
                     when prefix = '' then manifest will be uploaded into
                     base of the server's manifest uploads location.
+    :param '?dependencies=1': (optional) answer JSON: the usual message as
+                    'status', plus 'digest' and the 'dependencies' report.
     """
     if prefix and not prefix.endswith('/'):    # FIXME WHY IS THIS BAD?
         flask.abort(404)
@@ -196,18 +243,31 @@ def api_upload(prefix=''):
         contentstr = flask.request.get_data().decode()
 
         if BP.config['DRYRUN']:
-            _data[prefix] = 'dry-run'
+            response = flask.make_response('Manifest upload (DRY RUN)', 200)
             BP.logger(response)    # level based on status cod3
             return response
         else:
             manifest = manifest_cfg.ManifestDestiny(prefix, '', BP, contentstr)
+            _store.update(manifest.namespace)
         response = manifest.response
+        # ?dependencies=1 opts in to JSON with the advisory dependency
+        # report; the upload stands whatever the answer.
+        report = flask.request.args.get('dependencies', '').lower()
+        if report in ('1', 'true', 'yes'):
+            try:
+                dependencies = manifest.resolve_dependencies()
+            except Exception as e:
+                dependencies = { 'error': str(e) }
+            response = flask.make_response(flask.jsonify({
+                'status': response.get_data().decode(),
+                'digest': manifest.digest,
+                'dependencies': dependencies }), response.status_code)
+        response.headers['ETag'] = manifest.etag
 
     except Exception as e:
         response = flask.make_response('Manifest upload failed: %s' % str(e), 422)
 
     BP.logger(response)    # level based on status code
-    _load_data()
     return response
 
 
@@ -232,25 +292,164 @@ def delete_manifest(manname=None):
         try:
             if not BP.config['DRYRUN']:
                 os.remove(manifest_server_path)
+                _store.remove(manname)
                 # TODO: remove prefix folders of the manifests if empty
         except EnvironmentError as err:
             response = flask.make_response('Failed to remove manifest', 500)
 
     BP.logger(response)    # level based on status code
-    _load_data()
     return response
 
 
+# Bulk import and export: many manifests per request, a tar of manifest
+# files at their namespace paths (relative to <prefix>) or NDJSON, one
+# per line.  Export writes { "namespace": ..., "manifest": { ... } } lines,
+# import also takes bare manifests, stored as <prefix>/<name>.
+
+_BULK_MAX = 64 << 20    # bytes in one bulk upload
+
+
+def _bulk_format():
+    fmt = flask.request.args.get('format', None)
+    if fmt is None:
+        fmt = 'tar' if 'tar' in (flask.request.mimetype or '') else 'ndjson'
+    if fmt not in ('tar', 'ndjson'):
+        raise ValueError('format must be tar or ndjson')
+    return fmt
+
+
+def _read_bulk(prefix, fmt):
+    '''[ (namespace, JSON string), ... ] from the request body.'''
+    entries = []
+    stream = flask.request.stream
+    if fmt == 'tar':
+        with tarfile.open(fileobj=stream, mode='r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                assert member.size < 20000, '%s: Too big' % member.name
+                entries.append((prefix + '/' + member.name,
+                                tar.extractfile(member).read().decode()))
+        return entries
+    for lineno, line in enumerate(iter(stream.readline, b''), 1):
+        line = line.decode().strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            raise ValueError('line %d is not JSON' % lineno)
+        if isinstance(item, dict) and 'manifest' in item:
+            namespace = prefix + '/' + str(item.get('namespace', ''))
+            item = item['manifest']
+        else:
+            namespace = '%s/%s' % (prefix, item.get('name', '') if
+                                   isinstance(item, dict) else '')
+        entries.append((namespace, json.dumps(item)))
+    return entries
+
+
+@BP.route('/api/%ss/' % _ERS_element, methods=('POST', ))
+@BP.route('/api/%ss/<path:prefix>' % _ERS_element, methods=('POST', ))
+def api_import(prefix=''):
+    """
+        Upload many manifests under <prefix> in one request, tar or NDJSON
+    (from ?format= or the Content-Type).  Every manifest is validated
+    before any is written; the index is updated once at the end.
+
+    :return: 200 and JSON lists of 'created' and 'overwritten' manifests,
+             or 422 and a list of 'errors' when nothing was written.
+    """
+    try:
+        length = flask.request.content_length
+        assert length is None or length <= _BULK_MAX, 'Too big'
+        fmt = _bulk_format()
+        if BP.config['DRYRUN']:
+            response = flask.make_response('Bulk upload (DRY RUN)', 200)
+            BP.logger(response)
+            return response
+        entries = _read_bulk(prefix.strip('/'), fmt)
+        assert entries, 'No manifests in the upload'
+        result = _store.write_many(entries)
+        code = 422 if 'errors' in result else 200
+        response = flask.make_response(flask.jsonify(result), code)
+    except Exception as e:
+        response = flask.make_response(
+            'Bulk manifest upload failed: %s' % str(e), 422)
+
+    BP.logger(response)    # level based on status code
+    return response
+
+
+class _Drain(object):
+    '''Write-only file for tarfile stream mode; drain() takes the output.'''
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _export_tar(items):
+    out = _Drain()
+    now = time.time()
+    with tarfile.open(fileobj=out, mode='w|') as tar:
+        for namespace, manifest in items:
+            info = tarfile.TarInfo(namespace)
+            info.size = len(manifest.body)
+            info.mtime = now
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(manifest.body))
+            yield out.drain()
+    yield out.drain()           # End-of-archive blocks
+
+
+@BP.route('/api/%ss/' % _ERS_element)
+@BP.route('/api/%ss/<path:prefix>' % _ERS_element)
+def api_export(prefix=''):
+    """
+        Stream every manifest under <prefix>, as NDJSON or with
+    ?format=tar a tar, namespaces relative to <prefix>.  api_import()
+    reads either back.
+    """
+    try:
+        fmt = _bulk_format()
+    except ValueError as e:
+        response = flask.make_response(str(e), 400)
+        BP.logger(response)
+        return response
+    prefix = prefix.strip('/')
+    if prefix:
+        prefix += '/'
+    items = ((namespace[len(prefix):], manifest)
+             for namespace, manifest in _store.export(prefix))
+    if fmt == 'tar':
+        body = _export_tar(items)
+        mimetype = 'application/x-tar'
+    else:
+        body = (json.dumps({ 'namespace': namespace,
+                             'manifest': manifest.thedict },
+                           sort_keys=True).encode() + b'\n'
+                for namespace, manifest in items)
+        mimetype = 'application/x-ndjson'
+    return flask.Response(body, status=200, mimetype=mimetype)
+
 ###########################################################################
 
 
 def _lookup(manifest_name):    # Can be sub/path/name
-    manifest_name = manifest_name.strip('/')
-    return _data.get(manifest_name, None)
+    return _store.get(manifest_name)
 
 
 def get_all():
-    return tuple(_data.keys())
+    return tuple(_store.names())
 
 
 def is_file_allowed(filename):
@@ -258,31 +457,18 @@ def is_file_allowed(filename):
 
 ###########################################################################
 
-_data = None
+_store = None   # manifest_cfg.ManifestStore
 
 
 def _load_data():
-    global _data
-    _data = {}
-    manfiles = [    # List comprehension
-        (dirpath, f) for dirpath, dirnames, fnames in os.walk(BP.UPLOADS)
-        for f in fnames
-    ]
-    for dirpath, basename in manfiles:
-        try:
-            this = manifest_cfg.ManifestDestiny(dirpath, basename, BP)
-
-            # Start with a full path, then a relative part, then the namespace
-            manname = os.path.join(dirpath, basename)   # Build a full path
-            manname = manname.split(BP.config['MANIFEST_UPLOADS'])[-1]
-            # folder. e.g. user_folder/my_manifest
-            manname = os.path.normpath(manname).strip('/')
-
-            # search is expected by manifest name, (e.g. manifest.json, not
-            # path/manifest.json)
-            _data[manname] = this
-        except Exception as e:
-            pass
+    """
+        Index the uploads once.  After that API writes update their own
+    entry and the store rescans for outside changes (stat() only, reading
+    just the new and changed files) every MANIFEST_RESCAN_SECONDS.
+    """
+    global _store
+    _store = manifest_cfg.ManifestStore(
+        BP, poll=int(BP.config.get('MANIFEST_RESCAN_SECONDS', 10)))
 
 
 def register(url_prefix):
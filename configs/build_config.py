@@ -175,10 +175,45 @@ class ManifestingConfiguration(object):
 
         return found_tar[0]
 
+    @property
+    def package_index(self):
+        '''SQLite index of the mirrors' Packages, see utils/package_index.py'''
+        return self.get('MANIFESTING_ROOT') + '/packages.sqlite'
+
     @property
     def golden_dir(self):
         return self.get('FILESYSTEM_IMAGES') + '/golden'
 
+    @property
+    def golden_snapshot_dir(self):
+        '''Dated, pre-upgraded copies of GOLDEN_TAR, see refresh_golden()'''
+        return self.golden_dir + '/snapshots'
+
+    @property
+    def golden_snapshot(self):
+        '''The newest golden snapshot .tar, or None'''
+        found = sorted(glob.glob(self.golden_snapshot_dir + '/golden.*.tar'))
+        return found[-1] if found else None
+
+    @property
+    def golden_cache_dir(self):
+        '''Pre-extracted copies of GOLDEN_TAR, see core_utils.untar_cached'''
+        return self.golden_dir + '/cache'
+
+    @property
+    def apt_cache_dir(self):
+        '''.debs and lists shared by node builds, see utils/apt_cache.py'''
+        if not int(self.get('APT_CACHE_MB', 2048)):
+            return None
+        return self.get('FILESYSTEM_IMAGES') + '/apt-cache'
+
+    @property
+    def image_cache_dir(self):
+        '''Customized rootfs per manifest, see customize_node.execute()'''
+        if not int(self.get('IMAGE_CACHE_ENTRIES', 4)):
+            return None
+        return self.get('FILESYSTEM_IMAGES') + '/image-cache'
+
     @property
     def arch(self):
         '''
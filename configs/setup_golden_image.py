@@ -13,8 +13,11 @@ __email__ = "rocky.craig@hpe.com, zakhar.volchak@hpe.com"
 
 import argparse
 import errno
+import glob
 import os
 import sys
+import tarfile
+import time
 
 from pdb import set_trace
 
@@ -29,9 +32,19 @@ LOGGER = None
 VERBOSE = False
 
 
-def customize_golden(manconfig):
-    '''Combine /etc/tmms settings and some hardcoded values.'''
-    build_dir = os.path.dirname(manconfig['GOLDEN_TAR'])
+_GOLDEN_PACKAGES = 'linux-image-4.14.0-l4fame-72708-ge6511d981425,l4fame-node'
+
+
+def customize_golden(manconfig, packages=_GOLDEN_PACKAGES, build_dir=None,
+                     destination=None):
+    '''
+        Combine /etc/tmms settings and some hardcoded values.  By default
+    GOLDEN_TAR is customized in place; refresh_golden() builds elsewhere.
+    '''
+    if build_dir is None:
+        build_dir = os.path.dirname(manconfig['GOLDEN_TAR'])
+    if destination is None:
+        destination = manconfig['GOLDEN_TAR']
     #FIXME: make it a config file
     arg_values = {
         'manifest' : None,
@@ -44,7 +57,7 @@ def customize_golden(manconfig):
         'repo_release' : manconfig['DEBIAN_RELEASE'],
         'repo_areas' : manconfig['DEBIAN_AREAS'],
         'other_mirrors' : manconfig['OTHER_MIRRORS'],
-        'packages' : 'linux-image-4.14.0-l4fame-72708-ge6511d981425,l4fame-node',
+        'packages' : packages,
         'golden_tar' : manconfig['GOLDEN_TAR'],
         'build_dir' : build_dir,
         'status_file' : build_dir + '/status.json',
@@ -61,7 +74,7 @@ def customize_golden(manconfig):
         raise RuntimeError(msg)
 
     golden_dir = os.path.dirname(manconfig['GOLDEN_TAR'])
-    core_utils.make_tar(manconfig['GOLDEN_TAR'], build_dir + '/untar')
+    core_utils.make_tar(destination, build_dir + '/untar')
     file_utils.remove_target(build_dir + '/untar')
 
     if os.path.exists(golden_dir + '.raw'):
@@ -73,6 +86,64 @@ def customize_golden(manconfig):
     print(' -- Customization stage is finished. -- ')
 
 
+def _dpkg_status(tarball):
+    '''/var/lib/dpkg/status of a golden tarball, None if it has none.'''
+    try:
+        with tarfile.open(tarball) as tar:
+            return tar.extractfile('var/lib/dpkg/status').read()
+    except (KeyError, OSError, tarfile.TarError):
+        return None
+
+
+def refresh_golden(manconfig, keep=2):
+    '''
+        Run apt-get update/upgrade on a copy of GOLDEN_TAR and save it as
+    golden/snapshots/golden.ARCH.YYYYmmdd-HHMMSS.tar.  Node builds start
+    from the newest snapshot and skip their own update/upgrade while it is
+    younger than GOLDEN_REFRESH_HOURS.  Run it from cron at least that often.
+
+    Every new snapshot is a new golden digest: the extracted golden cache
+    and every image cache entry start over, ie, the next build of each
+    manifest is a full one.  So a refresh that upgraded nothing (same dpkg
+    status) doesn't make a snapshot, it only marks the newest one fresh.
+
+    :param 'keep': [int] snapshots to keep; older ones are removed.
+    :return: [str] path of the new (or renewed) snapshot.
+    '''
+    assert manconfig['GOLDEN_TAR'] is not None, \
+        'No golden image, run "setup.py golden_image" first'
+    snapshot_dir = manconfig.golden_snapshot_dir
+    build_dir = snapshot_dir + '/build'
+    file_utils.remove_target(build_dir)
+    os.makedirs(build_dir)
+
+    snapshot = '%s/golden.%s.%s.tar' % (
+        snapshot_dir, manconfig.arch, time.strftime('%Y%m%d-%H%M%S'))
+    # No packages: install.sh only does update/upgrade
+    customize_golden(manconfig, packages=None, build_dir=build_dir,
+                     destination=snapshot + '.new')
+    file_utils.remove_target(build_dir)
+
+    newest = manconfig.golden_snapshot
+    status = _dpkg_status(snapshot + '.new')
+    if newest is not None and status is not None and \
+       status == _dpkg_status(newest):
+        file_utils.remove_target(snapshot + '.new')
+        os.utime(newest)                # Fresh for GOLDEN_REFRESH_HOURS
+        core_utils.hash_file(newest)    # New mtime: rehash here, not in a build
+        print(' -- Nothing upgraded, %s is still current. -- ' %
+            os.path.basename(newest))
+        return newest
+    os.rename(snapshot + '.new', snapshot)
+
+    snapshots = sorted(glob.glob(snapshot_dir + '/golden.*.tar'))
+    for stale in snapshots[:-max(1, keep)]:
+        file_utils.remove_target(stale)
+        file_utils.remove_target(stale + '.sha256')     # see hash_file()
+    print(' -- Golden snapshot %s is ready. -- ' % os.path.basename(snapshot))
+    return snapshot
+
+
 def move_dir(target, into, verbose=False):
     move_status = file_utils.move_target(target, into, verbose)
     if move_status is False:
@@ -214,6 +285,16 @@ def main(args):
     customize_golden(manconfig)
 
 
+def main_refresh(args):
+    """
+        Make a new pre-upgraded golden snapshot.  Return None or raise error.
+    """
+    assert os.geteuid() == 0, 'This script requires root permissions'
+    manconfig = ManifestingConfiguration(args.config, autoratify=False)
+    manconfig.ratify(dontcare=('TMCONFIG', ))
+    refresh_golden(manconfig)
+
+
 if __name__ == '__main__':
     # Not worth working around this
     raise SystemExit('Can only be run from top-level setup.py')
@@ -381,6 +381,43 @@ def daemonize(mainapp, cmdline_args):
 # Used here for debug and in landing page (see route above).
 
 
+def serve(mainapp):
+    """
+        Answer requests on SERVER_THREADS threads so a slow one (a big
+    page, an ESP download, a "waitnode" long poll) doesn't hold up the rest.
+    Long polls may only take a quarter of them, see the nodes blueprint.
+    Use waitress (python3-waitress) if it's installed: a fixed pool of
+    request threads, and files are streamed by its I/O loop, not a request
+    thread.  Otherwise, or for --debug/--auto-update which need the reloader
+    and debugger, the werkzeug server with a thread per request.
+    """
+    threads = int(mainapp.config.get('SERVER_THREADS', 8))
+    if not mainapp.config['DEBUG'] and not mainapp.config['auto-update']:
+        try:
+            import waitress
+        except ImportError:
+            mainapp.logger.warning(
+                'waitress is not installed, using the werkzeug server')
+        else:
+            mainapp.logger.info(
+                'Starting waitress web server, %d threads' % threads)
+            waitress.serve(
+                mainapp,
+                host=mainapp.config['HOST'],
+                port=mainapp.config['PORT'],
+                threads=threads,
+                ident='tm-manifesting')
+            return
+
+    mainapp.logger.info('Starting werkzeug web server')
+    mainapp.run(
+        debug=mainapp.config['DEBUG'],
+        use_reloader=mainapp.config['auto-update'],
+        host=mainapp.config['HOST'],
+        port=mainapp.config['PORT'],
+        threaded=threads > 1)
+
+
 def main():
     core_utils.set_proxy_environment()
 
@@ -427,14 +464,8 @@ def main():
     daemonize(mainapp, cmdline_args)    # If it's a daemon, do it now...
     register_blueprints(mainapp)        # ...to stick this in the background.
 
-    mainapp.logger.info('Starting web server')
-    mainapp.run(
-        debug=mainapp.config['DEBUG'],
-        use_reloader=mainapp.config['auto-update'],
-        host=mainapp.config['HOST'],
-        port=mainapp.config['PORT'],
-        threaded=False)
-    mainapp.logger.warning('Built-in server terminated')
+    serve(mainapp)
+    mainapp.logger.warning('Web server terminated')
     kill_dnsmasq(mainapp.config)
 
 
@@ -159,7 +159,7 @@ if __name__ == '__main__':
             raise RuntimeError(msg)
 
         args = parse_cmdline_args(
-            'setup action(s):\n   "all", "environment", "networking", "golden_image"')
+            'setup action(s):\n   "all", "environment", "networking", "golden_image", "golden_refresh"')
         try_dh_helper(args.extra)     # Doesn't return if packaging called me
 
         # Imports are relative because implicit Python path "tmms" may not
@@ -187,7 +187,7 @@ if __name__ == '__main__':
             actions = legal
         else:
             actions = args.extra
-            assert actions[0] in ('tmconfig',) + legal, \
+            assert actions[0] in ('tmconfig', 'golden_refresh') + legal, \
                 'Illegal action "%s"' % actions[0]
 
         for a in actions:
@@ -200,6 +200,9 @@ if __name__ == '__main__':
             elif a == 'golden_image':
                 from configs import setup_golden_image
                 setup_golden_image.main(args)
+            elif a == 'golden_refresh':
+                from configs import setup_golden_image
+                setup_golden_image.main_refresh(args)
             elif a == 'tmconfig':
                 from configs import setup_tmconfig
                 setup_tmconfig.main(args)
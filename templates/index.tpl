@@ -208,6 +208,9 @@
                 <li class="list-group-item">
                     <a>{{ base_url }}api/manifest/&lt;name&gt;</a>
                 </li>
+                <li class="list-group-item">
+                    <a>{{ base_url }}api/manifests/&lt;prefix&gt;</a>
+                </li>
             </ul>
 
 
@@ -219,6 +222,9 @@
                 <li class="list-group-item">
                     <a>{{ base_url }}api/tasks/&lt;name&gt;</a>
                 </li>
+                <li class="list-group-item">
+                    <a>{{ base_url }}api/tasks/packages/&lt;name&gt;</a>
+                </li>
             </ul>
 
             <ul class="list-group" style="margin-top:2%;">
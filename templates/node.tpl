@@ -150,8 +150,16 @@ determined, we’ll list those here.
         <div class="alert alert-info col-md-7" role="alert" style="text-align:center;">
             <h4>SDHC/USB image:
                 <a class="alert-link" href="{{ ESPURL }}">
-                    {{ node.hostname }}.ESP ({{ ESPsizeMB }}M)
+                    {{ node.hostname }}.ESP
+                    {% if ESPsizeMB %}({{ ESPsizeMB }}M){% else %}(built on first download){% endif %}
                 </a>
+                {% if ESPgzURL is not none %}
+                or
+                <a class="alert-link" href="{{ ESPgzURL }}">
+                    {{ node.hostname }}.ESP.gz
+                    {% if ESPgzsizeMB %}({{ ESPgzsizeMB }}M){% endif %}
+                </a>
+                {% endif %}
             </h4>
         </div>
     {% endif %}
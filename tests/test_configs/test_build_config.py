@@ -4,6 +4,7 @@
 """
 import json
 import os
+import shutil
 import unittest
 from pdb import set_trace
 
@@ -57,5 +58,22 @@ class PackageTest(unittest.TestCase):
         self.assertIsNone(cfg['DOES_NOT_EXIST'])
 
 
+
+    def test_golden_snapshot(self):
+        cfg = MC(self.tmms_path, False)
+        snapshots = cfg.golden_snapshot_dir
+        self.assertTrue(snapshots.startswith(cfg.golden_dir))
+        try:
+            os.makedirs(snapshots)
+            self.assertIsNone(cfg.golden_snapshot)
+            for stamp in ('20260101-120000', '20261001-090000', '20260501-000000'):
+                open('%s/golden.arm64.%s.tar' % (snapshots, stamp), 'w').close()
+            open(snapshots + '/golden.arm64.20261231-000000.tar.new', 'w').close()
+            self.assertEqual(cfg.golden_snapshot,
+                             snapshots + '/golden.arm64.20261001-090000.tar')
+        finally:
+            shutil.rmtree(snapshots, ignore_errors=True)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,45 @@
+#!/usr/bin/python3 -tt
+"""
+    Test parse_apt_failures function of customize_node.py script.
+"""
+from pdb import set_trace
+import unittest
+
+from config import CN
+
+_LOG = '''
+---------- Installing 4 packages
+
+Reading package lists...
+Building dependency tree...
+Some packages could not be installed. This may mean that you have
+requested an impossible situation.
+The following packages have unmet dependencies:
+ album : Depends: libpmem1 (>= 1.3) but it is not going to be installed
+E: Unable to locate package nosuch
+E: Package 'ghost' has no installation candidate
+E: Failed to fetch http://mirror/pool/main/v/vim/vim-common_8.0_arm64.deb  404  Not Found
+dpkg: error processing package tm-librarian (--configure):
+ subprocess installed post-installation script returned error exit status 1
+Errors were encountered while processing:
+ tm-librarian
+ /var/cache/apt/archives/python3-tm_1.2_all.deb
+Install failed
+'''
+
+
+class AptFailuresTest(unittest.TestCase):
+
+    def test_parse_apt_failures(self):
+        """ Each broken package is named once, in order, with its reason """
+        failures = CN.parse_apt_failures(_LOG)
+        self.assertEqual(list(failures), [
+            'album', 'nosuch', 'ghost', 'vim-common', 'tm-librarian',
+            'python3-tm'])
+        self.assertIn('libpmem1', failures['album'][0])
+        self.assertEqual(len(failures['tm-librarian']), 2)
+        self.assertEqual(CN.parse_apt_failures('All is well\n'), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
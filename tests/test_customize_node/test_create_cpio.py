@@ -4,6 +4,7 @@
 """
 from pdb import set_trace
 from argparse import Namespace
+import gzip
 import os
 import sys
 import unittest
@@ -56,5 +57,32 @@ class CreateCpioTest(unittest.TestCase):
         self.assertTrue(os.path.exists(cpio_file), 'cpio file was not created!')
 
 
+    def test_create_cpio_streaming(self):
+        """
+            With a TFTP directory and no debug flag the archive goes straight
+        to <tftp_dir>/<hostname>.cpio.gz, without an uncompressed copy.
+        """
+        hostname = 'unittest_host'
+        tftp_dir = '%s/tftp' % self.tmp_folder
+        os.makedirs(tftp_dir)
+        args = {'new_fs_dir' : self.fs_img,
+                'hostname' : hostname,
+                'build_dir' : self.tmp_folder,
+                'tftp_dir' : tftp_dir,
+                'verbose' : False,
+                'debug' : False,
+                'dryrun' : True}
+        args = Namespace(**args)
+
+        cpio_gzip = CN.create_cpio(args)
+
+        self.assertEqual(cpio_gzip, '%s/%s.cpio.gz' % (tftp_dir, hostname))
+        self.assertEqual(os.listdir(tftp_dir), [hostname + '.cpio.gz'])
+        self.assertFalse(os.path.exists(
+            '%s/%s.cpio' % (self.tmp_folder, hostname)))
+        with gzip.open(cpio_gzip, 'rb') as f:
+            self.assertEqual(f.read(6), b'070701')
+
+
 if __name__ == '__main__':
     unittest.main()
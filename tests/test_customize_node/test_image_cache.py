@@ -0,0 +1,127 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the manifest-keyed image cache of customize_node.py script.
+"""
+from pdb import set_trace
+from argparse import Namespace
+import os
+import unittest
+from shutil import rmtree
+from unittest import mock
+
+import config
+from config import CN
+
+
+class ImageCacheTest(unittest.TestCase):
+
+    tmp_folder = "/tmp/UNITTEST_CUSTOMNODE/"
+    fs_img = "/tmp/UNITTEST_CUSTOMNODE/fs_img/"
+
+    @classmethod
+    def setUp(cls):
+        config.setup()
+        cls.tmp_folder = config.tmp_folder
+        cls.fs_img = config.fs_img
+        cls.golden_tar = cls.tmp_folder + '/golden.arm64.tar'
+        with open(cls.golden_tar, 'w') as f:
+            f.write('not really a tarball')
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def make_args(self, **manifest):
+        thedict = {'name': 'base', 'description': 'Base image',
+                   'release': 'stretch', 'tasks': [], 'packages': ['vim']}
+        thedict.update(manifest)
+        args = {'manifest': Namespace(thedict=thedict),
+                'golden_tar': self.golden_tar,
+                'repo_mirror': 'http://localhost/debian',
+                'repo_release': 'stretch',
+                'repo_areas': ['main'],
+                'image_cache': self.tmp_folder + '/image-cache',
+                'image_cache_entries': 1,
+                'is_golden': False,
+                'dryrun': True}
+        return Namespace(**args)
+
+
+    def test_image_cache_key(self):
+        """ Renaming a manifest keeps the key, changing packages doesn't """
+        key = CN.image_cache_key(self.make_args())
+        self.assertEqual(key, CN.image_cache_key(
+            self.make_args(name='copy', description='Same thing')))
+        self.assertEqual(key, CN.image_cache_key(
+            self.make_args(rclocal='echo hello')))
+        self.assertEqual(key, CN.image_cache_key(
+            self.make_args(esp_image=True)))
+        self.assertNotEqual(key, CN.image_cache_key(
+            self.make_args(packages=['vim', 'emacs'])))
+
+
+    def test_save_restore(self):
+        """ A saved rootfs and its kernel come back for another node """
+        args = self.make_args()
+        args.new_fs_dir = self.fs_img
+        args.build_dir = self.tmp_folder + '/node01'
+        os.makedirs(args.build_dir)
+        args.bootfiles = ['%s/%s' % (args.build_dir, os.path.basename(f))
+                          for f in CN.extract_bootfiles(args)]
+        with CN.image_cache_entry(args) as entry:
+            CN.save_cached_image(args, entry)
+        self.assertTrue(os.path.isdir(entry + '/rootfs/etc'))
+
+        other = self.make_args(name='other')
+        other.build_dir = self.tmp_folder + '/node02'
+        os.makedirs(other.build_dir)
+        with CN.image_cache_entry(other) as found:
+            self.assertEqual(found, entry)
+            CN.restore_cached_image(other, found)
+        self.assertTrue(os.path.isfile(other.new_fs_dir + '/etc/hosts'))
+        self.assertEqual(os.path.dirname(other.vmlinuz_golden),
+                         other.build_dir)
+        self.assertTrue(os.path.isfile(other.vmlinuz_golden))
+
+
+    def test_per_node(self):
+        """ A cached tree gets this node's identity, a fresh one is left alone """
+        os.makedirs(self.fs_img + '/etc/dhcp')
+        with open(self.fs_img + '/etc/dhcp/dhclient.conf', 'w') as f:
+            f.write('#send dhcp-client-identifier 1:0:a0:24:ab:fb:9c;\n')
+        args = self.make_args()
+        args.new_fs_dir = self.fs_img
+        args.hostname = 'node01'
+        args.node_coord = '/MachineRevision/1/Node/1'
+        args.DhcpClientId = 'node01-id'
+        CN.set_client_id(args)      # As customize_shared() does
+
+        args.hostname = 'node02'
+        args.DhcpClientId = 'node02-id'
+        with mock.patch.object(CN, 'rehost_packages') as rehost, \
+             mock.patch.object(CN, 'hack_LFS_autostart'), \
+             mock.patch.object(CN, 'rewrite_rclocal'):
+            args.image_cache_hit = False
+            CN.customize_per_node(args)
+            self.assertEqual(rehost.call_count, 0)
+            with open(self.fs_img + '/etc/hostname') as f:
+                self.assertEqual(f.read().strip(), '')
+
+            args.image_cache_hit = True
+            CN.customize_per_node(args)
+            self.assertEqual(rehost.call_count, 1)
+
+        with open(self.fs_img + '/etc/hostname') as f:
+            self.assertEqual(f.read().strip(), 'node02')
+        with open(self.fs_img + '/etc/dhcp/dhclient.conf') as f:
+            dhclient = f.read()
+        self.assertIn('#send dhcp-client-identifier', dhclient)
+        self.assertNotIn('node01-id', dhclient)
+        self.assertEqual(dhclient.count('node02-id'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
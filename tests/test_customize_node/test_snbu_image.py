@@ -0,0 +1,94 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the SNBU (SDHC/USB) image steps of customize_node.py script, the
+way the nodes blueprint runs them on first download.
+"""
+from pdb import set_trace
+from argparse import Namespace
+import os
+import unittest
+from shutil import rmtree
+from unittest import mock
+
+import config
+from config import CN
+
+
+class SNBUImageTest(unittest.TestCase):
+
+    tmp_folder = "/tmp/UNITTEST_CUSTOMNODE/"
+
+    @classmethod
+    def setUp(cls):
+        config.setup()
+        cls.tmp_folder = config.tmp_folder
+        cls.tftp_dir = cls.tmp_folder + '/tftp/images/node01'
+        os.makedirs(cls.tftp_dir)
+        os.makedirs(cls.tmp_folder + '/tftp/grub')
+        with open(cls.tmp_folder + '/tftp/grub/grubaa64.efi', 'wb') as f:
+            f.write(b'MZ' + bytes(4096))
+        cls.bootfiles = []
+        for name in ('node01.vmlinuz.gz', 'node01.cpio.gz'):
+            cls.bootfiles.append(cls.tftp_dir + '/' + name)
+            with open(cls.bootfiles[-1], 'wb') as f:
+                f.write(os.urandom(100000))
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def make_args(self):
+        build_dir = self.tftp_dir + '/.ESP.test'
+        os.makedirs(build_dir, exist_ok=True)
+        return Namespace(hostname='node01', tftp_dir=self.tftp_dir,
+                         build_dir=build_dir, esp_gzip=False, no_status=True,
+                         logger=mock.Mock())
+
+
+    def test_create_remove(self):
+        """ Published in the TFTP directory, sparse, removed on rebuild """
+        args = self.make_args()
+        CN.create_SNBU_image(args, *self.bootfiles)
+        ESP = self.tftp_dir + '/node01.ESP'
+        self.assertTrue(os.path.isfile(ESP))
+        self.assertFalse(os.path.exists(args.build_dir + '/node01.ESP'))
+        self.assertEqual(os.stat(ESP).st_size, 384 << 20)
+        self.assertLess(os.stat(ESP).st_blocks * 512, 16 << 20)
+        self.assertFalse(os.path.exists(self.tftp_dir + '/status.json'))
+        with open(ESP, 'rb') as f:
+            image = f.read()
+        self.assertIn(b'linux /EFI/debian/node01.vmlinuz.gz\n', image)
+        self.assertIn(b'initrd /EFI/debian/node01.cpio.gz\n', image)
+
+        CN.remove_SNBU_image(args)
+        self.assertFalse(os.path.exists(ESP))
+
+
+    def test_missing_grub(self):
+        """ A failed build publishes nothing """
+        os.unlink(self.tmp_folder + '/tftp/grub/grubaa64.efi')
+        CN.create_SNBU_image(self.make_args(), *self.bootfiles)
+        self.assertFalse(os.path.exists(self.tftp_dir + '/node01.ESP'))
+        with self.assertRaises(RuntimeError):
+            CN.build_SNBU_image(self.make_args(), *self.bootfiles)
+
+
+    def test_build_publish_gzip(self):
+        """ Both files built in build_dir, then moved into place """
+        args = self.make_args()
+        args.esp_gzip = True
+        ESP_img = CN.build_SNBU_image(args, *self.bootfiles)
+        self.assertTrue(os.path.isfile(ESP_img + '.gz'))
+        self.assertFalse(os.path.exists(self.tftp_dir + '/node01.ESP'))
+        CN.publish_ESP(args, ESP_img, self.tftp_dir + '/node01.ESP')
+        self.assertTrue(os.path.isfile(self.tftp_dir + '/node01.ESP'))
+        self.assertTrue(os.path.isfile(self.tftp_dir + '/node01.ESP.gz'))
+        self.assertEqual(os.listdir(args.build_dir), [])
+        self.assertFalse(os.path.exists(self.tftp_dir + '/status.json'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the shared apt cache in apt_cache.py.
+"""
+from pdb import set_trace
+
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+from tmms.utils import apt_cache
+
+
+class AptCacheTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.cache = cls.tmp_folder + '/apt-cache'
+        cls.node1 = cls.tmp_folder + '/node01'
+        cls.node2 = cls.tmp_folder + '/node02'
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def write_file(self, path, size, atime=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        if atime is not None:
+            os.utime(path, (atime, atime))
+
+
+    def test_seed_harvest(self):
+        """ One node's downloads are hardlinked into the next node """
+        archives = '/var/cache/apt/archives/'
+        lists = '/var/lib/apt/lists/'
+        self.write_file(self.node1 + archives + 'foo_1.0_arm64.deb', 10)
+        self.write_file(self.node1 + lists + 'mirror_dists_main_Packages', 5)
+        self.write_file(self.node1 + lists + 'lock', 0)
+
+        self.assertEqual(apt_cache.harvest(self.cache, self.node1, 1000), 2)
+        self.assertEqual(os.listdir(self.node1 + archives), [])
+        self.assertEqual(sorted(os.listdir(self.cache)), ['archives', 'lists'])
+        self.assertFalse(os.path.exists(self.cache + '/lists/lock'))
+
+        self.assertEqual(apt_cache.seed(self.cache, self.node2), 2)
+        deb = self.node2 + archives + 'foo_1.0_arm64.deb'
+        self.assertEqual(os.stat(deb).st_ino,
+            os.stat(self.cache + '/archives/foo_1.0_arm64.deb').st_ino)
+        self.assertEqual(apt_cache.seed(self.cache, self.node2), 0)
+
+
+    def test_evict(self):
+        """ Least recently used .debs go first """
+        for n, name in enumerate(('old', 'mid', 'new')):
+            self.write_file('%s/archives/%s.deb' % (self.cache, name),
+                            100, atime=1000 + n)
+        self.assertEqual(apt_cache.evict(self.cache, 250), 100)
+        self.assertEqual(sorted(os.listdir(self.cache + '/archives')),
+                         ['mid.deb', 'new.deb'])
+        self.assertEqual(apt_cache.evict(self.cache, 250), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the build stage profile in build_profile.py.
+"""
+from pdb import set_trace
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from argparse import Namespace
+from shutil import rmtree
+
+from tmms.utils import build_profile
+
+
+@build_profile.profiled
+def _step(args, seconds):
+    time.sleep(seconds)
+    return 'done'
+
+
+class BuildProfileTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_stages(self):
+        """ Nesting, child CPU, failures, the summary """
+        args = Namespace(profile=build_profile.BuildProfile())
+        with build_profile.stage(args, 'outer'):
+            self.assertEqual(_step(args, 0.05), 'done')
+            subprocess.check_call([ sys.executable, '-c',
+                                    'sum(range(3000000))' ])
+        try:
+            with build_profile.stage(args, 'broken'):
+                raise RuntimeError('apt-get failed')
+        except RuntimeError:
+            pass
+        _step(args, 0)
+
+        outer, step, broken, again = args.profile.stages
+        self.assertEqual((outer['stage'], outer['depth']), ('outer', 0))
+        self.assertEqual((step['stage'], step['depth']), ('_step', 1))
+        self.assertGreaterEqual(step['wall'], 0.05)
+        self.assertGreaterEqual(outer['wall'], step['wall'])
+        self.assertGreater(outer['cpu_user'] + outer['cpu_system'], 0)
+        self.assertGreater(outer['children_maxrss_kb'], 0)
+        self.assertTrue(outer['ok'])
+        self.assertFalse(broken['ok'])
+
+        summary = args.profile.summary()
+        self.assertEqual(sorted(summary['stages']),
+                         [ '_step', 'broken', 'outer' ])
+        self.assertGreaterEqual(summary['elapsed'], outer['wall'])
+
+
+    def test_unprofiled(self):
+        """ Steps run as usual without args.profile """
+        self.assertEqual(_step(Namespace(), 0), 'done')
+
+
+    def test_write(self):
+        profile = build_profile.BuildProfile()
+        with profile.stage('create_cpio'):
+            pass
+        path = self.tmp_folder + '/' + build_profile.REPORT
+        profile.write(path, hostname='node01', status='ready')
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(report['hostname'], 'node01')
+        self.assertEqual(report['stages'][0]['stage'], 'create_cpio')
+        self.assertFalse(os.path.exists(path + '.new'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the node build queue in build_scheduler.py.
+"""
+from pdb import set_trace
+
+import os
+import tempfile
+import time
+import unittest
+from shutil import rmtree
+
+from tmms.utils.build_scheduler import BuildScheduler
+
+
+def _runner(job):
+    '''Runs in the forked child: leave a trace, take a little time.'''
+    fname, delay = job
+    time.sleep(delay)
+    with open(fname, 'w') as f:
+        f.write('%f' % time.time())
+    return 0
+
+
+def _crasher(job):
+    if job == 'crash':
+        raise RuntimeError('before execute() wrote any status')
+    return job
+
+
+class BuildSchedulerTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.positions = {}
+        cls.failures = {}
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def _notify(self, key, job, position):
+        self.positions[key] = position
+
+
+    def _failed(self, key, job, reason):
+        self.failures[key] = reason
+
+
+    def _wait_for(self, fnames, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if all(os.path.exists(f) for f in fnames):
+                return True
+            time.sleep(0.05)
+        return False
+
+
+    def test_priority_order(self):
+        """ One worker: a blocker runs, then lower priority numbers first """
+        sched = BuildScheduler(1, _runner, notify=self._notify)
+        fnames = dict((k, '%s/%s' % (self.tmp_folder, k))
+            for k in ('blocker', 'late', 'early'))
+        sched.submit('blocker', (fnames['blocker'], 0.5))
+        time.sleep(0.2)     # let it start
+        sched.submit('late', (fnames['late'], 0), priority=5)
+        sched.submit('early', (fnames['early'], 0), priority=1)
+
+        self.assertEqual(sched.position('blocker'), 0)
+        self.assertEqual(sched.position('early'), 1)
+        self.assertEqual(sched.position('late'), 2)
+        self.assertEqual(self.positions,      # Once each, when queued
+                         { 'blocker': 1, 'late': 1, 'early': 1 })
+        self.assertRaises(ValueError, sched.submit, 'late', None)
+
+        self.assertTrue(self._wait_for(fnames.values()))
+        with open(fnames['early']) as e, open(fnames['late']) as l:
+            self.assertLess(float(e.read()), float(l.read()))
+
+
+    def test_cancel(self):
+        """ Cancel both a waiting and a running build """
+        sched = BuildScheduler(1, _runner)
+        running = '%s/running' % self.tmp_folder
+        waiting = '%s/waiting' % self.tmp_folder
+        sched.submit('running', (running, 30))
+        time.sleep(0.2)
+        sched.submit('waiting', (waiting, 0))
+
+        self.assertTrue(sched.cancel('waiting'))
+        self.assertIsNone(sched.position('waiting'))
+        self.assertTrue(sched.cancel('running', timeout=5))
+        self.assertIsNone(sched.position('running'))
+        self.assertFalse(sched.cancel('running'))
+        self.assertFalse(os.path.exists(running))
+        self.assertFalse(os.path.exists(waiting))
+
+
+    def test_failed(self):
+        """ Crashes and nonzero exits are reported, cancels are not """
+        sched = BuildScheduler(2, _crasher, failed=self._failed)
+        for key in ('crash', 0, 3):
+            sched.submit(key, key)
+        running = '%s/running' % self.tmp_folder
+        cancelled = BuildScheduler(1, _runner, failed=self._failed)
+        cancelled.submit('cancelled', (running, 30))
+        time.sleep(0.2)
+        self.assertTrue(cancelled.cancel('cancelled', timeout=5))
+
+        deadline = time.time() + 10
+        while len(self.failures) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.2)     # Anything else would have shown up by now
+        self.assertEqual(self.failures, {
+            'crash': 'Build crashed',
+            3: 'Build exited with status 3' })
+        self.assertIsNone(sched.position('crash'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the boot artifact compressors in compress_utils.py.
+"""
+from pdb import set_trace
+
+import gzip
+import io
+import lzma
+import os
+import shutil
+import unittest
+import zlib
+
+from tmms.utils import compress_utils
+
+
+class CompressUtilsTest(unittest.TestCase):
+
+    data = os.urandom(100 << 10) + b'cpio ' * (200 << 10)
+
+
+    def test_parallel_gzip(self):
+        """ Many threads, small blocks, still one standard gzip member """
+        out = io.BytesIO()
+        with compress_utils.ParallelGzipWriter(out, threads=4,
+                filename='node01.cpio.gz', blocksize=64 << 10) as w:
+            for i in range(0, len(self.data), 10000):
+                w.write(self.data[i:i + 10000])
+        raw = out.getvalue()
+        self.assertEqual(gzip.decompress(raw), self.data)
+        self.assertIn(b'node01.cpio\0', raw[:32])
+
+        # A single member: zlib stops at its end with nothing left over
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(d.decompress(raw), self.data)
+        self.assertTrue(d.eof)
+        self.assertEqual(d.unused_data, b'')
+
+
+    def test_empty(self):
+        """ Nothing written is still a valid gzip file """
+        out = io.BytesIO()
+        compress_utils.ParallelGzipWriter(out).close()
+        self.assertEqual(gzip.decompress(out.getvalue()), b'')
+
+
+    def test_compressed_writer(self):
+        """ xz uses CRC32 for the kernel, unknown methods are refused """
+        out = io.BytesIO()
+        with compress_utils.compressed_writer(out, 'xz') as w:
+            w.write(self.data)
+        self.assertEqual(lzma.decompress(out.getvalue()), self.data)
+        self.assertRaises(RuntimeError,
+            compress_utils.compressed_writer, out, 'bzip2')
+
+
+    @unittest.skipIf(shutil.which('zstd') is None, 'zstd is not installed')
+    def test_zstd(self):
+        """ zstd goes through the external program """
+        tmp = '/tmp/UNITTEST_zstd'
+        try:
+            with open(tmp, 'wb') as f:
+                with compress_utils.compressed_writer(f, 'zstd', 2) as w:
+                    w.write(self.data)
+            with open(tmp, 'rb') as f:
+                self.assertEqual(f.read(4), b'\x28\xb5\x2f\xfd')
+        finally:
+            os.unlink(tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,8 @@
 """
 from pdb import set_trace
 
+import fcntl
+import glob
 import os
 import tempfile
 import unittest
@@ -51,6 +53,59 @@ class UtilsTest(unittest.TestCase):
         self.assertTrue(os.path.exists(uncompressed_dir + '/' + test_file_name))
 
 
+    def test_untar_cached(self):
+        """ Golden tarball is extracted once, each caller gets its own copy """
+        test_dir = '%s/to_compress/' % self.tmp_folder
+        tarball = '%s/golden.test.tar' % self.tmp_folder
+        cache_dir = '%s/cache' % self.tmp_folder
+        self.touch_folder(test_dir)
+        self.touch_file(test_dir + 'hostname')
+        TmmsUtils.make_tar(tarball, test_dir)
+
+        first = TmmsUtils.untar_cached(
+            '%s/first/' % self.tmp_folder, tarball, cache_dir)
+        second = TmmsUtils.untar_cached(
+            '%s/second/' % self.tmp_folder, tarball, cache_dir)
+
+        digest = TmmsUtils.hash_file(tarball)
+        self.assertTrue(os.path.isfile(tarball + '.sha256'))
+        self.assertTrue(os.path.isdir('%s/%s' % (cache_dir, digest)))
+        self.assertEqual(len(os.listdir(cache_dir)), 2)     # tree + lock
+
+        with open(first + '/hostname', 'w') as f:
+            f.write('node01')
+        self.assertEqual(os.path.getsize(second + '/hostname'), 0)
+        self.assertEqual(
+            os.path.getsize('%s/%s/hostname' % (cache_dir, digest)), 0)
+
+
+    def test_untar_cached_evict(self):
+        """ A new golden evicts old trees, but not from under a clone """
+        test_dir = '%s/to_compress/' % self.tmp_folder
+        tarball = '%s/golden.test.tar' % self.tmp_folder
+        cache_dir = '%s/cache' % self.tmp_folder
+        self.touch_folder(test_dir)
+        self.touch_file(test_dir + 'hostname')
+        TmmsUtils.make_tar(tarball, test_dir)
+        TmmsUtils.untar_cached('%s/old/' % self.tmp_folder, tarball, cache_dir)
+        old = '%s/%s' % (cache_dir, TmmsUtils.hash_file(tarball))
+
+        self.touch_file(test_dir + 'motd')
+        TmmsUtils.make_tar(tarball, test_dir)
+        with open(old + '.lock') as cloning:            # Still copying
+            fcntl.flock(cloning, fcntl.LOCK_SH)
+            TmmsUtils.untar_cached(
+                '%s/new/' % self.tmp_folder, tarball, cache_dir)
+            self.assertTrue(os.path.isdir(old))
+        self.touch_file(test_dir + 'issue')
+        TmmsUtils.make_tar(tarball, test_dir)
+        TmmsUtils.untar_cached('%s/newer/' % self.tmp_folder, tarball, cache_dir)
+        self.assertFalse(os.path.isdir(old))
+        self.assertTrue(os.path.isfile(old + '.lock'))
+        self.assertEqual(len(glob.glob(cache_dir + '/*[0-9a-f]')), 1)
+        self.assertTrue(os.path.isfile('%s/newer/issue' % self.tmp_folder))
+
+
     def test_deb_components_valid(self):
         '''
             Validate sources.list url can be parsed properly by checking
@@ -0,0 +1,93 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the newc cpio writer in cpio_utils.py.
+"""
+from pdb import set_trace
+
+import io
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+from tmms.utils import cpio_utils
+
+
+def parse_newc(data):
+    '''Return [(name, fields, body)] of a newc archive, trailer included.'''
+    entries = []
+    offset = 0
+    while True:
+        assert data[offset:offset + 6] == b'070701', 'bad magic'
+        fields = [int(data[offset + 6 + 8 * i:offset + 14 + 8 * i], 16)
+                  for i in range(13)]
+        namesize, size = fields[11], fields[6]
+        offset += 110
+        name = data[offset:offset + namesize - 1].decode()
+        offset += namesize + (-(110 + namesize) % 4)
+        body = data[offset:offset + size]
+        offset += size + (-size % 4)
+        entries.append((name, fields, body))
+        if name == 'TRAILER!!!':
+            return entries
+
+
+class CpioUtilsTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.tree = cls.tmp_folder + '/untar'
+        for d in ('etc', 'boot/grub', 'sbin'):
+            os.makedirs('%s/%s' % (cls.tree, d))
+        with open(cls.tree + '/etc/hostname', 'w') as f:
+            f.write('node01\n')
+        os.link(cls.tree + '/etc/hostname', cls.tree + '/etc/hostname.bak')
+        with open(cls.tree + '/boot/grub/grub.cfg', 'w') as f:
+            f.write('ignored')
+        os.symlink('sbin/init', cls.tree + '/init')
+        os.symlink('boot/vmlinuz-4.14', cls.tree + '/vmlinuz')
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_write_tree(self):
+        """ Relative names, symlinks, hardlinks, ignored dirs and trailer """
+        out = io.BytesIO()
+        n = cpio_utils.write_tree(out, self.tree,
+            ignore_files=['vmlinuz'], ignore_dirs=['boot'])
+        data = out.getvalue()
+        self.assertEqual(len(data) % 512, 0)
+
+        entries = parse_newc(data)
+        names = [e[0] for e in entries]
+        self.assertEqual(names, ['./etc', './etc/hostname',
+            './etc/hostname.bak', './init', './sbin', 'TRAILER!!!'])
+        self.assertEqual(n, len(entries) - 1)
+
+        byname = dict((e[0], e) for e in entries)
+        self.assertEqual(byname['./init'][2], b'sbin/init')
+        first, second = byname['./etc/hostname'], byname['./etc/hostname.bak']
+        self.assertEqual(first[1][0], second[1][0])     # same inode
+        self.assertEqual(first[2], b'node01\n')
+        self.assertEqual(second[1][6], 0)               # data only once
+        inodes = [e[1][0] for e in entries[:-1]]
+        self.assertEqual(len(set(inodes)), len(inodes) - 1)
+
+
+    def test_only_hardlinks_remembered(self):
+        """ Singly-linked files and directories take no inode memory """
+        writer = cpio_utils.CpioWriter(io.BytesIO())
+        for path, arcname, st in cpio_utils._walk(self.tree, '.', (), ()):
+            writer.add(path, arcname, st)
+        self.assertEqual(len(writer._inodes), 1)       # hostname's inode
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the dependency closure in dependency_graph.py.
+"""
+from pdb import set_trace
+
+import unittest
+
+from tmms.utils.dependency_graph import DependencyGraph, parse_relations
+
+
+def _pkg(name, version='1.0', size=1000, installed=10, **fields):
+    pkg = { 'Package': name, 'Version': version,
+            'Size': size, 'Installed-Size': installed }
+    pkg.update((k.replace('_', '-'), v) for k, v in fields.items())
+    return pkg
+
+
+class DependencyGraphTest(unittest.TestCase):
+
+    graph = DependencyGraph([
+        _pkg('libc6', '2.24-11'),
+        _pkg('vim', Depends='vim-common (= 1.0), libc6 (>= 2.15)'),
+        _pkg('vim-common', Pre_Depends='libc6:any'),
+        _pkg('mutt', Depends='default-mta | mail-transport-agent, libc6'),
+        _pkg('exim4', Provides='mail-transport-agent', Depends='libc6',
+             Conflicts='mail-transport-agent'),
+        _pkg('postfix', Provides='mail-transport-agent',
+             Conflicts='mail-transport-agent, exim4 (<< 0.5)'),
+        _pkg('newer', Depends='libc6 (>> 3.0) | libc6-dev'),
+        _pkg('broken', Depends='nosuch', Breaks='vim (<< 2)'),
+    ])
+
+
+    def test_parse_relations(self):
+        """ Alternatives, versions, architecture qualifiers and lists """
+        self.assertEqual(
+            parse_relations('a (>= 1:2.0) | b:any [amd64], c <!nocheck>'),
+            [[('a', '>=', '1:2.0'), ('b', None, None)], [('c', None, None)]])
+        self.assertEqual(parse_relations(None), [])
+
+
+    def test_closure(self):
+        """ Depends and Pre-Depends are followed, sizes add up """
+        report = self.graph.resolve(['vim'])
+        self.assertEqual(report['packages'], ['libc6', 'vim', 'vim-common'])
+        self.assertEqual(report['required_by'],
+                         { 'vim-common': 'vim', 'libc6': 'vim' })
+        self.assertEqual(report['missing'], [])
+        self.assertEqual(report['conflicts'], [])
+        self.assertEqual(report['download_size'], 3000)
+        self.assertEqual(report['installed_size'], 30 << 10)
+        self.assertEqual(self.graph.reverse_depends('libc6'),
+                         ['exim4', 'mutt', 'newer', 'vim', 'vim-common'])
+
+
+    def test_alternatives(self):
+        """ Virtual packages, chosen providers are reused """
+        report = self.graph.resolve(['mutt'])
+        self.assertEqual(report['packages'], ['exim4', 'libc6', 'mutt'])
+        report = self.graph.resolve(['postfix', 'mutt'])
+        self.assertEqual(report['packages'], ['libc6', 'mutt', 'postfix'])
+        self.assertEqual(report['conflicts'], [])
+
+
+    def test_missing_and_conflicts(self):
+        """ Unsatisfiable versions, unknown names, Conflicts and Breaks """
+        report = self.graph.resolve(['newer', 'broken', 'nosuch2'])
+        self.assertEqual(report['missing'], [
+            { 'dependency': 'nosuch2', 'required_by': None },
+            { 'dependency': 'libc6 (>> 3.0) | libc6-dev',
+              'required_by': 'newer' },
+            { 'dependency': 'nosuch', 'required_by': 'broken' }])
+
+        report = self.graph.resolve(['broken', 'vim', 'exim4', 'postfix'])
+        self.assertEqual(sorted((c['package'], c['with'])
+                                for c in report['conflicts']),
+                         [('broken', 'vim'), ('exim4', 'postfix'),
+                          ('postfix', 'exim4')])
+
+
+if __name__ == '__main__':
+    unittest.main()
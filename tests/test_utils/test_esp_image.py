@@ -0,0 +1,160 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the userspace GPT + FAT32 ESP builder in esp_image.py by reading
+the image back with struct, the way firmware would.
+"""
+from pdb import set_trace
+
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+from shutil import rmtree
+
+from tmms.utils import esp_image
+
+
+class EspImageTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.kernel = cls.tmp_folder + '/node01.vmlinuz.gz'
+        with open(cls.kernel, 'wb') as f:
+            f.write(os.urandom(300000))
+        cls.image = cls.tmp_folder + '/node01.ESP'
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def read_gpt(self, f, size):
+        f.seek(0)
+        mbr = f.read(512)
+        self.assertEqual(mbr[510:], b'\x55\xaa')
+        self.assertEqual(mbr[450], 0xEE)
+        for lba in (1, size // 512 - 1):
+            f.seek(lba * 512)
+            header = bytearray(f.read(92))
+            self.assertEqual(header[:8], b'EFI PART')
+            crc = struct.unpack_from('<I', header, 16)[0]
+            header[16:20] = b'\0\0\0\0'
+            self.assertEqual(zlib.crc32(header), crc)
+            entries_lba, count, entry_size, entries_crc = \
+                struct.unpack_from('<QIII', header, 72)
+            f.seek(entries_lba * 512)
+            entries = f.read(count * entry_size)
+            self.assertEqual(zlib.crc32(entries), entries_crc)
+        first, last = struct.unpack_from('<QQ', entries, 32)
+        name = entries[56:128].decode('utf-16-le').rstrip('\0')
+        return entries[:16], first, last, name
+
+
+    def read_fat(self, f, offset):
+        '''{ path: bytes } of every file, following the FAT chains'''
+        f.seek(offset)
+        boot = f.read(512)
+        self.assertEqual(boot[82:90], b'FAT32   ')
+        bps, spc, reserved, nfats = struct.unpack_from('<HBHB', boot, 11)
+        fatsz, _, _, root = struct.unpack_from('<IHHI', boot, 36)
+        f.seek(offset + reserved * bps)
+        fat = f.read(fatsz * bps)
+        self.assertEqual(fat, f.read(fatsz * bps))     # Both copies
+        cluster_bytes = bps * spc
+        data_start = offset + (reserved + nfats * fatsz) * bps
+
+        def read_chain(cluster):
+            data = b''
+            while cluster < 0x0FFFFFF8:
+                f.seek(data_start + (cluster - 2) * cluster_bytes)
+                data += f.read(cluster_bytes)
+                cluster = struct.unpack_from('<I', fat, cluster * 4)[0]
+            return data
+
+        files = {}
+
+        def walk(cluster, prefix):
+            data = read_chain(cluster)
+            long_name = ''
+            for i in range(0, len(data), 32):
+                entry = data[i:i + 32]
+                if entry[0] == 0:
+                    break
+                if entry[11] == 0x0F:
+                    part = entry[1:11] + entry[14:26] + entry[28:32]
+                    long_name = part.decode('utf-16-le').split('\0')[0] + \
+                        long_name
+                    continue
+                name = long_name
+                long_name = ''
+                if entry[11] & 0x08 or entry[:1] == b'.':
+                    continue
+                if not name:
+                    base, ext = entry[:8].decode().strip(), \
+                                entry[8:11].decode().strip()
+                    name = base + ('.' + ext if ext else '')
+                hi, lo, size = struct.unpack_from('<H4xHI', entry, 20)
+                if entry[11] & 0x10:
+                    walk(hi << 16 | lo, prefix + name + '/')
+                else:
+                    files[prefix + name] = read_chain(hi << 16 | lo)[:size]
+
+        walk(root, '/')
+        return files
+
+
+    def test_build(self):
+        """ GPT with one ESP, FAT32 with long names, sparse """
+        size = 384 << 20
+        names = [ 'long file name number %d.txt' % i for i in range(40) ]
+        files = [
+            ('/startup.nsh', b'\\EFI\\debian\\grubaa64.efi\n'),
+            ('/EFI/debian/node01.vmlinuz.gz', self.kernel),
+            ('/EFI/debian/grub.cfg', b'boot\n'),
+            ('/EFI/debian/EMPTY', b''),
+        ] + [ ('/many/' + n, n.encode()) for n in names ]
+        esp_image.build_ESP(self.image, files, size=size, offset=129 << 20,
+                            name='node01')
+        self.assertEqual(os.stat(self.image).st_size, size)
+        self.assertLess(os.stat(self.image).st_blocks * 512, 16 << 20)
+
+        with open(self.image, 'rb') as f:
+            type_guid, first, last, name = self.read_gpt(f, size)
+            self.assertEqual(type_guid, esp_image._ESP_TYPE.bytes_le)
+            self.assertEqual(first * 512, 129 << 20)
+            self.assertEqual(name, 'node01')
+            found = self.read_fat(f, first * 512)
+
+        with open(self.kernel, 'rb') as f:
+            self.assertEqual(found['/EFI/debian/node01.vmlinuz.gz'], f.read())
+        self.assertEqual(found['/startup.nsh'], b'\\EFI\\debian\\grubaa64.efi\n')
+        self.assertEqual(found['/EFI/debian/grub.cfg'], b'boot\n')
+        self.assertEqual(found['/EFI/debian/EMPTY'], b'')
+        for n in names:         # The directory grew past one cluster
+            self.assertEqual(found['/many/' + n], n.encode())
+
+
+    def test_short_name(self):
+        self.assertEqual(esp_image.short_name('STARTUP.NSH'),
+                         (b'STARTUP NSH', False))
+        self.assertEqual(esp_image.short_name('grub.cfg'),
+                         (b'GRUB~1  CFG', True))
+        self.assertEqual(esp_image.short_name('grub.cfg', {b'GRUB~1  CFG'}),
+                         (b'GRUB~2  CFG', True))
+        self.assertEqual(esp_image.short_name('node01.cpio.gz'),
+                         (b'NODE01~1GZ ', True))
+
+
+    def test_too_small(self):
+        self.assertRaises(ValueError, esp_image.build_ESP, self.image,
+                          [], size=8 << 20, offset=1 << 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -34,6 +34,25 @@ class CustomizeNodeHelpersTest(unittest.TestCase):
             rmtree(cls.tmp_folder)
 
 
+    def test_copy_sparse(self):
+        """
+            Copy a mostly-hole image: same content, holes stay unallocated.
+        """
+        source = self.tmp_folder + '/sparse.ESP'
+        target = self.tmp_folder + '/copy.ESP'
+        with open(source, 'wb') as f:
+            f.truncate(64 << 20)
+            f.seek(40 << 20)
+            f.write(b'FAT32' * 1000)
+        copied = FileUtils.copy_sparse(source, target)
+        self.assertLess(copied, 64 << 20)
+        with open(source, 'rb') as a, open(target, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertEqual(os.path.getsize(target), 64 << 20)
+        self.assertLess(os.stat(target).st_blocks * 512, 8 << 20)
+        self.assertFalse(os.path.exists(target + '.new'))
+
+
     def test_copy_target_into_file(self):
         """
             Create an empty file inside tmp folder and copy into the
@@ -0,0 +1,90 @@
+#!/usr/bin/python3 -tt
+"""
+    Test conditional and ranged artifact downloads in http_utils.py.
+"""
+from pdb import set_trace
+
+import os
+import tempfile
+import unittest
+from shutil import rmtree
+
+import flask
+
+from tmms.utils import http_utils
+
+
+class HttpUtilsTest(unittest.TestCase):
+
+    tmp_folder = None
+    data = bytes(range(256)) * 4096     # 1M
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.path = cls.tmp_folder + '/node01.ESP'
+        with open(cls.path, 'wb') as f:
+            f.write(cls.data)
+        app = flask.Flask(__name__)
+        app.add_url_rule('/ESP', 'ESP', methods=('GET', 'HEAD'),
+            view_func=lambda: http_utils.send_artifact(
+                cls.path, 'application/x-raw-disk-image', 'node01.ESP'))
+        cls.client = app.test_client()
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def test_parse_range(self):
+        self.assertEqual(http_utils.parse_range('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(http_utils.parse_range('bytes=900-', 1000), (900, 999))
+        self.assertEqual(http_utils.parse_range('bytes=-100', 1000), (900, 999))
+        self.assertEqual(http_utils.parse_range('bytes=10-5000', 1000), (10, 999))
+        self.assertIsNone(http_utils.parse_range(None, 1000))
+        self.assertIsNone(http_utils.parse_range('bytes=1-2,5-6', 1000))
+        self.assertIsNone(http_utils.parse_range('bytes=5-3', 1000))
+        self.assertRaises(ValueError, http_utils.parse_range, 'bytes=1000-', 1000)
+
+
+    def test_download(self):
+        """ Whole file, 304, resume with If-Range, 416 """
+        resp = self.client.get('/ESP')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, self.data)
+        etag = resp.headers['ETag']
+        self.assertIn('node01.ESP', resp.headers['Content-Disposition'])
+
+        resp = self.client.get('/ESP', headers={ 'If-None-Match': etag })
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+        resp = self.client.get('/ESP', headers={
+            'Range': 'bytes=1000-', 'If-Range': etag })
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, self.data[1000:])
+        self.assertEqual(resp.headers['Content-Range'],
+                         'bytes 1000-%d/%d' % (len(self.data) - 1, len(self.data)))
+
+        resp = self.client.get('/ESP', headers={
+            'Range': 'bytes=1000-', 'If-Range': '"stale"' })
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.data), len(self.data))
+
+        resp = self.client.get('/ESP', headers={           # Strong only
+            'Range': 'bytes=1000-', 'If-Range': 'W/' + etag })
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.data), len(self.data))
+        self.assertFalse(os.path.exists(self.path + '.sha256'))
+
+        resp = self.client.get('/ESP', headers={ 'Range': 'bytes=99999999-' })
+        self.assertEqual(resp.status_code, 416)
+
+        resp = self.client.head('/ESP')
+        self.assertEqual(resp.headers['Content-Length'], str(len(self.data)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the incremental manifest index, ManifestStore in manifest_cfg.py.
+"""
+from pdb import set_trace
+
+import json
+import logging
+import os
+import tempfile
+import time
+import unittest
+from argparse import Namespace
+from shutil import rmtree
+from unittest import mock
+
+from tmms.utils import manifest_cfg
+
+
+class ManifestStoreTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.BP = Namespace(UPLOADS=cls.tmp_folder, logger=logging)
+        for namespace in ('base', 'fry/bender', 'fry/leela', 'fryer/zoidberg'):
+            cls.write(namespace)
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    @classmethod
+    def write(cls, namespace, **extra):
+        manifest = { 'name': os.path.basename(namespace),
+                     'description': 'test', 'release': 'stretch',
+                     'tasks': [], 'packages': [ 'vim' ] }
+        manifest.update(extra)
+        path = '%s/%s' % (cls.tmp_folder, namespace)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(json.dumps(manifest))
+
+
+    def test_index(self):
+        """ Sorted prefix queries """
+        store = manifest_cfg.ManifestStore(self.BP, poll=0)
+        self.assertEqual(len(store), 4)
+        self.assertEqual(store.names(), [ 'base', 'fry/bender', 'fry/leela',
+                                          'fryer/zoidberg' ])
+        self.assertEqual(store.names('fry/'), [ 'fry/bender', 'fry/leela' ])
+        self.assertEqual(store.names('fry'), [ 'fry/bender', 'fry/leela',
+                                               'fryer/zoidberg' ])
+        self.assertEqual(store.names('nobody/'), [])
+        self.assertEqual(store.get('/fry/leela').namespace, 'fry/leela')
+        self.assertIsNone(store.get('fry'))
+
+
+    def test_page(self):
+        """ Cursor pagination and counts """
+        store = manifest_cfg.ManifestStore(self.BP, poll=0)
+        self.assertEqual(store.page(limit=2), ([ 'base', 'fry/bender' ],
+                                               'fry/bender'))
+        self.assertEqual(store.page(after='fry/bender', limit=2),
+                         ([ 'fry/leela', 'fryer/zoidberg' ], None))
+        self.assertEqual(store.page('fry/', after='base'),
+                         ([ 'fry/bender', 'fry/leela' ], None))
+        self.assertEqual(store.page('fry/', after='fry/leela'), ([], None))
+        self.assertEqual(store.page('fry/', limit=1),
+                         ([ 'fry/bender' ], 'fry/bender'))
+        self.assertEqual(store.count(), 4)
+        self.assertEqual(store.count('fry/'), 2)
+        self.assertEqual(store.children(), { 'fry/': 2, 'fryer/': 1 })
+        self.assertEqual(store.children('fr'), { 'fry/': 2, 'fryer/': 1 })
+        self.assertEqual(store.children('fry/'), {})
+
+
+    def test_digest(self):
+        """ Content address of the canonical form, not of the file """
+        store = manifest_cfg.ManifestStore(self.BP, poll=0)
+        bender = store.get('fry/bender')
+        self.assertEqual(json.loads(bender.body.decode()), bender.thedict)
+        self.assertEqual(bender.etag, '"%s"' % bender.digest)
+        with open(self.tmp_folder + '/fry/bender') as f:
+            reordered = json.dumps(json.loads(f.read()), indent=1)
+        with open(self.tmp_folder + '/fry/bender', 'w') as f:
+            f.write(reordered)
+        self.assertEqual(store.update('fry/bender').digest, bender.digest)
+        self.write('fry/bender', comment='changed')
+        self.assertNotEqual(store.update('fry/bender').digest, bender.digest)
+
+
+    def test_incremental(self):
+        """ Only touched files are parsed again """
+        store = manifest_cfg.ManifestStore(self.BP, poll=0)
+        with mock.patch.object(manifest_cfg, 'ManifestDestiny',
+                               wraps=manifest_cfg.ManifestDestiny) as parse:
+            store.rescan()
+            self.assertEqual(parse.call_count, 0)
+
+            self.write('fry/leela', comment='edited')
+            self.write('amy/wong')
+            with open(self.tmp_folder + '/fry/broken', 'w') as f:
+                f.write('{ not json')
+            os.unlink(self.tmp_folder + '/base')
+            store.rescan()
+            self.assertEqual(parse.call_count, 3)
+            store.rescan()                          # Broken isn't retried
+            self.assertEqual(parse.call_count, 3)
+
+        self.assertEqual(store.get('fry/leela').get('comment'), 'edited')
+        self.assertEqual(store.names(), [ 'amy/wong', 'fry/bender',
+                                          'fry/leela', 'fryer/zoidberg' ])
+
+        os.unlink(self.tmp_folder + '/amy/wong')    # Like delete_manifest()
+        store.remove('amy/wong')
+        self.assertIsNone(store.get('amy/wong'))
+        self.write('hermes')                        # Like api_upload()
+        self.assertEqual(store.update('hermes').namespace, 'hermes')
+        self.assertEqual(store.names('h'), [ 'hermes' ])
+
+
+    def test_write_many(self):
+        """ All or nothing, one index update """
+        store = manifest_cfg.ManifestStore(self.BP, poll=0)
+        good = lambda name, **extra: json.dumps(dict(
+            name=name, description='bulk', release='stretch', tasks=[],
+            packages=[], **extra))
+        result = store.write_many([ ('amy/wong', good('wong')),
+                                    ('fry/leela', '{ not json'),
+                                    ('fry', good('fry')),
+                                    ('kif/kroker', good('kif')) ])
+        self.assertEqual([ e['namespace'] for e in result['errors'] ],
+                         [ 'fry/leela', 'fry', 'kif/kroker' ])
+        self.assertNotIn('created', result)
+        self.assertFalse(os.path.exists(self.tmp_folder + '/amy'))
+        self.assertEqual(len(store), 4)
+
+        result = store.write_many([ ('amy/wong', good('wong')),
+                                    ('/fry/leela', good('leela', x=1)) ])
+        self.assertEqual(result, { 'created': [ 'amy/wong' ],
+                                   'overwritten': [ 'fry/leela' ] })
+        self.assertEqual(store.get('fry/leela').get('x'), 1)
+        self.assertEqual(store.names('a'), [ 'amy/wong' ])
+        self.assertEqual(sorted(os.listdir(self.tmp_folder)),
+                         [ 'amy', 'base', 'fry', 'fryer' ])   # No staging
+
+        exported = dict(store.export('fry/'))
+        self.assertEqual(sorted(exported), [ 'fry/bender', 'fry/leela' ])
+        self.assertEqual(exported['fry/leela'].thedict['x'], 1)
+
+
+    def test_write_many_rollback(self):
+        """ A failed rename puts back the ones before it """
+        store = manifest_cfg.ManifestStore(self.BP, poll=0)
+        good = lambda name: json.dumps(dict(
+            name=name, description='bulk', release='stretch', tasks=[],
+            packages=[], x=1))
+        replace = os.replace
+
+        def failing(src, dst):
+            if dst.endswith('/fry/bender'):
+                raise OSError(28, 'No space left on device')
+            replace(src, dst)
+
+        with mock.patch('os.replace', side_effect=failing):
+            with self.assertRaises(OSError):
+                store.write_many([ ('amy/wong', good('wong')),
+                                   ('fry/leela', good('leela')),
+                                   ('fry/bender', good('bender')) ])
+        self.assertFalse(os.path.exists(self.tmp_folder + '/amy/wong'))
+        self.assertIsNone(store.get('amy/wong'))
+        self.assertIsNone(store.get('fry/leela').get('x'))
+        self.assertEqual(sorted(os.listdir(self.tmp_folder)),
+                         [ 'amy', 'base', 'fry', 'fryer' ])   # No staging
+
+
+    def test_poll(self):
+        """ Outside edits show up by themselves """
+        store = manifest_cfg.ManifestStore(self.BP, poll=0.05)
+        self.write('kif/kroker')
+        for i in range(100):
+            if store.get('kif/kroker') is not None:
+                break
+            time.sleep(0.05)
+        self.assertEqual(store.names('kif/'), [ 'kif/kroker' ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the SQLite package index in package_index.py against a local
+HTTP "mirror".
+"""
+from pdb import set_trace
+
+import functools
+import gzip
+import hashlib
+import http.server
+import os
+import tempfile
+import threading
+import time
+import unittest
+from shutil import rmtree
+
+from tmms.utils.package_index import PackageIndex
+
+_PACKAGE = '''Package: {0}
+Version: {1}
+Architecture: arm64
+Installed-Size: 100
+Size: 42
+Depends: libc6 (>= 2.24)
+Description: test package {0}
+ Long description.
+Bugs: not indexed
+
+'''
+
+
+class _Quiet(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class PackageIndexTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        cls.mirror = cls.tmp_folder + '/mirror'
+        handler = functools.partial(_Quiet, directory=cls.mirror)
+        cls.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=cls.httpd.serve_forever, daemon=True).start()
+        cls.url = 'http://127.0.0.1:%d' % cls.httpd.server_address[1]
+        cls.index = PackageIndex(cls.tmp_folder + '/packages.sqlite')
+
+
+    @classmethod
+    def tearDown(cls):
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def publish(self, repo, packages, mtime):
+        '''Write dists/stretch/{Release,main/binary-arm64/Packages.gz}'''
+        dists = '%s/%s/dists/stretch' % (self.mirror, repo)
+        relpath = 'main/binary-arm64/Packages.gz'
+        os.makedirs('%s/main/binary-arm64' % dists, exist_ok=True)
+        data = gzip.compress(''.join(
+            _PACKAGE.format(*p) for p in packages).encode())
+        with open('%s/%s' % (dists, relpath), 'wb') as f:
+            f.write(data)
+        with open(dists + '/Release', 'w') as f:
+            f.write('Suite: stretch\nSHA256:\n %s %d %s\n' % (
+                hashlib.sha256(data).hexdigest(), len(data), relpath))
+        os.utime(dists + '/Release', (mtime, mtime))
+
+
+    def test_refresh(self):
+        """ Conditional refresh, selected fields, later mirror wins """
+        now = time.time()
+        self.publish('a', [('vim', '1'), ('album', '2')], now - 100)
+        self.publish('b', [('vim', '3')], now - 100)
+        sources = ['deb %s/a stretch main' % self.url,
+                   'deb [trusted=yes] %s/b/ stretch main' % self.url]
+
+        stats = self.index.refresh(sources, 'arm64')
+        self.assertEqual(stats['files_loaded'], 2)
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.keys(), ['album', 'vim'])
+        self.assertIn('album', self.index)
+        self.assertNotIn('emacs', self.index)
+        vim = self.index['vim']
+        self.assertEqual(vim['Version'], '3')
+        self.assertEqual(vim['Size'], 42)
+        self.assertNotIn('Bugs', vim)
+        self.assertEqual([p['Version'] for p in self.index.values()],
+                         ['2', '3'])
+
+        stats = self.index.refresh(sources, 'arm64')
+        self.assertEqual(stats['releases_changed'], 0)
+        self.assertEqual(stats['files_loaded'], 0)
+
+        self.publish('a', [('vim', '1'), ('emacs', '4')], now)
+        stats = self.index.refresh(sources, 'arm64')
+        self.assertEqual(stats['releases_changed'], 1)
+        self.assertEqual(stats['files_loaded'], 1)
+        self.assertEqual(self.index.keys(), ['emacs', 'vim'])
+
+        stats = self.index.refresh(sources[1:], 'arm64')
+        self.assertEqual(self.index.keys(), ['vim'])
+        self.assertIsNotNone(self.index.meta('built'))
+
+
+    def test_failed_file_is_retried(self):
+        """ A Packages.gz that fails to load keeps old rows until it works """
+        now = time.time()
+        self.publish('a', [('vim', '1')], now - 100)
+        sources = ['deb %s/a stretch main' % self.url]
+        self.index.refresh(sources, 'arm64')
+
+        self.publish('a', [('vim', '2')], now)
+        packages = '%s/a/dists/stretch/main/binary-arm64/Packages.gz' % (
+            self.mirror)
+        os.rename(packages, packages + '.hidden')
+        stats = self.index.refresh(sources, 'arm64')
+        self.assertEqual(stats['files_loaded'], 0)
+        self.assertEqual(len(stats['errors']), 1)
+        self.assertEqual(self.index['vim']['Version'], '1')
+        self.assertFalse(self.index.refreshing)
+
+        os.rename(packages + '.hidden', packages)
+        stats = self.index.refresh(sources, 'arm64')
+        self.assertEqual(stats['files_loaded'], 1)
+        self.assertEqual(self.index['vim']['Version'], '2')
+
+        stats = self.index.refresh(sources, 'arm64', force=True)
+        self.assertEqual(stats['files_loaded'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
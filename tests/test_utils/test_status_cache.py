@@ -0,0 +1,139 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the node status cache in status_cache.py.
+"""
+from pdb import set_trace
+
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from shutil import rmtree
+from unittest import mock
+
+from tmms.utils import status_cache
+
+
+class StatusCacheTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        os.makedirs(cls.tmp_folder + '/node01')
+        cls.write('node01', 'ready')
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    @classmethod
+    def write(cls, hostname, status):
+        '''Like customize_node.update_status(): write, then rename'''
+        path = '%s/%s/status.json' % (cls.tmp_folder, hostname)
+        with open(path + '.new', 'w') as f:
+            f.write(json.dumps({ 'status': status }))
+        os.replace(path + '.new', path)
+
+
+    def wait_for(self, cache, hostname, expected):
+        for i in range(100):
+            status = cache.get(hostname)
+            if (status and status['status']) == expected:
+                return
+            time.sleep(0.05)
+        self.assertEqual(cache.get(hostname), expected)
+
+
+    def exercise(self, cache):
+        self.assertEqual(cache.get('node01'), { 'status': 'ready' })
+        self.assertIsNone(cache.get('node02'))
+
+        self.write('node01', 'building')
+        self.wait_for(cache, 'node01', 'building')
+
+        os.makedirs(self.tmp_folder + '/node02')    # A new node is bound
+        self.write('node02', 'building')
+        self.wait_for(cache, 'node02', 'building')
+
+        os.unlink(self.tmp_folder + '/node01/status.json')   # Unbound
+        self.wait_for(cache, 'node01', None)
+
+        with open(self.tmp_folder + '/node02/status.json', 'w') as f:
+            f.write('{ not json')
+        self.wait_for(cache, 'node02', 'error')
+
+
+    def test_inotify(self):
+        """ Changes from other processes show up without polling """
+        cache = status_cache.StatusCache(self.tmp_folder, poll=3600)
+        self.assertTrue(cache.watching)
+        self.exercise(cache)
+
+
+    def test_polling(self):
+        """ Without inotify the files are scanned periodically """
+        with mock.patch.object(status_cache, '_Inotify',
+                               side_effect=OSError(38, 'ENOSYS')):
+            cache = status_cache.StatusCache(self.tmp_folder, poll=0.05)
+        self.assertFalse(cache.watching)
+        self.exercise(cache)
+
+
+    def test_wait(self):
+        """ Long poll: wait() returns when the version moves on """
+        cache = status_cache.StatusCache(self.tmp_folder, poll=3600)
+        version, status = cache.lookup('node01')
+        self.assertEqual(status['status'], 'ready')
+        self.assertFalse(cache.wait('node01', version, 0.1))
+
+        threading.Timer(0.1, self.write, ('node01', 'building')).start()
+        start = time.time()
+        self.assertTrue(cache.wait('node01', version, 10))
+        self.assertLess(time.time() - start, 5)
+        self.assertGreater(cache.lookup('node01')[0], version)
+        self.assertTrue(cache.wait('node01', version, 0))   # Already past
+
+
+    def test_wait_any(self):
+        """ One long poll for several nodes """
+        os.makedirs(self.tmp_folder + '/node02')
+        cache = status_cache.StatusCache(self.tmp_folder, poll=3600)
+        since = { 'node01': cache.lookup('node01')[0],
+                  'node02': cache.lookup('node02')[0] }
+        self.assertFalse(cache.wait_any(since, 0.1))
+
+        threading.Timer(0.1, self.write, ('node02', 'building')).start()
+        start = time.time()
+        self.assertTrue(cache.wait_any(since, 10))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(cache.lookup('node01')[0], since['node01'])
+
+
+    def test_reload_race(self):
+        """ A file rewritten while reload() reads it is read again """
+        with mock.patch.object(status_cache, '_Inotify',
+                               side_effect=OSError(38, 'ENOSYS')):
+            cache = status_cache.StatusCache(self.tmp_folder, poll=3600)
+        self.write('node01', 'building')
+        loads = json.loads
+
+        def rewritten(text):
+            if 'building' in text:      # Another writer got in meanwhile
+                self.write('node01', 'error')
+            return loads(text)
+
+        with mock.patch.object(status_cache.json, 'loads',
+                               side_effect=rewritten):
+            cache.reload('node01')
+        self.assertEqual(cache.get('node01'), { 'status': 'error' })
+
+
+if __name__ == '__main__':
+    unittest.main()
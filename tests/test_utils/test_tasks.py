@@ -0,0 +1,97 @@
+#!/usr/bin/python3 -tt
+"""
+    Test the parsed tasks description of the tasks blueprint: reloaded
+when L4TM.desc changes, and the package <-> task indices.
+"""
+from pdb import set_trace
+
+import importlib.util
+import os
+import shutil
+import tempfile
+import unittest
+from shutil import rmtree
+
+import flask
+
+import tmms
+
+
+class TasksTest(unittest.TestCase):
+
+    tmp_folder = None
+
+    @classmethod
+    def setUp(cls):
+        cls.tmp_folder = tempfile.mkdtemp()
+        os.makedirs(cls.tmp_folder + '/configs')
+        cls.desc = cls.tmp_folder + '/configs/L4TM.desc'
+        shutil.copy(tmms.__path__[0] + '/configs/L4TM.desc', cls.desc)
+        # A fresh module each time: the parse is cached in its globals.
+        spec = importlib.util.spec_from_file_location(
+            'tasks_blueprint',
+            tmms.__path__[0] + '/blueprints/20-tasks/blueprint.py')
+        cls.tasks = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(cls.tasks)
+        app = flask.Flask(__name__, root_path=cls.tmp_folder)
+        cls.tasks.BP.mainapp = app
+        cls.tasks.register('')
+        cls.client = app.test_client()
+
+
+    @classmethod
+    def tearDown(cls):
+        if os.path.isdir(cls.tmp_folder):
+            rmtree(cls.tmp_folder)
+
+
+    def edit(self, text):
+        '''Append a paragraph with a new mtime, whatever the clock says.'''
+        mtime = os.stat(self.desc).st_mtime_ns
+        with open(self.desc, 'a') as f:
+            f.write(text)
+        os.utime(self.desc, ns=(mtime + 10**9, mtime + 10**9))
+
+
+    def test_indices(self):
+        """ Packages of a task and the reverse """
+        BP = self.tasks.BP
+        packages = BP.get_packages('L4TM_C_CPP')
+        self.assertIsInstance(packages, tuple)
+        self.assertIn('gcc', packages)
+        self.assertNotIn('', packages)
+        self.assertIsNone(BP.get_packages('L4TM_Nope'))
+        self.assertEqual(BP.lookup('L4TM_LSGI')['Section'], 'xfce')
+        self.assertEqual(BP.filter([ 'L4TM_LSGI', 'L4TM_Nope' ]),
+                         [ 'L4TM_Nope' ])
+
+        resp = self.client.get('/api/tasks/packages/task-xfce-desktop')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json(), {
+            'package': 'task-xfce-desktop',
+            'tasks': [ 'L4TM_Spark', 'L4TM_XFCE' ] })
+        resp = self.client.get('/api/tasks/packages/nosuchpackage')
+        self.assertEqual(resp.get_json()['tasks'], [])
+        everything = self.client.get('/api/tasks/packages/').get_json()
+        self.assertEqual(everything['packages']['easyspice'], [ 'L4TM_LSGI' ])
+
+
+    def test_reload(self):
+        """ An edit shows up on the next lookup, no edit no parse """
+        BP = self.tasks.BP
+        parsed = self.tasks._data
+        self.assertIsNone(BP.lookup('L4TM_Kif'))
+        self.assertIs(self.tasks._data, parsed)
+
+        self.edit('\nTask: L4TM_Kif\nSection: xfce\n'
+                  'Description: Kif\n  just do it\nKey:\n  easyspice\n  kroker\n')
+        self.assertEqual(BP.get_packages('L4TM_Kif'), ('easyspice', 'kroker'))
+        self.assertIsNot(self.tasks._data, parsed)
+        resp = self.client.get('/api/tasks/packages/easyspice')
+        self.assertEqual(resp.get_json()['tasks'], [ 'L4TM_LSGI', 'L4TM_Kif' ])
+        tasks = [ t['task'] for t in self.client.get('/api/tasks/').get_json()['task'] ]
+        self.assertEqual(tasks[-1], 'L4TM_Kif')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -121,6 +121,7 @@ class TmCmd():
         in jsong format (if abailable).
         :param 'url': [str] url request.
         :param 'options[payload]': [dict]
+        :param 'options[params]': [dict or list of pairs] GET query string.
         :return: [json]
         """
         headers = options.get('headers', self.header)
@@ -128,7 +129,8 @@ class TmCmd():
             http_resp = HTTP_REQUESTS.put(
                 url, options['payload'], headers=headers)
         else:
-            http_resp = HTTP_REQUESTS.get(url, headers=headers)
+            http_resp = HTTP_REQUESTS.get(
+                url, headers=headers, params=options.get('params', None))
         return http_resp
 
     @_NST
@@ -138,13 +140,41 @@ class TmCmd():
         to a file.  Save the file to the requested destination.
         :param 'url': [str] url link to a file to download.
         :param 'destination': [str] destination to save downloaded file to.
+                              An interrupted download is left in
+                              destination.part and resumed next time.
         :return: None
         """
-        headers = options.get('headers', self.header)
+        headers = dict(options.get('headers', self.header))
+        partial = destination + '.part'     # Resumed by the next attempt
+        validator = partial + '.etag'
+        try:
+            done = os.path.getsize(partial)
+            with open(validator) as f:
+                etag = f.read().strip()
+            headers['Range'] = 'bytes=%d-' % done
+            headers['If-Range'] = etag      # Whole file if it changed
+        except OSError:
+            done = 0
+
         downloaded = HTTP_REQUESTS.get(url, stream=True, headers=headers)
-        with open(destination, "wb") as dest_file:
-            # need to feedback a download bar to the screen here.
-            dest_file.write(downloaded.content)
+        if downloaded.status_code == 416:   # Nothing left, or it shrank
+            total = downloaded.headers.get('Content-Range', '').split('/')[-1]
+            if not done or total != str(done):
+                os.unlink(partial)
+                return self.http_download(url, destination, **options)
+        else:
+            downloaded.raise_for_status()
+            mode = 'ab' if downloaded.status_code == 206 else 'wb'
+            etag = downloaded.headers.get('ETag', None)
+            if etag:
+                with open(validator, 'w') as f:
+                    f.write(etag)
+            with open(partial, mode) as dest_file:
+                for chunk in downloaded.iter_content(1 << 20):
+                    dest_file.write(chunk)
+        os.replace(partial, destination)
+        if os.path.exists(validator):
+            os.unlink(validator)
 
     @_NST
     def http_upload(self, url, **kwargs):
@@ -163,6 +193,21 @@ class TmCmd():
             url, headers=headers, data=json.dumps(payload) )
         return upload
 
+    @_NST
+    def http_upload_file(self, url, file_path, content_type, **kwargs):
+        """
+            POST the contents of a local file, streamed rather than read
+        into memory.
+
+        :param 'url': [str] url link to a destination to upload a file.
+        :param 'file_path': [str] path to a file to upload on the local system.
+        :param 'content_type': [str] MIME type of the file.
+        """
+        headers = dict(kwargs.get('headers', self.header))
+        headers['Content-Type'] = content_type
+        with open(file_path, 'rb') as file_obj:
+            return HTTP_REQUESTS.post(url, headers=headers, data=file_obj)
+
     @_NST
     def http_delete(self, url, **kwargs):
         """
@@ -25,7 +25,9 @@ class TmManifest(tm_base.TmCmd):
             'list':     self.listall,
             'get':      self.show,
             'put':      self.upload,
-            'delete':   self.delete
+            'delete':   self.delete,
+            'import':   self.bulk_upload,
+            'export':   self.bulk_download
         }
 
     def listall(self, arg_list=None, **options):
@@ -102,3 +104,43 @@ class TmManifest(tm_base.TmCmd):
         api_url = "%s%s%s" % (self.url, 'manifest/', self.show_name.strip('/'))
         data = self.http_delete(api_url)
         return self.to_json(data)
+
+    def _bulk_target(self, target):
+        """[prefix] file: the URL for the prefix and the file format."""
+        if len(target) == 1:
+            target.insert(0, '')    # null prefix
+        assert len(target) == 2, 'Missing argument: [prefix] filename'
+        prefix = target[0].strip('/')
+        api_url = '%s%s%s' % (self.url, 'manifests/', prefix)
+        if prefix:
+            api_url += '/'
+        fmt = 'tar' if '.tar' in os.path.basename(target[1]) or \
+            target[1].endswith('.tgz') else 'ndjson'
+        return api_url, fmt
+
+    def bulk_upload(self, target, **options):
+        """
+        import [prefix] <file.tar|file.ndjson>
+
+        Upload many manifests in one request: a tar (may be compressed) of
+        manifest files at their namespace paths, or NDJSON with one manifest
+        per line, as written by "export".  Nothing is written unless every
+        manifest is valid.
+        """
+        api_url, fmt = self._bulk_target(target)
+        content_type = 'application/x-tar' if fmt == 'tar' else \
+            'application/x-ndjson'
+        data = self.http_upload_file(
+            api_url, os.path.realpath(target[1]), content_type)
+        return self.to_json(data)
+
+    def bulk_download(self, target, **options):
+        """
+        export [prefix] <file.tar|file.ndjson>
+
+        Save every manifest under prefix into one file, a tar or NDJSON
+        according to the file name, for backups and migrations ("import").
+        """
+        api_url, fmt = self._bulk_target(target)
+        self.http_download(api_url + '?format=' + fmt, target[1])
+        return self.to_json({ 'exported': target[1] })
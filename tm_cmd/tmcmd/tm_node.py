@@ -142,26 +142,51 @@ class TmNode(tm_base.TmCmd):
             'Missing argument: waitnode <node coordinate>'
         node_coords = self._resolve_nodes(target)
         responses = {}      # only add them when non-building state is reached
-        coordset = frozenset(node_coords)
-        remaining = coordset - frozenset(responses.keys())
-        sleepy = 0
-        while remaining:
-            time.sleep(sleepy)
-            for node_coord in remaining:
-                time.sleep(0.1)
-                resp = json.loads(self.show((node_coord,)))
-                try:
-                    status = resp['200']['status']  # some phase of binding
+        pending = dict((node_coord, None) for node_coord in node_coords)
+        url = '%s%s' % (self.url, 'nodes/status')
+        while pending:      # One long poll watches all of them
+            query = [ ('node', node_coord) for node_coord in pending ]
+            if None not in pending.values():
+                query += [ ('since', v) for v in pending.values() ]
+                query.append(('wait', 30))
+            data = self.http_request(url, params=query)
+            if data.status_code == 404:
+                break       # Older server or unknown node: one at a time
+            if data.status_code != 200:
+                for node_coord in pending:
+                    responses[node_coord] = 'error'
+                return json.dumps({'200': responses})
+            for node in json.loads(data.text)['nodes']:
+                node_coord = node['node']
+                status = node['status'] and node['status']['status']
+                if status != 'building':
+                    responses[node_coord] = status or 'unbound'
+                    pending.pop(node_coord, None)
+                elif node_coord in pending:
+                    pending[node_coord] = node['version']
+            time.sleep(int(data.headers.get('Retry-After', 0)))
+        for node_coord in pending:
+            api_url = '%s%s%s' % (self.url, 'node/', node_coord)
+            url = api_url
+            while node_coord not in responses:
+                data = self.http_request(url)
+                if data.status_code == 200:
+                    status = json.loads(data.text)['status']
                     if status != 'building':
                         responses[node_coord] = status
-                except KeyError:
-                    if '204' in resp:
-                        status = 'unbound'
-                    elif '404' in resp:
-                        status = 'unknown'
-                    else:
-                        status = 'error'
-                    responses[node_coord] = status
-            remaining = coordset - frozenset(responses.keys())
-            sleepy = 5
+                elif data.status_code == 204:
+                    responses[node_coord] = 'unbound'
+                elif data.status_code == 404:
+                    responses[node_coord] = 'unknown'
+                else:
+                    responses[node_coord] = 'error'
+                if node_coord in responses:
+                    break
+                # Long poll: the server answers when the status changes
+                version = data.headers.get('X-Status-Version', None)
+                if version is None:     # Older server, poll
+                    time.sleep(5)
+                else:
+                    url = '%s?wait=%d&since=%s' % (api_url, 30, version)
+                    time.sleep(int(data.headers.get('Retry-After', 0)))
         return json.dumps({'200': responses})   # Just like other commands
@@ -0,0 +1,119 @@
+#!/usr/bin/python3 -tt
+'''
+    Server-wide cache of downloaded .deb files and apt lists, shared by all
+node image builds.  Before the chroot install runs, seed() hardlinks the
+cache into the node's own /var/cache/apt/archives and /var/lib/apt/lists.
+Afterwards harvest() hardlinks anything new back into the cache and removes
+the .debs from the node image (the job "apt-get clean" used to do).
+
+Hardlinks instead of bind mounts: apt takes a lock in both directories,
+so concurrent builds sharing one mounted directory would fail each other.
+apt never rewrites these files in place (it downloads into partial/ and
+renames), so sharing inodes is safe.  Only standard python3 libraries.
+'''
+
+import errno
+import glob
+import logging
+import os
+import shutil
+import time
+
+from pdb import set_trace
+
+# cache subdirectory, location in the node FS, files of interest
+_LAYOUT = (
+    ('archives', 'var/cache/apt/archives', '*.deb'),
+    ('lists',    'var/lib/apt/lists',      '*_*'),  # skips lock and partial
+)
+
+
+def _link(source, target):
+    '''Hardlink, or copy if on another filesystem.  Replaces target.'''
+    tmp = '%s.%d.tmp' % (target, os.getpid())
+    try:
+        os.link(source, tmp)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(source, tmp)
+    os.replace(tmp, target)
+
+
+def _sync(fromdir, todir, pattern, touch=False):
+    '''Link files missing (or older) in todir.  Return count of new links.'''
+    os.makedirs(todir, exist_ok=True)
+    linked = 0
+    for source in glob.glob('%s/%s' % (fromdir, pattern)):
+        target = '%s/%s' % (todir, os.path.basename(source))
+        try:
+            s = os.stat(source)
+            try:
+                if os.stat(target).st_mtime >= s.st_mtime:
+                    continue
+            except FileNotFoundError:
+                pass
+            _link(source, target)
+            linked += 1
+            if touch:   # LRU stamp; mtime matters to apt, atime doesn't
+                os.utime(source, (time.time(), s.st_mtime))
+        except OSError as e:    # Eviction by another build, etc
+            logging.warning('apt cache: %s -> %s: %s' % (
+                source, target, str(e)))
+    return linked
+
+
+def seed(cache_dir, fs_dir):
+    '''
+        Populate the node FS from the cache.
+    :param 'cache_dir': [str] server cache directory.
+    :param 'fs_dir': [str] root of the node file system being built.
+    :return: [int] number of files provided.
+    '''
+    linked = 0
+    for sub, fsdir, pattern in _LAYOUT:
+        linked += _sync('%s/%s' % (cache_dir, sub),
+                        '%s/%s' % (fs_dir, fsdir), pattern, touch=True)
+    return linked
+
+
+def harvest(cache_dir, fs_dir, max_bytes):
+    '''
+        Return new downloads to the cache, strip .debs from the node FS,
+    then trim the cache to max_bytes.
+    :return: [int] number of files added to the cache.
+    '''
+    linked = 0
+    for sub, fsdir, pattern in _LAYOUT:
+        linked += _sync('%s/%s' % (fs_dir, fsdir),
+                        '%s/%s' % (cache_dir, sub), pattern)
+    for deb in glob.glob('%s/%s/*.deb' % (fs_dir, _LAYOUT[0][1])):
+        os.unlink(deb)
+    evict(cache_dir, max_bytes)
+    return linked
+
+
+def evict(cache_dir, max_bytes):
+    '''
+        Remove least recently used .debs until the archive cache fits in
+    max_bytes.  Lists are small and always current, so they stay.
+    :return: [int] bytes released.
+    '''
+    debs = []
+    for deb in glob.glob('%s/%s/*.deb' % (cache_dir, _LAYOUT[0][0])):
+        try:
+            s = os.stat(deb)
+        except FileNotFoundError:
+            continue
+        debs.append((s.st_atime, s.st_size, deb))
+    total = sum(d[1] for d in debs)
+    released = 0
+    for _, size, deb in sorted(debs):
+        if total - released <= max_bytes:
+            break
+        try:
+            os.unlink(deb)
+            released += size
+        except FileNotFoundError:
+            pass
+    return released
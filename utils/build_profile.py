@@ -0,0 +1,125 @@
+#!/usr/bin/python3 -tt
+'''
+    Where the time of a node build goes.  Each stage of
+customize_node.execute() records its wall clock time, CPU time (this
+process plus the children it reaped: tar, apt-get, chroot...), bytes read
+from and written to storage, and the peak RSS of the children so far.
+Only standard python3 libraries.
+
+The byte counts come from /proc/self/io, which includes reaped children
+(and is zero where it can't be read).  ru_maxrss of RUSAGE_CHILDREN is a
+high-water mark over every child reaped, so a stage only "owns" it when
+it went up during that stage.
+'''
+
+import contextlib
+import functools
+import json
+import os
+import resource
+import time
+
+from pdb import set_trace
+
+REPORT = 'build_profile.json'
+
+
+def _io_bytes():
+    counts = { 'read_bytes': 0, 'write_bytes': 0 }
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in counts:
+                    counts[key] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counts
+
+
+def _sample():
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    sample = {
+        'wall': time.monotonic(),
+        'cpu_user': me.ru_utime + kids.ru_utime,
+        'cpu_system': me.ru_stime + kids.ru_stime,
+        'children_maxrss_kb': kids.ru_maxrss,
+    }
+    sample.update(_io_bytes())
+    return sample
+
+
+class BuildProfile(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self._start = time.monotonic()
+        self.stages = []        # In the order they started
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Time the body as stage "name"; stages may nest.'''
+        entry = { 'stage': name, 'depth': self._depth,
+                  'started': round(time.time(), 3), 'ok': False }
+        self.stages.append(entry)
+        before = _sample()
+        self._depth += 1
+        try:
+            yield entry
+            entry['ok'] = True
+        finally:
+            self._depth -= 1
+            after = _sample()
+            for key in ('wall', 'cpu_user', 'cpu_system'):
+                entry[key] = round(after[key] - before[key], 3)
+            for key in ('read_bytes', 'write_bytes'):
+                entry[key] = after[key] - before[key]
+            entry['children_maxrss_kb'] = after['children_maxrss_kb']
+            entry['children_maxrss_grew'] = \
+                after['children_maxrss_kb'] > before['children_maxrss_kb']
+
+    @property
+    def elapsed(self):
+        return round(time.monotonic() - self._start, 3)
+
+    def summary(self):
+        '''Short form for status.json: seconds per top-level stage.'''
+        seconds = {}
+        for entry in self.stages:
+            if entry['depth'] == 0 and 'wall' in entry:
+                seconds[entry['stage']] = round(
+                    seconds.get(entry['stage'], 0) + entry['wall'], 3)
+        return { 'elapsed': self.elapsed, 'stages': seconds }
+
+    def report(self, **meta):
+        '''Everything, plus "meta" (hostname, manifest, golden...).'''
+        report = dict(meta)
+        report['started'] = round(self.started, 3)
+        report['elapsed'] = self.elapsed
+        report['stages'] = [ dict(entry) for entry in self.stages ]
+        return report
+
+    def write(self, path, **meta):
+        '''The report as JSON, replaced atomically like status.json.'''
+        with open(path + '.new', 'w') as f:
+            json.dump(self.report(**meta), f, indent=4)
+        os.replace(path + '.new', path)
+
+
+def stage(args, name):
+    '''args.profile.stage(name), or nothing if the build isn't profiled.'''
+    profile = getattr(args, 'profile', None)
+    if profile is None:
+        return contextlib.ExitStack()
+    return profile.stage(name)
+
+
+def profiled(func):
+    '''Decorator: time a build step whose first argument is "args".'''
+    @functools.wraps(func)
+    def wrapper(args, *posargs, **kwargs):
+        with stage(args, func.__name__):
+            return func(args, *posargs, **kwargs)
+    return wrapper
@@ -0,0 +1,195 @@
+#!/usr/bin/python3 -tt
+'''
+    Bounded pool of image builders for the API server.  Each PUT used to
+fork its own customize_node.execute(); binding 40 nodes started 40 chroot
+apt runs at once.  Now requests go into a priority queue (lower number
+first, FIFO within a priority) and a fixed number of worker threads each
+fork one build child at a time and wait for it.  Only standard python3
+libraries are used here.
+'''
+
+import heapq
+import itertools
+import logging
+import os
+import signal
+import threading
+import time
+import traceback
+
+from pdb import set_trace
+
+
+_CRASHED = 70       # EX_SOFTWARE: the runner raised instead of returning
+
+
+def _terminated(signum, frame):
+    '''SIGTERM in a build child: unwind so "finally" clauses can unmount.'''
+    raise SystemExit('Build cancelled')
+
+
+class BuildScheduler(object):
+
+    def __init__(self, workers, runner, notify=None, failed=None,
+                 logger=None):
+        '''
+        :param 'workers': [int] number of concurrent builds.
+        :param 'runner': callable(job) run in a forked child; its return
+                         value is the child exit status.
+        :param 'notify': callable(key, job, position) called once when a
+                         job is queued.  Later positions come from
+                         position(), nobody is rewritten as the queue moves.
+        :param 'failed': callable(key, job, reason) called when a job could
+                         not be started, or its child exited nonzero or was
+                         killed, unless it was cancel()led.
+        :param 'logger': where to say things, default is the root logger.
+        '''
+        assert workers > 0, 'Need at least one build worker'
+        self._runner = runner
+        self._notify = notify
+        self._failed = failed
+        self._logger = logger or logging
+        self._cond = threading.Condition()
+        self._queue = []            # heap of (priority, sequence, key)
+        self._jobs = {}             # key: job, waiting in the queue
+        self._running = {}          # key: child PID
+        self._cancelled = set()     # running keys being cancel()led
+        self._sequence = itertools.count()
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name='builder%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    @property
+    def workers(self):
+        return len(self._threads)
+
+    def submit(self, key, job, priority=0):
+        '''Queue a job; raise ValueError if key is already queued or running.'''
+        with self._cond:
+            if key in self._jobs or key in self._running:
+                raise ValueError('%s is already scheduled' % key)
+            self._jobs[key] = job
+            entry = (priority, next(self._sequence), key)
+            heapq.heappush(self._queue, entry)
+            self._call(self._notify, key, job,
+                       sum(1 for e in self._queue if e <= entry))
+            self._cond.notify()
+
+    def position(self, key):
+        '''0 if running, 1-based queue position if waiting, else None.'''
+        with self._cond:
+            if key in self._running:
+                return 0
+            for entry in self._queue:
+                if entry[2] == key:
+                    return sum(1 for e in self._queue if e <= entry)
+        return None
+
+    def cancel(self, key, timeout=10.0):
+        '''
+            Drop a waiting job, or SIGTERM the process group of a running
+        one and wait for it to be reaped.  SIGKILL after "timeout" seconds.
+        :return: [bool] True if there was something to cancel.
+        '''
+        with self._cond:
+            if key in self._jobs:
+                del self._jobs[key]
+                self._queue = [e for e in self._queue if e[2] != key]
+                heapq.heapify(self._queue)
+                return True
+            pid = self._running.get(key, None)
+            if pid is None:
+                return False
+            self._cancelled.add(key)
+
+        self._logger.warning('Cancelling build of %s (PID %d)' % (key, pid))
+        sig = signal.SIGTERM
+        deadline = time.time() + timeout
+        while True:
+            try:
+                os.killpg(pid, sig)
+            except OSError:     # already gone
+                pass
+            with self._cond:
+                while key in self._running and time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+                if key not in self._running:
+                    return True
+            if sig == signal.SIGKILL:
+                return True     # Let the worker reap it eventually
+            sig = signal.SIGKILL
+            deadline = time.time() + timeout
+
+    def _call(self, callback, key, job, arg):
+        '''notify or failed, which must not take a worker down.'''
+        if callback is None:
+            return
+        try:
+            callback(key, job, arg)
+        except Exception as err:
+            self._logger.error('Build queue callback for %s failed: %s' % (
+                key, str(err)))
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                _, _, key = heapq.heappop(self._queue)
+                job = self._jobs.pop(key)
+                # Fork with the lock held so cancel() can never find the
+                # job in neither dictionary.  The child never touches it.
+                try:
+                    pid = os.fork()
+                except OSError as err:
+                    pid = None
+                    reason = 'Cannot start build: %s' % str(err)
+                if pid == 0:
+                    self._child(job)    # does not return
+                if pid is not None:
+                    self._running[key] = pid
+            if pid is None:             # Dropped, but not silently
+                self._logger.critical('%s: %s' % (key, reason))
+                self._call(self._failed, key, job, reason)
+                continue
+            self._logger.info('Build of %s started as PID %d' % (key, pid))
+
+            try:
+                _, status = os.waitpid(pid, 0)
+                if os.WIFEXITED(status):
+                    status = os.WEXITSTATUS(status)
+                    reason = 'Build crashed' if status == _CRASHED else \
+                        'Build exited with status %d' % status
+                else:
+                    status = -os.WTERMSIG(status)
+                    reason = 'Build killed by signal %d' % -status
+            except OSError as err:
+                status = reason = str(err)
+            self._logger.info('Build of %s finished: %s' % (key, status))
+
+            with self._cond:
+                del self._running[key]
+                cancelled = key in self._cancelled
+                self._cancelled.discard(key)
+                self._cond.notify_all()
+            if status != 0 and not cancelled:
+                self._call(self._failed, key, job, reason)
+
+    def _child(self, job):
+        '''Own session and process group so cancel() reaches chroot children.'''
+        status = _CRASHED
+        try:
+            os.setsid()
+            signal.signal(signal.SIGTERM, _terminated)
+            status = self._runner(job)
+        except SystemExit as err:   # including _terminated
+            self._logger.warning('Build child exiting: %s' % str(err))
+            status = err.code if isinstance(err.code, int) else 1
+        except BaseException:
+            self._logger.error('Build crashed:\n%s' % traceback.format_exc())
+            status = _CRASHED
+        finally:
+            os._exit(status if isinstance(status, int) else _CRASHED)
@@ -0,0 +1,163 @@
+#!/usr/bin/python3 -tt
+'''
+    Compressors for boot artifacts.  All of them are write-only file-like
+objects wrapped around an already open binary file, which they do not
+close.  Only standard python3 libraries; zstd needs the external binary.
+
+ParallelGzipWriter is the pigz technique: the input is cut into blocks
+which are deflated on a thread pool (zlib releases the GIL), each primed
+with the last 32K of the previous block and ended on a byte boundary with
+a sync flush.  The concatenation is ONE ordinary gzip member, so gunzip,
+grub and the kernel initramfs unpacker read it like any other.
+'''
+
+import collections
+import concurrent.futures
+import lzma
+import os
+import shutil
+import struct
+import subprocess
+import time
+import zlib
+
+from pdb import set_trace
+
+METHODS = ('gzip', 'xz', 'zstd')
+
+_WINDOW = 32 << 10      # deflate dictionary size
+
+
+def _deflate(block, zdict, level, last):
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                         zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+                         *((zdict, ) if zdict else ()))
+    return c.compress(block) + c.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(object):
+
+    def __init__(self, fileobj, threads=4, level=6, filename='',
+                 blocksize=128 << 10):
+        '''
+        :param 'fileobj': [file] binary output, left open by close().
+        :param 'threads': [int] compression threads.
+        :param 'filename': [str] original name recorded in the gzip header.
+        '''
+        self._out = fileobj
+        self._level = level
+        self._blocksize = blocksize
+        self._pool = concurrent.futures.ThreadPoolExecutor(max(1, threads))
+        self._pending = collections.deque()
+        self._backlog = 2 * max(1, threads)     # bounds memory use
+        self._buffer = bytearray()
+        self._dict = b''
+        self._crc = 0
+        self._size = 0
+        self.closed = False
+
+        name = os.path.basename(filename)
+        if name.endswith('.gz'):
+            name = name[:-3]
+        flags = 0x08 if name else 0     # FNAME
+        self._out.write(struct.pack('<BBBBLBB', 0x1f, 0x8b, zlib.DEFLATED,
+                                    flags, int(time.time()), 0, 255))
+        if name:
+            self._out.write(name.encode('latin-1', 'replace') + b'\0')
+
+    def _submit(self, block, last=False):
+        self._pending.append(self._pool.submit(
+            _deflate, block, self._dict, self._level, last))
+        self._dict = block[-_WINDOW:]
+        while len(self._pending) > self._backlog:
+            self._out.write(self._pending.popleft().result())
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+        # Keep at least one byte back: the final block must carry Z_FINISH
+        while len(self._buffer) > self._blocksize:
+            block = bytes(self._buffer[:self._blocksize])
+            del self._buffer[:self._blocksize]
+            self._submit(block)
+        return len(data)
+
+    def flush(self):
+        pass    # Blocks are only complete at their boundary or close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            while self._pending:
+                self._out.write(self._pending.popleft().result())
+            self._out.write(struct.pack('<LL', self._crc & 0xFFFFFFFF,
+                                        self._size & 0xFFFFFFFF))
+            self._out.flush()
+        finally:
+            self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _PipeWriter(object):
+    '''Feed an external compressor whose stdout is fileobj.'''
+
+    def __init__(self, cmd, fileobj):
+        if shutil.which(cmd[0]) is None:
+            raise RuntimeError('%s is not installed' % cmd[0])
+        fileobj.flush()
+        self._cmd = ' '.join(cmd)
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+            stdout=fileobj, stderr=subprocess.PIPE)
+        self.closed = False
+
+    def write(self, data):
+        return self._proc.stdin.write(data)
+
+    def flush(self):
+        self._proc.stdin.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._proc.stdin.close()
+        stderr = self._proc.stderr.read()
+        if self._proc.wait():
+            raise RuntimeError('"%s" failed: %s' % (
+                self._cmd, stderr.decode().strip()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compressed_writer(fileobj, method='gzip', threads=1, filename=''):
+    '''
+        Wrap fileobj in a compressor acceptable as a kernel initramfs.
+    :param 'method': [str] one of METHODS.
+    :param 'threads': [int] gzip and zstd compress in parallel.
+    :param 'filename': [str] recorded in gzip headers.
+    :return: file-like object; close() it, then close fileobj.
+    '''
+    if method == 'gzip':
+        return ParallelGzipWriter(fileobj, threads=threads, filename=filename)
+    if method == 'xz':      # The kernel XZ decoder only verifies CRC32
+        return lzma.LZMAFile(fileobj, 'wb',
+            format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32)
+    if method == 'zstd':
+        return _PipeWriter(
+            ['zstd', '-q', '-c', '-9', '-T%d' % max(1, threads)], fileobj)
+    raise RuntimeError('Unknown compression "%s", use one of %s' % (
+        method, ', '.join(METHODS)))
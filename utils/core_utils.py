@@ -8,7 +8,9 @@ libraries.
 '''
 
 import collections
+import fcntl
 import glob
+import hashlib
 import logging
 import os
 import shlex
@@ -143,6 +145,118 @@ def untar(destination, source):
         raise RuntimeError('Error occured while untaring "%s": %s' % (source, str(err)))
 
 
+def hash_file(path, blocksize=1 << 20):
+    """
+        SHA256 of a file's content.  Hashing a golden tarball takes a while,
+    so the answer is remembered in a "<path>.sha256" sidecar and reused
+    for as long as the file's size and mtime stay the same.
+
+    :param 'path': [str] file to hash.
+    :return: [str] hex digest.  Raise RuntimeError on problems.
+    """
+    sidecar = path + '.sha256'
+    try:
+        s = os.stat(path)
+        stamp = '%d %d' % (s.st_size, s.st_mtime_ns)
+        try:
+            with open(sidecar, 'r') as f:
+                digest, oldstamp = f.read().strip().split(' ', 1)
+            if oldstamp == stamp:
+                return digest
+        except (OSError, ValueError):   # missing or garbled, just redo it
+            pass
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+    except OSError as err:
+        raise RuntimeError('Cannot hash "%s": %s' % (path, str(err)))
+
+    try:
+        with open(sidecar, 'w') as f:
+            f.write('%s %s\n' % (digest, stamp))
+    except OSError:     # read-only location, it will just be slower next time
+        pass
+    return digest
+
+
+def clone_tree(source, destination):
+    """
+        Give "destination" a private, writable copy of the "source" tree.
+    "cp --reflink=auto" shares data blocks on filesystems that can do it
+    (btrfs, XFS) and falls back to a plain copy everywhere else.  Hardlinks
+    are NOT an option: customization appends to files in place.
+
+    :param 'source': [str] directory to clone.
+    :param 'destination': [str] new directory; replaced if it exists.
+    :return: [str] destination.  Raise RuntimeError on problems.
+    """
+    file_utils.remove_target(destination)
+    cmd = 'cp -a --reflink=auto %s %s' % (
+        source.rstrip('/'), destination.rstrip('/'))
+    ret, _, stderr = piper(cmd)
+    if ret:
+        raise RuntimeError('"%s" failed: %s' % (cmd, stderr.decode().strip()))
+    return destination
+
+
+def _evict_stale(cache_dir, keep):
+    """
+        Remove the extracted trees (and leftover .new extractions) of every
+    digest but "keep".  Each one is only removed while holding its lock
+    exclusively, so never from under a clone or an extraction; busy ones
+    are left for next time.  Lock files stay: unlinking one that another
+    process has open would let two processes "hold" the same lock.
+    """
+    for name in sorted(os.listdir(cache_dir)):
+        digest = name.split('.')[0]
+        if name.endswith('.lock') or digest == keep:
+            continue
+        stale = '%s/%s' % (cache_dir, digest)
+        with open(stale + '.lock', 'a') as lockobj:
+            try:
+                fcntl.flock(lockobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:     # In use
+                continue
+            file_utils.remove_target(stale)
+            file_utils.remove_target(stale + '.new')
+
+
+def untar_cached(destination, source, cache_dir):
+    """
+        untar() with a memory.  The tarball is extracted once into
+    cache_dir/<sha256 of tarball>/ and every caller gets a clone_tree()
+    of that.  Each entry has a lock file: clones hold it shared for as
+    long as they copy, the extraction holds it exclusive.  Entries for any
+    other hash are stale (the golden image was rebuilt) and are removed
+    after a new extraction, see _evict_stale().
+
+    :param 'destination': [str] path to where the writable tree should go.
+    :param 'source': [str] path to a .tar file.
+    :param 'cache_dir': [str] directory holding the extracted trees.
+    :return: [str] path to untared content.  Raise RuntimeError on problems.
+    """
+    digest = hash_file(source)
+    cached = '%s/%s' % (cache_dir, digest)
+    file_utils.make_dir(cache_dir)
+    with open(cached + '.lock', 'a') as lockobj:    # released on close
+        for attempt in range(3):
+            fcntl.flock(lockobj, fcntl.LOCK_SH)
+            if os.path.isdir(cached):
+                clone_tree(cached, destination)
+                return destination
+            fcntl.flock(lockobj, fcntl.LOCK_EX)
+            if not os.path.isdir(cached):
+                untar(cached + '.new', source)
+                os.rename(cached + '.new', cached)
+                _evict_stale(cache_dir, digest)
+            # Back to shared to clone.  That is not atomic, so the entry is
+            # checked again: an eviction may have slipped in between.
+    raise RuntimeError('Cache entry "%s" keeps disappearing' % cached)
+
+
 def make_tar(destination, source):
     """ Make a "source" folder into "tar" destination. No compression involved."""
     with tarfile.open(destination, 'w') as tar:
@@ -244,8 +358,8 @@ def set_proxy_environment():
 
 def create_loopback_files():
     """
-    One loopback file is required for each node being bound to a manifest.
-    One is also used during setup golden_image.  LXC doesn't prebuild them
+    Node ESP images are built in userspace (esp_image.py) and don't need
+    these, but setup golden_image still uses one.  LXC doesn't prebuild them
     and I'm not sure why.  "loop" is statically compiled and that seems to
     lock the count at eight.
     """
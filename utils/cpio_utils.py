@@ -0,0 +1,141 @@
+#!/usr/bin/python3 -tt
+'''
+    Write "newc" (SVR4, no CRC) cpio archives, the format the kernel
+unpacks as an initramfs.  The tree is walked with os.scandir and every
+header and file body goes straight to the output stream, so memory use
+doesn't grow with the number of files and no external cpio is needed.
+Only standard python3 libraries.
+'''
+
+import os
+import shutil
+import stat
+
+from pdb import set_trace
+
+_MAGIC = b'070701'
+_TRAILER = 'TRAILER!!!'
+_BLOCKSIZE = 512        # Total output is padded to this, like GNU cpio
+
+
+class CpioWriter(object):
+    '''
+        Append entries to a binary file object, then close() to write the
+    trailer.  Inode numbers are renumbered (64-bit inodes don't fit in the
+    header) and hardlinked file data is written with the first link only;
+    the kernel links the later names to it.
+    '''
+
+    def __init__(self, fileobj):
+        self._out = fileobj
+        self._offset = 0
+        self._inodes = {}       # (st_dev, st_ino): renumbered, hardlinks only
+        self._next_ino = 0
+        self.entries = 0
+
+    def _write(self, data):
+        self._out.write(data)
+        self._offset += len(data)
+
+    def _pad(self, alignment=4):
+        self._write(b'\0' * (-self._offset % alignment))
+
+    def _header(self, name, ino, mode, uid, gid, nlink, mtime, size,
+                dev=0, rdev=0):
+        name = name.encode() + b'\0'
+        fields = (ino, mode, uid, gid, nlink, int(mtime), size,
+                  os.major(dev), os.minor(dev),
+                  os.major(rdev), os.minor(rdev), len(name), 0)
+        for f in fields:
+            if not 0 <= f <= 0xFFFFFFFF:
+                raise RuntimeError('"%s" does not fit in a cpio header' %
+                    name[:-1].decode())
+        self._write(_MAGIC + b''.join(b'%08X' % f for f in fields) + name)
+        self._pad()
+
+    def add(self, path, arcname, st=None):
+        '''
+            Archive the file system object at "path" as "arcname".
+        :param 'st': [os.stat_result] lstat() of path if already known.
+        '''
+        if st is None:
+            st = os.lstat(path)
+        # Only multiply-linked files need remembering (directories' links
+        # are their children), so memory stays flat for ordinary trees.
+        seen = False
+        if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+            key = (st.st_dev, st.st_ino)
+            seen = key in self._inodes
+            if not seen:
+                self._next_ino += 1
+                self._inodes[key] = self._next_ino
+            ino = self._inodes[key]
+        else:
+            self._next_ino += 1
+            ino = self._next_ino
+
+        data = None
+        size = 0
+        if stat.S_ISLNK(st.st_mode):
+            data = os.readlink(path).encode()
+            size = len(data)
+        elif stat.S_ISREG(st.st_mode) and not seen:
+            size = st.st_size
+
+        self._header(arcname, ino, st.st_mode, st.st_uid, st.st_gid,
+                     st.st_nlink, st.st_mtime, size, st.st_dev, st.st_rdev)
+        if data is not None:
+            self._write(data)
+        elif size:
+            with open(path, 'rb') as f:
+                start = self._offset
+                shutil.copyfileobj(f, self, 1 << 20)
+                if self._offset - start != size:
+                    raise RuntimeError('"%s" changed size while archiving' %
+                        path)
+        self._pad()
+        self.entries += 1
+
+    def write(self, data):
+        '''So shutil.copyfileobj() can target this object.'''
+        self._write(data)
+
+    def close(self):
+        '''Write the trailer entry; the underlying file is left open.'''
+        self._header(_TRAILER, 0, 0, 0, 0, 1, 0, 0)
+        self._pad(_BLOCKSIZE)
+        self._out.flush()
+
+
+def _walk(top, prefix, ignore_files, ignore_dirs):
+    '''Yield (path, arcname, lstat) below top, directories before contents.'''
+    # Not "with": python 3.5 iterators have no context manager, and
+    # reading it to the end closes it anyway.
+    entries = sorted(os.scandir(top), key=lambda e: e.name)
+    for entry in entries:
+        is_dir = entry.is_dir(follow_symlinks=False)
+        if entry.name in (ignore_dirs if is_dir else ignore_files):
+            continue
+        arcname = prefix + '/' + entry.name
+        yield entry.path, arcname, entry.stat(follow_symlinks=False)
+        if is_dir:
+            yield from _walk(entry.path, arcname, ignore_files, ignore_dirs)
+
+
+def write_tree(fileobj, top, ignore_files=(), ignore_dirs=()):
+    '''
+        Archive everything below "top" with names relative to it ("./etc",
+    "./etc/hostname" ...).  A leading '/' in the names makes the kernel
+    panic at boot.  Ignored directories are not descended into.
+
+    :param 'fileobj': [file] binary stream open for writing.
+    :param 'top': [str] root of the tree; itself is not archived.
+    :param 'ignore_files': [list] basenames of non-directories to skip.
+    :param 'ignore_dirs': [list] basenames of directories to skip.
+    :return: [int] number of entries written, excluding the trailer.
+    '''
+    writer = CpioWriter(fileobj)
+    for path, arcname, st in _walk(top, '.', ignore_files, ignore_dirs):
+        writer.add(path, arcname, st)
+    writer.close()
+    return writer.entries
@@ -14,12 +14,16 @@ __email__ = "rocky.craig@hpe.com, zakhar.volchak@hpe.com"
 
 
 import argparse
+import collections
 import contextlib
+import errno
+import fcntl
 import glob
-import gzip
+import hashlib
 import json
 import magic  # to get file type and check if gzipped
 import os
+import re
 import requests as HTTP_REQUESTS
 import shutil   # explicit namespace differentiates from our custom FS routines
 import sys
@@ -27,7 +31,12 @@ import time
 
 from pdb import set_trace
 
+from tmms.utils import apt_cache
+from tmms.utils import build_profile
+from tmms.utils import compress_utils
 from tmms.utils import core_utils
+from tmms.utils import cpio_utils
+from tmms.utils import esp_image
 from tmms.utils import file_utils
 from tmms.utils import logging
 from tmms.utils import utils
@@ -40,6 +49,7 @@ from tmms.utils import utils
 # actually tracked it down.   Hasn't been seen in a while....
 
 
+@build_profile.profiled
 def extract_bootfiles(args, keep_kernel=False):
     """
         Remove boot/vmlinuz* and boot/initrd.img/ files from new file system.
@@ -99,6 +109,7 @@ def extract_bootfiles(args, keep_kernel=False):
 #    just rewrite the whole thing.
 
 
+@build_profile.profiled
 def persist_initrd(args):
     """
 
@@ -121,6 +132,7 @@ def persist_initrd(args):
 #==============================================================================
 
 
+@build_profile.profiled
 def cleanup_sources_list(args):
     """
         Golden image from (vm)debootstrap leave two pieces of useless info:
@@ -182,6 +194,7 @@ def set_apt_conf(path, apt_cfg_content, args=None):
                             path, err))
 
 
+@build_profile.profiled
 def set_apt_proxy(args):
     """
         @param args: namespace obj.
@@ -223,6 +236,7 @@ def set_apt_proxy(args):
                             (path, err))
 
 
+@build_profile.profiled
 def add_other_mirror(args):
     """
     @param other_mirrors:
@@ -243,6 +257,7 @@ def add_other_mirror(args):
     return
 
 
+@build_profile.profiled
 def localhost2torms(args):
     '''Go through apt.conf.d and sources.list.d and change localhost -> torms'''
     if args.is_golden:
@@ -259,6 +274,7 @@ def localhost2torms(args):
 #===========================================================================
 
 
+@build_profile.profiled
 def set_client_id(args):
     """
         Augment dhclient configuration file
@@ -275,14 +291,24 @@ def set_client_id(args):
     dhclient_conf = '%s/etc/dhcp/dhclient.conf' % args.new_fs_dir
     clientid = args.DhcpClientId
     try:
-        with open(dhclient_conf, 'a') as f:
-            f.write('\nsend dhcp-client-identifier "%s";\n' % clientid)
+        # A cached image carries the ID of the node that built it.
+        lines = []
+        if os.path.exists(dhclient_conf):
+            with open(dhclient_conf, 'r') as f:
+                lines = [ line for line in f.readlines() if not
+                          line.startswith('send dhcp-client-identifier ') ]
+        while lines and not lines[-1].strip():
+            lines.pop()
+        lines.append('\nsend dhcp-client-identifier "%s";\n' % clientid)
+        with open(dhclient_conf, 'w') as f:
+            f.write(''.join(lines))
     except Exception as err:
         raise RuntimeError('Cannot set DHCP client ID: %s' % str(err))
 
 #==============================================================================
 
 
+@build_profile.profiled
 def hack_LFS_autostart(args):
     """
     FIXME: DEPRECATED. Seems like we don't need it anymore.
@@ -325,6 +351,7 @@ def hack_LFS_autostart(args):
 
 #==============================================================================
 
+@build_profile.profiled
 def set_foreign_package(args, foreign_package):
     """
         When "foreign" parameter used in vmdebootstrap, it will remove whose
@@ -341,6 +368,7 @@ def set_foreign_package(args, foreign_package):
         os.chmod(foreign_in_build, 0o755)
 
 
+@build_profile.profiled
 def set_environment(args):
     """
         Set new /etc/environment http_proxy stuff on the file system image.
@@ -367,6 +395,7 @@ def set_environment(args):
         raise RuntimeError('Cannot set %s: %s' % (fname, str(err)))
 
 
+@build_profile.profiled
 def set_hostname(args):
     """
         Set new /etc/hostname on the file system image.
@@ -385,6 +414,7 @@ def set_hostname(args):
         raise RuntimeError('Cannot set /etc/hostname: %s' % str(err))
 
 
+@build_profile.profiled
 def set_hosts(args):
     """
         Set new /etc/hosts on the file system image.
@@ -410,6 +440,7 @@ def set_hosts(args):
         raise RuntimeError('Cannot set %s: %s' % (fname, str(err)))
 
 
+@build_profile.profiled
 def set_resolv_conf(args):
     """
         Copy /etc/resolv.conf from host to the building image.
@@ -423,6 +454,7 @@ def set_resolv_conf(args):
     file_utils.copy_target_into('/etc/resolv.conf', resolv_path)
 
 
+@build_profile.profiled
 def set_sudo(args):
     """
         Set sudoer policy of no password for the normal user.  That user was
@@ -472,6 +504,7 @@ def _get_userstuff(args, user):
             raise RuntimeError('Cannot find normal user 1000:1000')
 
 
+@build_profile.profiled
 def set_sshkeys(args):
     """
         Add pubkey to /home/<user>/.ssh/authorized_keys.  Overwrite
@@ -519,6 +552,7 @@ def set_sshkeys(args):
 #==============================================================================
 
 
+@build_profile.profiled
 def rewrite_rclocal(args):
     """
         Completely rewrite the /etc/rc.local noop script.
@@ -549,44 +583,50 @@ def rewrite_rclocal(args):
 #==============================================================================
 
 
+@build_profile.profiled
 def create_cpio(args):
     """
         Get the non-boot pieces, ignoring initrd, kernel, and /boot.
+    Normally the archive streams through the compressor straight into the
+    TFTP directory in one pass.  With args.debug (or no TFTP directory) the
+    uncompressed .cpio is kept in the build directory and compressed by
+    compress_bootfiles() as before.
 
-    :param 'dest_file': [str] path to save cpio archive
     :param 'args.new_fs_dir': [str] folder to create .cpio from.
-    :return: cpio_file
+    :return: cpio_file, either <build_dir>/<host>.cpio or the final
+             <tftp_dir>/<host>.cpio.gz
     """
-    cpio_file = '%s/%s.cpio' % (args.build_dir, args.hostname)
+    cpio_name = '%s.cpio' % args.hostname
+    tftp_dir = getattr(args, 'tftp_dir', None)
+    streaming = tftp_dir is not None and not getattr(args, 'debug', False)
+    if streaming:
+        cpio_file = '%s/%s.gz' % (tftp_dir, cpio_name)
+    else:
+        cpio_file = '%s/%s' % (args.build_dir, cpio_name)
     update_status(args, 'Create %s from %s' % (cpio_file, args.new_fs_dir))
+
+    # Nodes may be booting the previous image, so replace it atomically.
+    partial = cpio_file + '.new'
     try:
-        # Skip things even though they may have been moved
-        found_data = core_utils.find(
-            args.new_fs_dir,
-            ignore_files=['vmlinuz', 'initrd.img'],
-            ignore_dirs=['boot'])
-
-        cmd = 'cpio --create --format \'newc\''
-        cpio_stdin = '\n'.join(found_data).encode()  # needed for Popen pipe.
-
-        with open(cpio_file, 'w') as dest_obj:
-            # create CPIO relative to the 'find' path, to avoid '/' in archive
-            # names.  Note: searching outside of untar folder results in a
-            # "full path" string (e.g. whatever/untar/boot...., instead
-            # ./boot...). This causes Kernel Panic when trying to boot with
-            # such a cpio file.
-            with file_utils.workdir(args.new_fs_dir):
-                ret, cpio_out, cpio_err = core_utils.piper(
-                    cmd, stdin=cpio_stdin, stdout=dest_obj)
-                assert not ret, 'cpio failed: %s' % cpio_err
-
-        # output find data to a log file
+        with open(partial, 'wb') as dest_obj:
+            if streaming:
+                dest_obj = _initramfs_writer(args, dest_obj, cpio_name)
+            # Skip things even though they may have been moved.  Names are
+            # relative to new_fs_dir: "full path" names (whatever/untar/
+            # boot... instead of ./boot...) cause a kernel panic at boot.
+            with dest_obj:
+                entries = cpio_utils.write_tree(
+                    dest_obj, args.new_fs_dir,
+                    ignore_files=['vmlinuz', 'initrd.img'],
+                    ignore_dirs=['boot'])
+        os.replace(partial, cpio_file)
         if args.verbose:
-            with open('/tmp/man_find.log', 'w') as file_obj:
-                file_obj.write('\n'.join(found_data))   # FIXME proper logging
+            update_status(args, '%d entries in %s' % (entries, cpio_file))
         return cpio_file
 
     except Exception as err:
+        if os.path.exists(partial):
+            os.unlink(partial)
         raise RuntimeError('Couldn\'t create "%s" from "%s": %s' % (
             cpio_file, args.new_fs_dir, str(err)))
 
@@ -617,7 +657,51 @@ else
 fi
 '''
 
+_apt_install = 'apt-get install -q -y {0}--force-yes -o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confold" {1}\n'
+
+# apt-get and dpkg complaints that name the package at fault
+_APT_FAILURES = (
+    re.compile(r"^E: Unable to locate package (\S+)"),
+    re.compile(r"^E: Package '([^']+)' has no installation candidate"),
+    re.compile(r"^E: Version '[^']+' for '([^']+)' was not found"),
+    re.compile(r"^E: Failed to fetch \S+/([^/_\s]+)_[^/\s]+\.deb\b"),
+    re.compile(r"^ ([^\s:]+) : (?:Pre-)?Depends: "),
+    re.compile(r"^ ([^\s:]+) : Breaks: "),
+    re.compile(r"^dpkg: error processing package ([^\s:]+)"),
+    re.compile(r"^dpkg: error processing archive \S*?([^/\s_]+)_[^/\s]+\.deb"),
+)
 
+
+def parse_apt_failures(text):
+    """
+        Attribute a failed apt transaction to packages.
+    :param 'text': [str] apt-get/dpkg output, eg, install.log.
+    :return: [dict] package name: [ lines of apt output about it ], in the
+             order they were first blamed.
+    """
+    failures = collections.OrderedDict()
+    processing = False      # dpkg's "Errors were encountered" list
+    for line in text.splitlines():
+        if line.startswith('Errors were encountered while processing:'):
+            processing = True
+            continue
+        if processing:
+            if line.startswith(' ') and line.strip():
+                name = line.split('/')[-1].split('_')[0].strip()
+                failures.setdefault(name, []).append(
+                    'dpkg could not process ' + line.strip())
+                continue
+            processing = False
+        for regex in _APT_FAILURES:
+            m = regex.match(line)
+            if m:
+                failures.setdefault(m.group(1).split(':')[0], []).append(
+                    line.strip())
+                break
+    return failures
+
+
+@build_profile.profiled
 def install_packages(args):
     """
         Install list of packages into the filesystem image.
@@ -630,9 +714,16 @@ def install_packages(args):
     :param 'args.new_fs_dir': [str] path to filesystem image to customize.
     :param 'args.packages': [str] of packages 'apt-get install'.
     :param 'args.tasks': [list] of tasks for 'tasksel'.
+    :param 'args.apt_single': [bool] install packages and the packages of
+                              the tasks in one apt-get transaction.
+    :param 'args.task_packages': [str] packages of all tasks, for apt_single.
+    :param 'args.apt_cache': [str] optional server-wide apt cache directory.
+    :param 'args.skip_upgrade': [bool] args.golden_tar is a fresh snapshot.
     :return [boolean] True if it worked, False otherwise with updated status.
     """
     is_debug = getattr(args, 'debug', False)
+    apt_single = getattr(args, 'apt_single', False)
+    cache_dir = getattr(args, 'apt_cache', None)
     localdebs = None
     packages = None
     downloads = None
@@ -675,6 +766,16 @@ def install_packages(args):
             'Logic errors in customization kept %s from being created' %
         installsh)
 
+    # A fresh golden snapshot was upgraded by setup_golden_image.refresh_golden
+    if getattr(args, 'skip_upgrade', False):
+        upgrade = '# %s is fresh, no apt-get update/upgrade\n' % (
+            os.path.basename(args.golden_tar))
+    else:
+        upgrade = """apt-get update
+apt-get upgrade -q --assume-yes -y --force-yes
+# apt-get dist-upgrade -q --assume-yes
+"""
+
     # Don't use "-e" (exit on error).  It always does "exit 1" which gets
     # treated as EPERM, masking the real error.  It's also inherited by
     # subshells which mask things even further.
@@ -685,35 +786,46 @@ set -u
 cd /root
 exec > %s 2>&1
 export DEBIAN_FRONTEND=noninteractive
-apt-get update
-apt-get upgrade -q --assume-yes -y --force-yes
-# apt-get dist-upgrade -q --assume-yes
-
+%s
 echo "en_US UTF-8" > /etc/locale.gen
 /usr/sbin/locale-gen
 # I can't get the previous steps to accomplish this...something is missing?
 echo 'LANG="en_US.UTF-8"' >> /etc/default/locale
-""" % (time.ctime(), installog)
+""" % (time.ctime(), installog, upgrade)
 
     with open(script_file, 'w') as install:
         # install.write("this isn't legal this cannot work\n")
         install.write(script_header)
 
         install.write('\n# Packages: %s\n' % packages)
+        tasks = getattr(args, 'tasks', None)
+        if apt_single:
+            # One dependency resolution, one dpkg run, triggers run once.
+            # Failures are attributed to packages from the log afterwards.
+            install.write('# Tasks: %s\n' % tasks)
+            task_packages = (getattr(args, 'task_packages', None) or '').split()
+            names = list(collections.OrderedDict.fromkeys(
+                (packages or []) + task_packages))
+            if names:
+                install.write('\necho -e "\\n---------- Installing %d '
+                              'packages\\n"\n' % len(names))
+                install.write(_apt_install.format('', ' '.join(names)))
+                install.write(
+                    '[ $? -ne 0 ] && echo "Install failed" && exit 1\n')
+            packages = tasks = None     # Done, skip the loops below
+
         if packages is not None:
             for pkg in packages:
                 install.write(
                     '\necho -e "\\n---------- Installing %s\\n"\n' % pkg)
-                cmd = 'apt-get install -q -y --reinstall --force-yes -o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confold" %s\n' % pkg
-                install.write(cmd)
+                install.write(_apt_install.format('--reinstall ', pkg))
                 # Things from the repo OUGHT to work.
                 install.write(
                     '[ $? -ne 0 ] && echo "Install %s failed" && exit 1\n' %
                     pkg)
 
-        tasks = getattr(args, 'tasks', None)
-        install.write('\n# Tasks: %s\n' % tasks)
         if tasks is not None:
+            install.write('\n# Tasks: %s\n' % tasks)
             for task in tasks.split(','):
                 install.write(
                     '\necho -e "\\n---------- Executing task  %s\\n"\n' % task)
@@ -770,10 +882,17 @@ echo 'LANG="en_US.UTF-8"' >> /etc/default/locale
         install.write('\necho systemctl status says...\n')
         install.write('\nsystemctl status\n')
         install.write('\necho chroot installer complete at `date`\n')
-        install.write('\nexec apt-get clean\n')     # Final exit value
+        if cache_dir is None:
+            install.write('\nexec apt-get clean\n')     # Final exit value
+        else:   # harvest_apt_cache() cleans up after it copies
+            install.write('\nexit 0\n')
 
     os.chmod(script_file, 0o744)
 
+    if cache_dir is not None:
+        n = apt_cache.seed(cache_dir, args.new_fs_dir)
+        update_status(args, 'Seeded %d files from the apt cache' % n)
+
     try:
         procmount = args.new_fs_dir + '/proc'
         os.makedirs(procmount, exist_ok=True)
@@ -812,14 +931,36 @@ echo 'LANG="en_US.UTF-8"' >> /etc/default/locale
     except Exception as err:
         args.logger.error( '%s' % (err))
         with open(args.new_fs_dir + installog, 'r') as log:
-            args.logger.debug(' - D - %s' % log.read())
+            logtext = log.read()
+        args.logger.debug(' - D - %s' % logtext)
+        failures = parse_apt_failures(logtext)
+        if failures:
+            err = 'apt failed on %s: %s' % (', '.join(failures), '; '.join(
+                reasons[0] for reasons in failures.values()))
         raise RuntimeError(str(err))
     finally:
         umountret, _, _ = core_utils.piper(umount)
         utils.kill_chroot_daemons(args.build_dir)
+        if cache_dir is not None:
+            harvest_apt_cache(args)
     return False
 
 
+@build_profile.profiled
+def harvest_apt_cache(args):
+    """
+        Move what apt downloaded into the server apt cache for the next
+    build.  The cache is an optimization; its failures don't fail the build.
+    """
+    max_bytes = int(getattr(args, 'apt_cache_max', 0) or 0)
+    try:
+        n = apt_cache.harvest(args.apt_cache, args.new_fs_dir, max_bytes)
+        update_status(args, 'Added %d files to the apt cache' % n)
+    except Exception as err:
+        args.logger.warning('apt cache harvest failed: %s' % str(err))
+
+
+@build_profile.profiled
 def customize_grub(args):
     """
         COnfigure grub's config entry with a custom kernel command line (if
@@ -869,6 +1010,8 @@ def update_status(args, message, status='building'):
     except Exception as e:
         pass
     args.logger('%s' % message, level=level)
+    if getattr(args, 'no_status', False):
+        return      # Logged only, eg, building the image of a ready node
 
     response = {}
     if getattr(args, 'manifest', None) is None:
@@ -882,6 +1025,14 @@ def update_status(args, message, status='building'):
     response['DhcpClientId'] = getattr(args, 'DhcpClientId', 'Not set')
     response['node_id'] = getattr(args, 'node_id', 'Not set')
     response['hostname'] = args.hostname
+    if getattr(args, 'golden_tar', None):      # Which golden (snapshot)
+        response['golden'] = os.path.basename(args.golden_tar)
+    position = getattr(args, 'queue_position', None)
+    if position:                                # waiting on a build worker
+        response['queue_position'] = position
+    profile = getattr(args, 'profile', None)
+    if profile is not None:                     # see build_profile.py
+        response['profile'] = profile.summary()
 
     # Rally DE118: make it an atomic update
     newstatus = args.status_file + '.new'
@@ -892,11 +1043,13 @@ def update_status(args, message, status='building'):
 # ESP == EFI System Partition, where EFI wants to scan for FS0:.
 
 
-def create_ESP(args, blockdev, vmlinuz, cpio):
+def create_ESP(args, ESP_img, vmlinuz, cpio, img_size, ESP_offset):
+    """
+        Write the whole disk image, GPT and filled-in FAT32 ESP, with
+    esp_image.py: no parted/kpartx/mkfs.vfat/mount, so no root, no loop
+    devices, and any number of these can run at once.
+    """
     update_status(args, 'Creating and filling ESP')
-    ESP_mnt = '%s/mnt' % (args.build_dir)   # Going to be a VFAT FS image
-    file_utils.remove_target(ESP_mnt)
-    os.makedirs(ESP_mnt)
 
     # tftp_dir has "images/nodeZZ" tacked onto it from caller.
     # Grub itself is pulled live from a fixed location.
@@ -912,52 +1065,28 @@ def create_ESP(args, blockdev, vmlinuz, cpio):
         grubbase = 'grubnetaa64.efi'    # gzipped files still choke it
         prefix = '/grub'
     getgrub = '/'.join(args.tftp_dir.split('/')[:-2]) + '/grub/%s' % grubbase
-    grubdir = ESP_mnt + prefix
 
-    undo_mount = False
-    try:
-        # This happens on containers. I think I solved it but paranoia is ok.
-        assert os.path.exists(blockdev), \
-            'Cannot find mapper file %s' % blockdev
-
-        cmd = 'mkfs.vfat ' + blockdev
-        ret, stdout, stderr = core_utils.piper(cmd)
-        assert not ret, cmd
-
-        # Step 3: Make, mount, and fill the VFAT FS.  The EFI default startup
-        # script goes at /, but the grub stuff lives under "prefix".
-
-        cmd = 'mount %s %s' % (blockdev, ESP_mnt)
-        ret, stdout, stderr = core_utils.piper(cmd)
-        assert not ret, cmd
-        undo_mount = True
-        update_status(args, 'SDHC GRUB DIR established at %s' % grubdir)
-
-        # The EFI directory separator is backslash, while grub is forward.
-        with open(ESP_mnt + '/startup.nsh', 'w') as f:
-            f.write(prefix.replace('/', '\\') + '\\%s\n' % grubbase)
-        os.makedirs(grubdir)
-        shutil.copy(vmlinuz, grubdir)
-        shutil.copy(cpio, grubdir)
-        shutil.copy(getgrub, grubdir)
-
-        with open(grubdir + '/grub.cfg', 'w') as f:
-            # Originally for SNBU but worth keeping
-            f.write('set debug=linux,linuxefi,efi\n')
-            f.write('set pager=1\n')
-            f.write('linux %s/%s\n' % (prefix, os.path.basename(vmlinuz)))
-            f.write('initrd %s/%s\n' % (prefix, os.path.basename(cpio)))
-            f.write('boot\n')
-
-    except Exception as e:
-        pass    # Just keep it here
-
-    if undo_mount:
-        cmd = 'umount ' + ESP_mnt
-        ret, stdout, stderr = core_utils.piper(cmd)
-        assert not ret, cmd
-
-    return undo_mount   # suppress final copy if this didn't work
+    # The EFI default startup script goes at /, but the grub stuff lives
+    # under "prefix".  The EFI directory separator is backslash, while
+    # grub is forward.
+    startup = prefix.replace('/', '\\') + '\\%s\n' % grubbase
+    grubcfg = ''.join((
+        'set debug=linux,linuxefi,efi\n',     # Originally for SNBU but
+        'set pager=1\n',                      # worth keeping
+        'linux %s/%s\n' % (prefix, os.path.basename(vmlinuz)),
+        'initrd %s/%s\n' % (prefix, os.path.basename(cpio)),
+        'boot\n',
+    ))
+    files = [
+        ('/startup.nsh', startup.encode()),
+        ('%s/%s' % (prefix, os.path.basename(vmlinuz)), vmlinuz),
+        ('%s/%s' % (prefix, os.path.basename(cpio)), cpio),
+        ('%s/%s' % (prefix, grubbase), getgrub),
+        ('%s/grub.cfg' % prefix, grubcfg.encode()),
+    ]
+    esp_image.build_ESP(ESP_img, files, size=img_size, offset=ESP_offset << 20,
+                        name=args.hostname)
+    update_status(args, 'SDHC GRUB DIR established at %s' % prefix)
 
 #=============================================================================
 # SNBU == Single Node Bringup, the first turnon of node boards.
@@ -968,14 +1097,42 @@ def create_ESP(args, blockdev, vmlinuz, cpio):
 # make all that much data, he says with a smile.
 
 
+def remove_SNBU_image(args):
+    '''Don't serve the image of a previous build.'''
+    ESP_target = '%s/%s.ESP' % (args.tftp_dir, args.hostname)
+    # .sha256: hash sidecars that earlier versions left for their ETags
+    for stale in (ESP_target, ESP_target + '.gz',
+                  ESP_target + '.sha256', ESP_target + '.gz.sha256'):
+        if os.path.exists(stale):
+            os.unlink(stale)
+
+
+@build_profile.profiled
 def create_SNBU_image(args, vmlinuz, cpio):
+    '''
+        Only nodes whose manifest sets "esp_image" get this during the build;
+    the nodes blueprint builds the rest when first downloaded, with its own
+    build_SNBU_image() and publish_ESP() calls.  A node boots without the
+    image so failures are only logged.
+    '''
+    remove_SNBU_image(args)
+    try:
+        ESP_img = build_SNBU_image(args, vmlinuz, cpio)
+        publish_ESP(args, ESP_img, '%s/%s.ESP' % (args.tftp_dir, args.hostname))
+    except RuntimeError as err:
+        args.logger.error(str(err))
+    except Exception as err:
+        args.logger.critical('create_SNBU_image: %s' % str(err))
+
+
+def build_SNBU_image(args, vmlinuz, cpio):
+    '''
+        Make the image, and with args.esp_gzip a gzipped copy for faster
+    downloads, in args.build_dir.
+    :return: [str] path of the image, for publish_ESP()
+    '''
     update_status(args, 'Building SNBU SDHC image')
     ESP_img = '%s/%s.ESP' % (args.build_dir, args.hostname)
-    ESP_target = '%s/%s' % (args.tftp_dir, ESP_img)     # node-specific by now
-    if os.path.exists(ESP_target):                      # shutil.copy below
-        os.unlink(ESP_target)
-
-    # Step 1: create the image file, burn GPT and ESP on it.
 
     whitney_FW_image = True     # FW updates for Whitney need 128M hole
     if whitney_FW_image:
@@ -985,71 +1142,45 @@ def create_SNBU_image(args, vmlinuz, cpio):
         img_size = 256 << 20    # Downloads and boots much faster
         ESP_offset = 1
 
-    with open(ESP_img, 'wb') as f:
-        os.posix_fallocate(f.fileno(), 0, img_size)
-    undo_kpartx = do_copy = False     # until I make it that far.
-
-    try:    # piper catches many things, asserts get me out early
-        cmd = 'parted -s %s ' % ESP_img    # Yes, -s goes right here
-        cmd += 'mklabel gpt '
-        cmd += 'unit MiB mkpart primary fat32 %d 100%% ' % ESP_offset
-        cmd += 'set 1 boot on set 1 esp on '
-        cmd += 'name 1 %s ' % args.hostname
-        ret, stdout, stderr = core_utils.piper(cmd)
-        assert not ret, cmd
-
-        # Step 2: located the partition and create a block device.
-        # Ass-u-me enough loopback devics to go around.
-
-        cmd = 'kpartx -asv %s' % ESP_img
-        ret, stdout, stderr = core_utils.piper(cmd)
-        assert not ret, cmd
-        undo_kpartx = True
-        stdout = stdout.decode()
-        assert stdout.startswith('add map loop'), \
-            'Unexpected kpartx output: %s' % stdout
-        blockdev = '/dev/mapper/' + stdout.split()[2]
-        assert blockdev.endswith('p1'), \
-            'Unexpected kpartx partition: %s' % blockdev
-
-        # Step 3: fill it out
-
-        do_copy = create_ESP(args, blockdev, vmlinuz, cpio)
-
-    except AssertionError as e:
-        args.logger.error('%s failed:\n - errno = %d: %s' % (
-                        str(e), ret, stderr))
-    except RuntimeError as e:
-        args.logger.error('%s:\n - errno = %d: %s' % (
-                        str(e), ret, stderr))
-    except Exception as e:
-        args.logger.critical('%s:\n - errno = %d: %s' % (
-                        str(e), ret, stderr))
-
-    if undo_kpartx:
-        # Sometimes this fails, especially with overloaded/underpowered
-        # server and "setnodes all".   Early in diagnosis, not sure what
-        # to do about it.   Just move along for now and see what happens
-        cmd = 'kpartx -d %s' % ESP_img
-        ret, stdout, stderr = core_utils.piper(cmd)
-        # assert not ret, cmd
-        if ret or stderr:
-            args.logger.warning('kpartx -d returned %d:\n - %s' % (ret, stderr))
-
-    if do_copy:
-        try:
-            shutil.copy(ESP_img, args.tftp_dir)
-        except OSError:
-            return
-        except Exception as err:
-            msg = ' - ERROR - Unexpected error duing create_SNBU_image:'
-            msg += '\n -- last step duing shutil.copy: %s' % err;
-            update_status(args, msg)
-            return
+    try:    # The image is sparse: the FW hole takes no space
+        create_ESP(args, ESP_img, vmlinuz, cpio, img_size, ESP_offset)
+    except (OSError, ValueError, AssertionError) as e:
+        raise RuntimeError('create_ESP failed: %s' % str(e))
+
+    if getattr(args, 'esp_gzip', False):
+        update_status(args, 'Compressing SNBU SDHC image')
+        with open(ESP_img, 'rb') as src, open(ESP_img + '.gz', 'wb') as f:
+            with compress_utils.ParallelGzipWriter(
+                    f, threads=getattr(args, 'compress_threads', 1),
+                    filename=os.path.basename(ESP_img)) as w:
+                shutil.copyfileobj(src, w, 1 << 20)
+    return ESP_img
+
+
+def publish_ESP(args, ESP_img, ESP_target):
+    """
+        Move the finished image, and its .gz if there is one, into the
+    TFTP directory: a rename if it's the same file system, else a copy
+    that keeps the image sparse.
+    """
+    try:
+        os.replace(ESP_img, ESP_target)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        file_utils.copy_sparse(ESP_img, ESP_target)
+        os.unlink(ESP_img)
+
+    if os.path.isfile(ESP_img + '.gz'):
+        ESP_gzip = ESP_target + '.gz'
+        shutil.move(ESP_img + '.gz', ESP_gzip + '.new')
+        os.replace(ESP_gzip + '.new', ESP_gzip)
 
 #=============================================================================
 # This is just as fast as gzip standalone program and gives better error
-# handling.  500M cpio file takes about 20 seconds for reduction to 180M.
+# handling.  500M cpio file takes about 20 seconds for reduction to 180M
+# on one core; compress_utils.ParallelGzipWriter spreads that over
+# args.compress_threads.
 # Use gzip command's default compression level (6).  For 180M (base) FS:
 # TMAS PXE is about 100 MB / hour xfer then 500 seconds to uncompress
 #          so about two hours to boot
@@ -1078,23 +1209,45 @@ def _is_gzipped(fname):
         raise RuntimeError('Failed in _is_gzipped(%s)! Error: %s' % (fname, err))
 
 
+def _initramfs_writer(args, fileobj, filename):
+    """
+        Compressor for the node initramfs chosen by the manifest field
+    "initramfs_compression" (gzip, xz or zstd, default gzip) and running
+    on args.compress_threads.  The kernel recognizes the format by its
+    magic number, so the file keeps its .cpio.gz name for grub menus.
+    """
+    method = 'gzip'
+    if getattr(args, 'manifest', None) is not None:
+        method = args.manifest.thedict.get('initramfs_compression', method)
+    threads = int(getattr(args, 'compress_threads', 1) or 1)
+    return compress_utils.compressed_writer(
+        fileobj, method=method, threads=threads, filename=filename)
+
+
+@build_profile.profiled
 def compress_bootfiles(args, cpio_file):
     update_status(args, 'Compressing kernel and file system')
+    threads = int(getattr(args, 'compress_threads', 1) or 1)
     vmlinuz_gzip = args.tftp_dir + '/' + args.hostname + '.vmlinuz.gz'
     if _is_gzipped(args.vmlinuz_golden):
         shutil.copy(args.vmlinuz_golden, vmlinuz_gzip)
     else:
         with open(args.vmlinuz_golden, 'rb') as f_in:
-            with gzip.open(vmlinuz_gzip, mode='wb', compresslevel=6) as f_out:
-                shutil.copyfileobj(f_in, f_out)
+            with open(vmlinuz_gzip, 'wb') as f_raw:
+                with compress_utils.ParallelGzipWriter(f_raw, threads=threads,
+                        filename=vmlinuz_gzip) as f_out:
+                    shutil.copyfileobj(f_in, f_out, 1 << 20)
 
-    cpio_gzip = args.tftp_dir + '/' + os.path.basename(cpio_file) + '.gz'
-    if _is_gzipped(cpio_file):
+    cpio_gzip = args.tftp_dir + '/' + args.hostname + '.cpio.gz'
+    if cpio_file == cpio_gzip:      # create_cpio() already streamed it here
+        pass
+    elif _is_gzipped(cpio_file):
         shutil.copy(cpio_file, cpio_gzip)
     else:
         with open(cpio_file, 'rb') as f_in:
-            with gzip.open(cpio_gzip, mode='wb', compresslevel=6) as f_out:
-                shutil.copyfileobj(f_in, f_out)
+            with open(cpio_gzip, 'wb') as f_raw:
+                with _initramfs_writer(args, f_raw, cpio_gzip) as f_out:
+                    shutil.copyfileobj(f_in, f_out, 1 << 20)
 
     return vmlinuz_gzip, cpio_gzip
 
@@ -1110,6 +1263,261 @@ def get_foreign_from_vmd(args):
 #==============================================================================
 
 
+#==============================================================================
+# Nodes bound to the same manifest differ only by what customize_per_node()
+# writes.  Everything before that is kept in an image cache keyed by the
+# golden image, the manifest content and the mirror settings.
+
+# Manifest fields used only by the per-node steps (or not at all).
+_PER_NODE_MANIFEST_KEYS = frozenset((
+    'name', 'description', 'comment', '_comment', 'rclocal', 'kernel_append',
+    'initramfs_compression', 'esp_image'))
+
+
+@build_profile.profiled
+def customize_shared(args, keep_kernel):
+    """
+        The expensive part of a build, identical for every node bound to the
+    same manifest: untar, apt configuration, package installation.
+    Records the boot files it moved to args.build_dir in args.bootfiles.
+    """
+    update_status(args, 'Untar golden image')
+    golden_cache = getattr(args, 'golden_cache', None)
+    with build_profile.stage(args, 'untar'):
+        if golden_cache is None:
+            args.new_fs_dir = core_utils.untar(
+                args.build_dir + '/untar/', args.golden_tar)
+        else:
+            args.new_fs_dir = core_utils.untar_cached(
+                args.build_dir + '/untar/', args.golden_tar, golden_cache)
+
+    # Move kernel that comes with golden image.
+    moved = extract_bootfiles(args, keep_kernel)
+
+    set_foreign_package(args, 'qemu-aarch64-static')
+
+    # Golden image contrived args has no "manifest" attribute.  Besides,
+    # a manifest should not contain distro-specific data structures.
+    cleanup_sources_list(args)
+    set_apt_proxy(args)
+    add_other_mirror(args)
+
+    # Global and account config files
+    set_resolv_conf(args)
+
+    # Before install_packages so postinsts see the real hostname.
+    set_environment(args)
+    set_hostname(args)
+    set_hosts(args)
+    set_client_id(args)
+    set_sudo(args)
+    set_sshkeys(args)
+
+    install_packages(args)
+
+    #Move installed "kernel" from boot/ (if any).
+    moved += extract_bootfiles(args, keep_kernel)
+    assert args.vmlinuz_golden, 'No golden/add-on kernel can be found'
+    args.bootfiles = sorted(set(
+        '%s/%s' % (args.build_dir, os.path.basename(m)) for m in moved))
+
+    persist_initrd(args)
+
+    localhost2torms(args)
+
+
+# Packages whose postinst derives something from the hostname, and how to
+# redo that for a node that got its rootfs from the image cache.  The SSH
+# host keys aren't even hostname-derived: each node just needs its own.
+_REHOST_SCRIPT = """#!/bin/bash
+set -u
+export DEBIAN_FRONTEND=noninteractive
+if dpkg-query -W -f='${Status}' openssh-server 2>/dev/null | grep -q 'ok installed'
+then
+    rm -f /etc/ssh/ssh_host_*
+    dpkg-reconfigure openssh-server || exit 1
+fi
+exit 0
+"""
+
+
+@build_profile.profiled
+def rehost_packages(args):
+    """
+        A cached rootfs was installed under the hostname of the node that
+    built it.  Redo the hostname-dependent parts of package configuration
+    for this one: /etc/mailname and the SSH host keys.
+    """
+    update_status(args, 'Reconfigure hostname-dependent packages')
+    mailname = args.new_fs_dir + '/etc/mailname'
+    if os.path.isfile(mailname):
+        file_utils.write_to_file(mailname, args.hostname)
+
+    rehostsh = '/root/rehost.sh'
+    with open(args.new_fs_dir + rehostsh, 'w') as script:
+        script.write(_REHOST_SCRIPT)
+    os.chmod(args.new_fs_dir + rehostsh, 0o744)
+    try:
+        ret, _, stderr = core_utils.piper('/usr/sbin/chroot %s %s' % (
+            args.new_fs_dir, rehostsh))
+        if ret:
+            raise RuntimeError('chroot %s retval=%d: %s' % (
+                rehostsh, ret, stderr.decode().strip() if stderr else ''))
+    finally:
+        utils.kill_chroot_daemons(args.build_dir)
+        os.unlink(args.new_fs_dir + rehostsh)
+
+
+@build_profile.profiled
+def customize_per_node(args):
+    """
+        The cheap part of a build, applied on top of customize_shared()
+    whether that just ran or came out of the image cache.  A fresh build
+    already has this node's identity; a cached one has that of the node
+    that built it, which is replaced here.
+    """
+    if getattr(args, 'image_cache_hit', False):
+        cleanup_sources_list(args)
+        set_environment(args)
+        set_hostname(args)
+        set_hosts(args)
+        set_client_id(args)
+        rehost_packages(args)
+    hack_LFS_autostart(args)    # Temporary; must come before...
+    rewrite_rclocal(args)
+
+
+def image_cache_key(args):
+    """
+        SHA256 over everything customize_shared() depends on.
+
+    :return: [str] hex digest.  Raise RuntimeError on problems.
+    """
+    manifest = dict(getattr(args.manifest, 'thedict', None) or {})
+    for key in _PER_NODE_MANIFEST_KEYS:
+        manifest.pop(key, None)
+
+    tmconfig = getattr(args, 'tmconfig', None)
+    if tmconfig is not None:
+        try:
+            with open(tmconfig, 'rb') as f:
+                tmconfig = hashlib.sha256(f.read()).hexdigest()
+        except OSError as err:
+            raise RuntimeError('Cannot hash "%s": %s' % (tmconfig, str(err)))
+
+    keyed = {
+        'golden':   core_utils.hash_file(args.golden_tar),
+        'manifest': manifest,
+        'mirrors':  (args.repo_mirror, args.repo_release, args.repo_areas,
+                     getattr(args, 'other_mirrors', None)),
+        'tmconfig': tmconfig,
+    }
+    keyed = json.dumps(keyed, sort_keys=True).encode()
+    return hashlib.sha256(keyed).hexdigest()
+
+
+@contextlib.contextmanager
+def image_cache_entry(args):
+    """
+        Yield the image cache entry path for this build while holding its
+    lock, so a second node bound to the same manifest waits for the first
+    build and then reuses it.  Yields None when there is no cache.
+    """
+    if getattr(args, 'image_cache', None) is None or args.is_golden:
+        yield None
+        return
+
+    entry = '%s/%s' % (args.image_cache, image_cache_key(args))
+    file_utils.make_dir(args.image_cache)
+    with open(entry + '.lock', 'w') as lockobj:
+        update_status(args, 'Locking image cache entry %s' %
+            os.path.basename(entry))
+        with build_profile.stage(args, 'image_cache_lock'):
+            fcntl.flock(lockobj, fcntl.LOCK_EX)     # released on close
+        yield entry
+
+
+@build_profile.profiled
+def restore_cached_image(args, entry):
+    """
+        Stand in for customize_shared(): clone the cached rootfs and copy
+    the boot files it extracted.
+    """
+    update_status(args, 'Reusing cached image %s' % os.path.basename(entry))
+    os.utime(entry)     # LRU
+    args.new_fs_dir = core_utils.clone_tree(
+        entry + '/rootfs', args.build_dir + '/untar/')
+    args.bootfiles = []
+    args.vmlinuz_golden = ''
+    for source in sorted(glob.glob(entry + '/boot/*')):
+        dest = '%s/%s' % (args.build_dir, os.path.basename(source))
+        file_utils.copy_target_into(source, dest)
+        args.bootfiles.append(dest)
+        if '/vmlinuz' in dest:
+            args.vmlinuz_golden = dest
+    assert args.vmlinuz_golden, 'Cached image %s has no kernel' % entry
+
+
+@build_profile.profiled
+def save_cached_image(args, entry):
+    """
+        Store the result of customize_shared() under "entry", then trim the
+    cache to args.image_cache_entries.  Caching is an optimization; its
+    failures are logged but don't fail the build.
+    """
+    update_status(args, 'Saving image cache entry %s' % os.path.basename(entry))
+    staging = entry + '.new'
+    try:
+        file_utils.remove_target(staging)
+        os.makedirs(staging + '/boot')
+        core_utils.clone_tree(args.new_fs_dir, staging + '/rootfs')
+        for source in args.bootfiles:
+            shutil.copy2(source, staging + '/boot')
+        os.rename(staging, entry)
+    except Exception as err:
+        args.logger.warning('Cannot save image cache entry: %s' % str(err))
+        return
+
+    keep = int(getattr(args, 'image_cache_entries', 0) or 0)
+    entries = [e for e in glob.glob(args.image_cache + '/*')
+               if os.path.isdir(e) and not e.endswith('.new')]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for stale in entries[max(keep, 1):]:
+        with open(stale + '.lock', 'w') as lockobj:
+            try:    # Skip entries that are being restored right now
+                fcntl.flock(lockobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+            update_status(args, 'Evicting image cache entry %s' %
+                os.path.basename(stale))
+            file_utils.remove_target(stale)
+        # The lock file stays: unlinking it while another build has it open
+        # (waiting in image_cache_entry) would let two builds own the entry.
+
+
+def write_build_report(args, response, status):
+    '''
+        The stage profile of this build, next to status.json, for the
+    /api/node/<coord>/profile route and for comparing builds.
+    '''
+    if getattr(args, 'dryrun', False):
+        return
+    report_dir = getattr(args, 'tftp_dir', None) or args.build_dir
+    try:
+        args.profile.write(
+            '%s/%s' % (report_dir, build_profile.REPORT),
+            hostname=args.hostname,
+            node_coord=getattr(args, 'node_coord', None),
+            manifest=getattr(getattr(args, 'manifest', None),
+                             'namespace', None),
+            golden=os.path.basename(getattr(args, 'golden_tar', '') or ''),
+            image_cache_hit=getattr(args, 'image_cache_hit', None),
+            status=status,
+            message=response['message'])
+    except Exception as err:    # Never worth failing a build over
+        args.logger.warning('Cannot write build report: %s' % str(err))
+
+
 def execute(args):
     """
         Customize Filesystem image: set hostname, cleanup sources.list,
@@ -1146,7 +1554,12 @@ def execute(args):
 
     logger = getattr(args, 'logger', None)
 
-    if not args.debug:
+    # A BuildScheduler child is already off on its own and must return here.
+    detach = getattr(args, 'detach', None)
+    if detach is None:
+        detach = not args.debug
+
+    if detach:
         # Ass-u-me I am the first child in a fork-setsid-fork daemon chain
         try:
             os.chdir('/tmp')
@@ -1186,45 +1599,20 @@ def execute(args):
     args.logger = logger
 
     args.logger('--- Starting image build for %s --- ' % args.hostname)
+    args.profile = build_profile.BuildProfile()
     # It's a big try block because individual exception handling
     # is done inside those functions that throw RuntimeError.
     # When some of them fail they'll handle last update_status themselves.
     try:
-        update_status(args, 'Untar golden image')
-        args.new_fs_dir = core_utils.untar(args.build_dir + '/untar/', args.golden_tar)
-
-        # Move kernel that comes with golden image.
-        extract_bootfiles(args, is_keep_kernel)
-
-        set_foreign_package(args, 'qemu-aarch64-static')
-
-        # Golden image contrived args has no "manifest" attribute.  Besides,
-        # a manifest should not contain distro-specific data structures.
-        cleanup_sources_list(args)
-        set_apt_proxy(args)
-        add_other_mirror(args)
-
-        # Global and account config files
-        set_resolv_conf(args)
-
-        set_environment(args)
-        set_hostname(args)
-        set_hosts(args)
-        set_client_id(args)
-        set_sudo(args)
-        set_sshkeys(args)
-
-        install_packages(args)
-
-        #Move installed "kernel" from boot/ (if any).
-        extract_bootfiles(args, is_keep_kernel)
-        assert args.vmlinuz_golden, 'No golden/add-on kernel can be found'
-
-        persist_initrd(args)
-
-        localhost2torms(args)
-        hack_LFS_autostart(args)    # Temporary; must come before...
-        rewrite_rclocal(args)
+        with image_cache_entry(args) as entry:
+            args.image_cache_hit = entry is not None and os.path.isdir(entry)
+            if args.image_cache_hit:
+                restore_cached_image(args, entry)
+            else:
+                customize_shared(args, is_keep_kernel)
+                if entry is not None:
+                    save_cached_image(args, entry)
+        customize_per_node(args)
 
         #------------------------------------------------------------------
 
@@ -1234,7 +1622,10 @@ def execute(args):
         else:
             cpio_file = create_cpio(args)
             vmlinuz_gzip, cpio_gzip = compress_bootfiles(args, cpio_file)
-            create_SNBU_image(args, vmlinuz_gzip, cpio_gzip)
+            if getattr(args, 'esp_image', False):
+                create_SNBU_image(args, vmlinuz_gzip, cpio_gzip)
+            else:   # Built on first download, see web_node_send_ESP()
+                remove_SNBU_image(args)
 
             # Free up space someday, but not during active development
             # remove_target(args.build_dir)
@@ -1265,8 +1656,9 @@ def execute(args):
         status = 'error'
 
     args.logger.propagate = True   # push final messages to root logger
+    write_build_report(args, response, status)
     update_status(args, response, status)
-    if not args.debug:  # I am the grandhild; release the wait() by init()
+    if detach:  # I am the grandhild; release the wait() by init()
         args.logger.debug('Closing the build child.')
         os._exit(0)     # RTFM: this is the preferred exit after fork()
 
@@ -0,0 +1,172 @@
+#!/usr/bin/python3 -tt
+'''
+    Package relationships of a mirror, indexed for quick answers to "what
+does this manifest really install?".  Built once per package index
+generation from its Depends, Pre-Depends, Provides, Conflicts and Breaks
+fields; resolve() is then a walk over dictionaries.  Like apt, the first
+satisfiable alternative of an "a | b" dependency is taken (preferring one
+already chosen), and only unversioned Provides satisfy a dependency.
+'''
+
+import collections
+import re
+import time
+
+from debian.debian_support import version_compare
+
+from pdb import set_trace
+
+# name[:archqual] [(op version)] [arch list] [<profiles>]
+_RELATION = re.compile(
+    r'^\s*([^\s:(\[<]+)(?::\S+)?\s*(?:\(\s*([<>=]+)\s*([^)\s]+)\s*\))?')
+
+_OPS = {
+    '<<': lambda c: c < 0,
+    '<':  lambda c: c <= 0,     # deprecated spelling of <=
+    '<=': lambda c: c <= 0,
+    '=':  lambda c: c == 0,
+    '>=': lambda c: c >= 0,
+    '>':  lambda c: c >= 0,     # deprecated spelling of >=
+    '>>': lambda c: c > 0,
+}
+
+
+def parse_relations(text):
+    '''"a (>= 1) | b, c" -> [ [('a', '>=', '1'), ('b', None, None)], ... ]'''
+    groups = []
+    for group in (text or '').split(','):
+        alternatives = []
+        for alt in group.split('|'):
+            m = _RELATION.match(alt)
+            if m:
+                alternatives.append(m.groups())
+        if alternatives:
+            groups.append(alternatives)
+    return groups
+
+
+def _format(alternatives):
+    return ' | '.join(
+        name if op is None else '%s (%s %s)' % (name, op, version)
+        for name, op, version in alternatives)
+
+
+class DependencyGraph(object):
+
+    def __init__(self, packages):
+        '''
+        :param 'packages': iterable of dicts with Debian field names, one
+                           per package, eg, PackageIndex.values().
+        '''
+        start = time.time()
+        self._versions = {}
+        self._sizes = {}
+        self._depends = {}
+        self._provides = collections.defaultdict(set)   # virtual: real
+        self._virtuals = collections.defaultdict(list)  # real: virtuals
+        self._rdepends = collections.defaultdict(set)   # name: dependers
+        self._rconflicts = collections.defaultdict(list)
+        for pkg in packages:
+            name = pkg['Package']
+            self._versions[name] = pkg.get('Version', '')
+            self._sizes[name] = (pkg.get('Size', 0) or 0,
+                                 pkg.get('Installed-Size', 0) or 0)
+            depends = parse_relations(pkg.get('Pre-Depends', None)) + \
+                parse_relations(pkg.get('Depends', None))
+            self._depends[name] = depends
+            for group in depends:
+                for dep, _, _ in group:
+                    self._rdepends[dep].add(name)
+            for group in parse_relations(pkg.get('Provides', None)):
+                virtual, op, _ = group[0]
+                if op is None:
+                    self._provides[virtual].add(name)
+                    self._virtuals[name].append(virtual)
+            for field in ('Conflicts', 'Breaks'):
+                for group in parse_relations(pkg.get(field, None)):
+                    for relation in group:
+                        self._rconflicts[relation[0]].append((name, relation))
+        self.build_seconds = round(time.time() - start, 3)
+
+    def __len__(self):
+        return len(self._versions)
+
+    def __contains__(self, name):
+        return name in self._versions or name in self._provides
+
+    def reverse_depends(self, name):
+        '''Packages with a Depends or Pre-Depends on "name".'''
+        return sorted(self._rdepends.get(name, ()))
+
+    def _satisfies(self, name, op, version):
+        '''Real package names that satisfy one relation.'''
+        if name in self._versions and (op is None or _OPS[op](
+                version_compare(self._versions[name], version))):
+            return [ name ]
+        if op is None:
+            return sorted(self._provides.get(name, ()))
+        return []
+
+    def _choose(self, alternatives, chosen):
+        candidates = []
+        for relation in alternatives:
+            candidates.extend(self._satisfies(*relation))
+        for c in candidates:
+            if c in chosen:
+                return c
+        return candidates[0] if candidates else None
+
+    def resolve(self, names):
+        '''
+            Dependency closure of "names".
+        :return: [dict] 'packages' (sorted closure), 'missing' and
+                 'conflicts' (lists of dicts), 'download_size' and
+                 'installed_size' in bytes, 'seconds' taken.
+        '''
+        start = time.time()
+        required_by = collections.OrderedDict()     # name: who pulled it in
+        missing = []
+        queue = collections.deque()
+        for name in names:
+            pick = self._choose([(name, None, None)], required_by)
+            if pick is None:
+                missing.append({ 'dependency': name, 'required_by': None })
+            elif pick not in required_by:
+                required_by[pick] = None
+                queue.append(pick)
+
+        while queue:
+            name = queue.popleft()
+            for group in self._depends.get(name, ()):
+                pick = self._choose(group, required_by)
+                if pick is None:
+                    missing.append({ 'dependency': _format(group),
+                                     'required_by': name })
+                elif pick not in required_by:
+                    required_by[pick] = name
+                    queue.append(pick)
+
+        conflicts = []
+        for name in required_by:
+            for target in [ name ] + self._virtuals.get(name, []):
+                for declarer, relation in self._rconflicts.get(target, ()):
+                    if declarer == name or declarer not in required_by:
+                        continue
+                    if target == name and name not in self._satisfies(
+                            *relation):
+                        continue    # Versioned, and this version is fine
+                    if target != name and relation[1] is not None:
+                        continue    # Versioned virtual never matches
+                    conflicts.append({ 'package': declarer,
+                                       'conflicts': _format([ relation ]),
+                                       'with': name })
+
+        return {
+            'packages':       sorted(required_by),
+            'required_by':    dict((k, v) for k, v in required_by.items() if v),
+            'missing':        missing,
+            'conflicts':      conflicts,
+            'download_size':  sum(self._sizes[n][0] for n in required_by),
+            'installed_size': sum(self._sizes[n][1] for n in required_by) << 10,
+            'seconds':        round(time.time() - start, 4),
+        }
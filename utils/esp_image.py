@@ -0,0 +1,346 @@
+#!/usr/bin/python3 -tt
+'''
+    Build a GPT disk image holding one EFI System Partition (FAT32) entirely
+in userspace: no parted, kpartx, loop devices, mkfs.vfat or mount, so it
+needs no root and any number of nodes can be built at once.  Only standard
+python3 libraries.
+
+The image starts as a sparse file of zeros.  Only the GPT, the FAT32
+reserved sectors, the used part of each FAT, the directories and the file
+data are written; everything else stays a hole.  Files are laid out in
+contiguous clusters; directories get one cluster each and grow a chain if
+they need more.  Names that aren't plain upper case 8.3 get VFAT long name
+entries, as Linux would write them.
+'''
+
+import os
+import struct
+import time
+import uuid
+import zlib
+
+from pdb import set_trace
+
+SECTOR = 512
+
+_ESP_TYPE = uuid.UUID('C12A7328-F81F-11D2-BA4B-00A0C93EC93B')
+
+_GPT_ENTRIES = 128
+_GPT_ENTRY_SIZE = 128
+_GPT_ENTRY_SECTORS = _GPT_ENTRIES * _GPT_ENTRY_SIZE // SECTOR  # 32
+_GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')   # 92 bytes
+_GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+
+_RESERVED = 32          # Sectors: boot, FSInfo, ..., backup boot, FSInfo
+_BACKUP_BOOT = 6
+_MIN_CLUSTERS = 65525   # Fewer than this and it's FAT16 by definition
+_EOC = 0x0FFFFFFF
+_MEDIA = 0xF8
+
+_ATTR_DIRECTORY = 0x10
+_ATTR_ARCHIVE = 0x20
+_ATTR_VOLUME_ID = 0x08
+_ATTR_LONG_NAME = 0x0F
+
+_DIRENT = struct.Struct('<11sBBBHHHHHHHI')          # 32 bytes
+_LFN = struct.Struct('<B10sBBB12sH4s')              # 32 bytes
+_SHORT_OK = set('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789!#$%&\'()-@^_`{}~')
+
+_CHUNK = 1 << 20
+
+
+def _dos_datetime(when=None):
+    t = time.localtime(when)
+    return (((max(t.tm_year, 1980) - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+            (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2))
+
+
+def _lfn_checksum(short):
+    total = 0
+    for c in short:
+        total = (((total & 1) << 7) + (total >> 1) + c) & 0xFF
+    return total
+
+
+def short_name(name, taken=()):
+    '''
+        8.3 directory name for "name", avoiding the 11-byte names in "taken".
+    :return: (bytes(11), bool) the second is True if it needs a long name.
+    '''
+    base, dot, ext = name.rpartition('.')
+    if not base:                    # No extension (or a leading dot)
+        base, ext = name, ''
+    clean = lambda s: ''.join(c if c in _SHORT_OK else '_'
+                              for c in s.upper() if c not in ' .')
+    sbase, sext = clean(base), clean(ext)[:3]
+    if (len(base) <= 8 and len(ext) <= 3 and sbase == base and
+            clean(ext) == ext and sbase):
+        short = (sbase.ljust(8) + sext.ljust(3)).encode('ascii')
+        if short not in taken:
+            return short, False
+    for n in range(1, 1000000):
+        tail = '~%d' % n
+        short = ((sbase[:8 - len(tail)] + tail).ljust(8) +
+                 sext.ljust(3)).encode('ascii')
+        if short not in taken:
+            return short, True
+    raise ValueError('No short name left for %s' % name)
+
+
+def _lfn_entries(name, short):
+    '''Long name entries for "name", in the order they go on disk.'''
+    encoded = name.encode('utf-16-le')
+    if len(encoded) > 255 * 2:
+        raise ValueError('Name too long: %s' % name)
+    if len(encoded) % 26:
+        encoded += b'\0\0'
+        encoded += b'\xff' * (-len(encoded) % 26)
+    checksum = _lfn_checksum(short)
+    pieces = [ encoded[i:i + 26] for i in range(0, len(encoded), 26) ]
+    entries = []
+    for seq, piece in enumerate(pieces, 1):
+        if seq == len(pieces):
+            seq |= 0x40
+        entries.append(_LFN.pack(seq, piece[:10], _ATTR_LONG_NAME, 0,
+                                 checksum, piece[10:22], 0, piece[22:]))
+    return entries[::-1]
+
+
+def _dirent(short, attr, cluster, size, stamp):
+    date, dtime = stamp
+    return _DIRENT.pack(short, attr, 0, 0, dtime, date, date,
+                        cluster >> 16, dtime, date, cluster & 0xFFFF, size)
+
+
+class _Directory(object):
+
+    def __init__(self, cluster, parent):
+        self.cluster = cluster
+        self.clusters = [ cluster ]
+        self.parent = parent
+        self.entries = []       # 32-byte records
+        self.children = {}      # upper case long name: _Directory or None
+        self.shorts = set()
+
+
+class FAT32(object):
+    '''
+        A FAT32 file system written into "sectors" sectors of an open, zeroed
+    file descriptor, starting at byte "offset".  Add directories and files,
+    then close() to write the FATs, directories and boot sectors.
+    '''
+
+    def __init__(self, fd, offset, sectors, label='ESP', hidden=0, when=None):
+        self._fd = fd
+        self._offset = offset
+        self._sectors = sectors
+        self._hidden = hidden
+        self._label = label.upper()[:11]
+        self._stamp = _dos_datetime(when)
+        # mkfs.fat picks 512 byte clusters below 260M, 4K up to 8G.
+        self._spc = 1 if sectors < 532480 else 8
+        fatsz = 1
+        while True:
+            data = sectors - _RESERVED - 2 * fatsz
+            clusters = data // self._spc
+            need = -(-(clusters + 2) * 4 // SECTOR)
+            if need <= fatsz:
+                break
+            fatsz = need
+        if clusters < _MIN_CLUSTERS:
+            raise ValueError('%d sectors is too small for FAT32' % sectors)
+        self._fatsz = fatsz
+        self._clusters = clusters
+        self._cluster_bytes = self._spc * SECTOR
+        self._data_start = offset + (_RESERVED + 2 * fatsz) * SECTOR
+        self._fat = [ 0x0FFFFF00 | _MEDIA, _EOC ]
+        self._next = 2
+        self.root = _Directory(self._allocate(1), None)
+        self.root.entries.append(_dirent(self._label.ljust(11).encode(
+            'ascii', 'replace'), _ATTR_VOLUME_ID, 0, 0, self._stamp))
+
+    @property
+    def free_clusters(self):
+        return self._clusters + 2 - self._next
+
+    def _allocate(self, count):
+        '''Chain "count" contiguous clusters, return the first.'''
+        if count > self.free_clusters:
+            raise OSError(28, 'No space left in FAT32 image')
+        first = self._next
+        self._next += count
+        self._fat.extend(range(first + 1, first + count))
+        self._fat.append(_EOC)
+        return first
+
+    def _cluster_offset(self, cluster):
+        return self._data_start + (cluster - 2) * self._cluster_bytes
+
+    def _add_entry(self, directory, name, attr, cluster, size):
+        if not name or name in ('.', '..') or '/' in name or '\\' in name:
+            raise ValueError('Bad file name "%s"' % name)
+        if name.upper() in directory.children:
+            raise FileExistsError(name)
+        short, needs_lfn = short_name(name, directory.shorts)
+        directory.shorts.add(short)
+        if needs_lfn:
+            directory.entries.extend(_lfn_entries(name, short))
+        directory.entries.append(_dirent(
+            short, attr, cluster, size, self._stamp))
+
+    def _lookup(self, path, create=False):
+        directory = self.root
+        for name in [ p for p in path.split('/') if p ]:
+            child = directory.children.get(name.upper())
+            if child is None:
+                if not create or name.upper() in directory.children:
+                    raise NotADirectoryError(path)
+                child = self._mkdir(directory, name)
+            directory = child
+        return directory
+
+    def _mkdir(self, parent, name):
+        child = _Directory(self._allocate(1), parent)
+        self._add_entry(parent, name, _ATTR_DIRECTORY, child.cluster, 0)
+        parent.children[name.upper()] = child
+        dotdot = 0 if parent is self.root else parent.cluster
+        child.entries.append(_dirent(b'.          ', _ATTR_DIRECTORY,
+                                     child.cluster, 0, self._stamp))
+        child.entries.append(_dirent(b'..         ', _ATTR_DIRECTORY,
+                                     dotdot, 0, self._stamp))
+        return child
+
+    def mkdir(self, path):
+        '''Make a directory and any missing parents, like "mkdir -p".'''
+        self._lookup(path, create=True)
+
+    def add_file(self, path, source):
+        '''
+            Copy a local file (by name) or content (bytes) to "path",
+        making parent directories as needed.
+        '''
+        dirname, _, name = path.rstrip('/').rpartition('/')
+        directory = self._lookup(dirname, create=True)
+        if isinstance(source, (bytes, bytearray)):
+            size = len(source)
+        else:
+            size = os.stat(source).st_size
+        if size >= 1 << 32:
+            raise ValueError('%s is too big for FAT32' % path)
+        count = -(-size // self._cluster_bytes)
+        first = self._allocate(count) if count else 0
+        self._add_entry(directory, name, _ATTR_ARCHIVE, first, size)
+        directory.children[name.upper()] = None
+        if not count:
+            return
+        position = self._cluster_offset(first)
+        if isinstance(source, (bytes, bytearray)):
+            os.pwrite(self._fd, source, position)
+            return
+        with open(source, 'rb') as f:
+            while True:
+                data = f.read(_CHUNK)
+                if not data:
+                    break
+                os.pwrite(self._fd, data, position)
+                position += len(data)
+
+    def _write_directory(self, directory):
+        data = b''.join(directory.entries)
+        need = max(1, -(-len(data) // self._cluster_bytes))
+        more = need - len(directory.clusters)
+        if more > 0:                            # Chain on more clusters
+            extra = self._allocate(more)
+            self._fat[directory.clusters[-1]] = extra
+            directory.clusters.extend(range(extra, extra + more))
+        for i, cluster in enumerate(directory.clusters):
+            chunk = data[i * self._cluster_bytes:(i + 1) * self._cluster_bytes]
+            if chunk:
+                os.pwrite(self._fd, chunk, self._cluster_offset(cluster))
+        for child in directory.children.values():
+            if child is not None:
+                self._write_directory(child)
+
+    def close(self):
+        self._write_directory(self.root)
+        fat = struct.pack('<%dI' % len(self._fat), *self._fat)
+        for i in range(2):
+            os.pwrite(self._fd, fat, self._offset +
+                      (_RESERVED + i * self._fatsz) * SECTOR)
+
+        boot = bytearray(SECTOR)
+        struct.pack_into('<3s8sHBHBHHBHHHII', boot, 0,
+            b'\xeb\x58\x90', b'mkfs.fat', SECTOR, self._spc, _RESERVED, 2,
+            0, 0, _MEDIA, 0, 32, 64, self._hidden, self._sectors)
+        struct.pack_into('<IHHIHH', boot, 36,
+            self._fatsz, 0, 0, self.root.cluster, 1, _BACKUP_BOOT)
+        serial = zlib.crc32(uuid.uuid4().bytes)
+        struct.pack_into('<BBBI11s8s', boot, 64,
+            0x80, 0, 0x29, serial,
+            self._label.ljust(11).encode('ascii', 'replace'), b'FAT32   ')
+        boot[510:512] = b'\x55\xaa'
+
+        fsinfo = bytearray(SECTOR)
+        struct.pack_into('<I', fsinfo, 0, 0x41615252)
+        struct.pack_into('<III', fsinfo, 484,
+            0x61417272, self.free_clusters, self._next)
+        struct.pack_into('<I', fsinfo, 508, 0xAA550000)
+
+        for sector in (0, _BACKUP_BOOT):
+            os.pwrite(self._fd, bytes(boot) + bytes(fsinfo),
+                      self._offset + sector * SECTOR)
+
+
+def write_gpt(fd, size, first_lba, last_lba, name, disk_guid=None):
+    '''
+        Protective MBR, primary and backup GPT with one EFI System Partition
+    from first_lba to last_lba inclusive, named "name".
+    '''
+    sectors = size // SECTOR
+    disk_guid = disk_guid or uuid.uuid4()
+    entries = bytearray(_GPT_ENTRIES * _GPT_ENTRY_SIZE)
+    _GPT_ENTRY.pack_into(entries, 0, _ESP_TYPE.bytes_le, uuid.uuid4().bytes_le,
+        first_lba, last_lba, 0, name.encode('utf-16-le')[:72])
+    entries_crc = zlib.crc32(entries)
+
+    def header(mine, alternate, entries_lba):
+        fields = [ b'EFI PART', 0x00010000, _GPT_HEADER.size, 0, 0,
+                   mine, alternate, 2 + _GPT_ENTRY_SECTORS,
+                   sectors - 2 - _GPT_ENTRY_SECTORS, disk_guid.bytes_le,
+                   entries_lba, _GPT_ENTRIES, _GPT_ENTRY_SIZE, entries_crc ]
+        fields[3] = zlib.crc32(_GPT_HEADER.pack(*fields))
+        return _GPT_HEADER.pack(*fields).ljust(SECTOR, b'\0')
+
+    mbr = bytearray(SECTOR)
+    struct.pack_into('<B3sB3sII', mbr, 446, 0, b'\x00\x02\x00', 0xEE,
+        b'\xff\xff\xff', 1, min(sectors - 1, 0xFFFFFFFF))
+    mbr[510:512] = b'\x55\xaa'
+    os.pwrite(fd, bytes(mbr) + header(1, sectors - 1, 2) + entries, 0)
+
+    backup = sectors - 1 - _GPT_ENTRY_SECTORS
+    os.pwrite(fd, entries + header(sectors - 1, 1, backup), backup * SECTOR)
+
+
+def build_ESP(path, files, size=384 << 20, offset=129 << 20,
+              name='ESP', label='ESP'):
+    '''
+        Create "path" as a sparse GPT disk image of "size" bytes with an
+    EFI System Partition from "offset" to the end.
+    :param 'files': [ (ESP path, source), ... ] where source is a local
+                    file name or the content as bytes.
+    :param 'name': [str] GPT partition name, eg, the hostname.
+    '''
+    assert not offset % SECTOR and not size % SECTOR, 'Sector alignment'
+    first_lba = offset // SECTOR
+    last_lba = size // SECTOR - 2 - _GPT_ENTRY_SECTORS - 1
+    assert first_lba >= 2 + _GPT_ENTRY_SECTORS and first_lba < last_lba, \
+        'ESP offset %d does not fit in %d bytes' % (offset, size)
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        fd = f.fileno()
+        write_gpt(fd, size, first_lba, last_lba, name)
+        fs = FAT32(fd, offset, last_lba + 1 - first_lba, label=label,
+                   hidden=first_lba)
+        for esp_path, source in files:
+            fs.add_file(esp_path, source)
+        fs.close()
@@ -69,6 +69,44 @@ def copy_target_into(target, into, verbose=False):
         raise RuntimeError(msg)
 
 
+def copy_sparse(source, destination, blocksize=1 << 20):
+    """
+        Copy a file without filling in its holes: only the data extents
+    (found with SEEK_DATA/SEEK_HOLE) are read and written, the rest of the
+    copy stays unallocated.  Written as destination.new, then renamed.
+
+    :return: [int] bytes of data copied.  Raise OSError on problems.
+    """
+    copied = 0
+    tmp = destination + '.new'
+    with open(source, 'rb') as src, open(tmp, 'wb') as dst:
+        infd, outfd = src.fileno(), dst.fileno()
+        size = os.fstat(infd).st_size
+        offset = 0
+        while offset < size:
+            try:
+                data = os.lseek(infd, offset, os.SEEK_DATA)
+                hole = os.lseek(infd, data, os.SEEK_HOLE)
+            except OSError as err:
+                if err.errno == errno.ENXIO:    # Only a hole is left
+                    break
+                if err.errno != errno.EINVAL:
+                    raise
+                data, hole = offset, size       # No SEEK_DATA on this FS
+            while data < hole:
+                chunk = os.pread(infd, min(blocksize, hole - data), data)
+                if not chunk:
+                    break
+                os.pwrite(outfd, chunk, data)
+                data += len(chunk)
+                copied += len(chunk)
+            offset = hole
+        os.ftruncate(outfd, size)
+    shutil.copystat(source, tmp)
+    os.replace(tmp, destination)
+    return copied
+
+
 def move_target(target, into, verbose=False):
     """
         Move target folder into new folder. NOTE: target will be removed!
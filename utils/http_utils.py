@@ -0,0 +1,139 @@
+#!/usr/bin/python3 -tt
+'''
+    Serve big build artifacts (node ESP images) without reading them into
+memory: ETag from the file's inode, size and mtime, If-None-Match/304,
+single byte Range/206 with If-Range so interrupted downloads resume.
+Artifacts are published by rename(), so any new content has a new inode
+and mtime: the ETag is strong without reading a byte of the file.
+
+A WSGI application never sees the socket, so os.sendfile() isn't possible
+here.  A whole file goes to the server's wsgi.file_wrapper instead (waitress
+streams it from its I/O loop, not a request thread); a range is read in
+chunks with os.pread().
+'''
+
+import os
+import re
+
+import flask
+import werkzeug.wsgi
+
+from pdb import set_trace
+
+_CHUNK = 1 << 20
+
+_RANGE = re.compile(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def file_etag(path, st=None):
+    '''Quoted ETag of a file from its stat(), see the module docstring.'''
+    if st is None:
+        st = os.stat(path)
+    return '"%x-%x-%x"' % (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def etag_matches(header, etag):
+    '''If-None-Match: "*" or a list of tags, weak comparison (RFC 7232).'''
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    tags = [ t.strip() for t in header.split(',') ]
+    return etag in [ t[2:] if t.startswith('W/') else t for t in tags ]
+
+
+def if_range_matches(header, etag):
+    '''
+        If-Range: one tag, strong comparison (RFC 7233), so a W/ tag never
+    matches, nor does a date.  Either way the whole file is sent.
+    '''
+    return header.strip() == etag and not etag.startswith('W/')
+
+
+def parse_range(header, size):
+    '''
+        One "bytes=" range of a file.
+    :return: (first, last) inclusive, or None to send the whole file
+             (no header, several ranges, or nonsense).
+    :raise: ValueError if the range can't be satisfied (416).
+    '''
+    m = _RANGE.match(header or '')
+    if m is None:
+        return None
+    first, last = m.groups()
+    if not first:
+        if not last:
+            return None
+        length = int(last)          # Suffix: the last N bytes
+        if not length or not size:
+            raise ValueError('Empty suffix range')
+        return (max(0, size - length), size - 1)
+    first = int(first)
+    if first >= size:
+        raise ValueError('Range starts past the end')
+    if not last:
+        return (first, size - 1)
+    if int(last) < first:
+        return None                 # "5-3" is invalid, ignore it
+    return (first, min(int(last), size - 1))
+
+
+def _read_range(path, first, last):
+    with open(path, 'rb') as f:
+        fd = f.fileno()
+        offset = first
+        while offset <= last:
+            data = os.pread(fd, min(_CHUNK, last + 1 - offset), offset)
+            if not data:
+                break
+            offset += len(data)
+            yield data
+
+
+def send_artifact(path, mimetype, download_name=None):
+    '''
+        Flask response for a GET/HEAD of "path", honoring If-None-Match,
+    Range and If-Range.  Raises FileNotFoundError.
+    '''
+    request = flask.request
+    st = os.stat(path)
+    etag = file_etag(path, st)
+    size = st.st_size
+    headers = {
+        'ETag': etag,
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'no-cache',    # Revalidate; ETag makes that cheap
+    }
+    if download_name is not None:
+        headers['Content-Disposition'] = \
+            'attachment; filename="%s"' % download_name
+
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        return flask.Response(status=304, headers=headers)
+
+    byterange = None
+    if_range = request.headers.get('If-Range')
+    if if_range is None or if_range_matches(if_range, etag):
+        try:
+            byterange = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            headers['Content-Range'] = 'bytes */%d' % size
+            return flask.Response(status=416, headers=headers)
+
+    if byterange is None:
+        status = 200
+        headers['Content-Length'] = str(size)
+        body = werkzeug.wsgi.wrap_file(
+            request.environ, open(path, 'rb'), _CHUNK)
+    else:
+        status = 206
+        first, last = byterange
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+        headers['Content-Length'] = str(last + 1 - first)
+        body = _read_range(path, first, last)
+    if request.method == 'HEAD':
+        if hasattr(body, 'close'):
+            body.close()
+        body = []
+    return flask.Response(body, status=status, headers=headers,
+                          mimetype=mimetype, direct_passthrough=True)
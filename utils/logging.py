@@ -131,7 +131,8 @@ class tmmsLogger(object):   # FIXME: how about subclassing getLogger?
 
 
     # Behave like a regular logging.info, logging.error and etc
-    _okattr = frozenset(('debug', 'info', 'warning', 'error', 'critical'))
+    _okattr = frozenset(('debug', 'info', 'warning', 'error', 'critical',
+                         'isEnabledFor'))
     def __getattr__(self, attr):
         if self._logger is None:
             raise RuntimeError('This logger is unconfigured!')
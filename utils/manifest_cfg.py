@@ -1,9 +1,20 @@
 #!/usr/bin/python3
+import bisect
+import collections
+import hashlib
 import os
 import flask
 import json
+import shutil
+import tempfile
+import threading
+import time
 import werkzeug
 
+from tmms.utils import compress_utils
+
+_LAST = '\U0010ffff'    # Sorts after any character of a namespace
+
 
 class ManifestDestiny(object):
 
@@ -24,7 +35,15 @@ class ManifestDestiny(object):
         molegal = legal.union(frozenset((    # Optional
             'comment', '_comment', 'privkey', 'pubkey',
             'l4tm_privkey', 'l4tm_pubkey',              # Deprecated
-            'postinst', 'rclocal', 'kernel_append')))
+            'postinst', 'rclocal', 'kernel_append',
+            'initramfs_compression', 'esp_image')))
+
+        compression = m.get('initramfs_compression', 'gzip')
+        assert compression in compress_utils.METHODS, \
+            'initramfs_compression must be one of ' + \
+            ', '.join(compress_utils.METHODS)
+        assert isinstance(m.get('esp_image', False), bool), \
+            'esp_image must be true or false'
 
         #NO NEED TO BE STRICT ANYMORE
         #illegal = list(keys - molegal - frozenset((_UPFROM, )))
@@ -44,11 +63,26 @@ class ManifestDestiny(object):
         assert not nosuch, 'no such task(s): ' + ', '.join(nosuch)
 
 
+    def resolve_dependencies(self):
+        '''
+            Everything apt-get will install for this manifest, from the
+        package index: the packages named directly and by its tasks and all
+        their Depends and Pre-Depends.  URL packages are not in any index.
+        '''
+        blueprints = self.BP.mainapp.blueprints
+        names = [ pkg for pkg in self.thedict['packages'] if
+                  not pkg.startswith(('http://', 'https://', 'file:///')) ]
+        for task in self.thedict['tasks']:
+            names.extend(blueprints['task'].get_packages(task) or [])
+        return blueprints['package'].resolve(names)
+
+
     def __init__(self, dirpath, basename, BP, contentstr=None):
         '''If contentstr is given, it is an upload, else read a file.'''
         assert '/' not in basename, 'basename is not a leaf element'
         self.basename = basename
         self.BP = BP
+        self._body = self._digest = None    # See body and digest
         # excludes basename, more like a namespace
         self.prefix = dirpath.split(self.BP.UPLOADS)[-1].strip('/')
         if contentstr is not None:
@@ -82,6 +116,7 @@ class ManifestDestiny(object):
             #Save manifest content into server destination ([...]tmms/manifest/)
             with open(self.manifest_file, 'w') as f:
                 f.write(formatted_content)
+            self._body = formatted_content.encode()
             return
 
         fname = os.path.join(dirpath, basename)
@@ -98,6 +133,28 @@ class ManifestDestiny(object):
         return self.thedict.get(key, default_value)
 
 
+    @property
+    def body(self):
+        '''The canonical form, as an upload writes it, serialized once.'''
+        if self._body is None:
+            self._body = json.dumps(
+                self.thedict, indent=4, sort_keys=True).encode()
+        return self._body
+
+
+    @property
+    def digest(self):
+        '''SHA256 of the canonical form: same content, same digest.'''
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.body).hexdigest()
+        return self._digest
+
+
+    @property
+    def etag(self):
+        return '"%s"' % self.digest
+
+
     @property
     def fullpath(self):
         return '%s/%s' % (self.dirpath, self.basename)
@@ -114,3 +171,243 @@ class ManifestDestiny(object):
     @property
     def key(self):  # FIXME returns trailing slash
         return os.path.join(self.namespace, self.basename)
+
+
+class ManifestStore(object):
+    '''
+        Every valid manifest under BP.UPLOADS by namespace ("sub/path/name").
+    Writes through the API update just their own entry; edits made behind
+    the server's back are found by a thread comparing file stat()s (no
+    parsing) every "poll" seconds.  The names are also kept sorted, so a
+    prefix query is a bisect rather than a scan of every key.
+    '''
+
+    def __init__(self, BP, poll=10):
+        self.BP = BP
+        self.topdir = BP.UPLOADS
+        self._poll = poll
+        self._lock = threading.Lock()
+        self._data = {}         # namespace: ManifestDestiny
+        self._stats = {}        # namespace: stat signature, valid or not
+        self._names = []        # sorted keys of _data
+        self.rescan()
+        if poll:
+            threading.Thread(target=self._poller, name='manifest_store',
+                             daemon=True).start()
+
+    def __len__(self):
+        return len(self._names)
+
+    def get(self, namespace):
+        return self._data.get(namespace.strip('/'), None)
+
+    @staticmethod
+    def _span(names, prefix):
+        '''[first, last) of the names starting with "prefix".'''
+        first = bisect.bisect_left(names, prefix)
+        return first, bisect.bisect_left(names, prefix + _LAST, first)
+
+    def names(self, prefix=''):
+        '''Sorted namespaces starting with "prefix".'''
+        names = self._names     # Replaced, never modified, by writers
+        first, last = self._span(names, prefix)
+        return names[first:last]
+
+    def count(self, prefix=''):
+        first, last = self._span(self._names, prefix)
+        return last - first
+
+    def page(self, prefix='', after=None, limit=None):
+        '''
+            One page of names(prefix): those sorting after the cursor
+        "after" (the last name of the previous page), at most "limit".
+        :return: (names, cursor for the next page or None)
+        '''
+        names = self._names
+        first, last = self._span(names, prefix)
+        if after is not None:
+            first = max(first, bisect.bisect_right(names, after, 0, last))
+        end = last if limit is None else min(last, first + limit)
+        return names[first:end], (names[end - 1] if end < last else None)
+
+    def children(self, prefix=''):
+        '''
+            The sub-namespaces one level under "prefix" and how many
+        manifests each holds, eg, { 'fry/': 2, 'fryer/': 1 } for "fr".
+        A bisect per child, not a scan of every name.
+        '''
+        names = self._names
+        first, last = self._span(names, prefix)
+        counts = collections.OrderedDict()
+        while first < last:
+            rest = names[first][len(prefix):]
+            if '/' not in rest:         # A manifest at this level
+                first += 1
+                continue
+            child = prefix + rest.split('/')[0] + '/'
+            end = self._span(names, child)[1]
+            counts[child] = end - first
+            first = end
+        return counts
+
+    def _namespace(self, path):
+        return os.path.normpath(os.path.relpath(path, self.topdir)).strip('/')
+
+    def _set(self, changes):
+        '''
+            Apply [ (namespace, signature, manifest), ... ]; a None manifest
+        drops the entry.  The sorted names are rebuilt at most once.
+        '''
+        with self._lock:
+            resort = False
+            for namespace, signature, manifest in changes:
+                if signature is None:
+                    self._stats.pop(namespace, None)
+                else:
+                    self._stats[namespace] = signature
+                if manifest is None:
+                    resort |= self._data.pop(namespace, None) is not None
+                else:
+                    resort |= namespace not in self._data
+                    self._data[namespace] = manifest
+            if resort:
+                self._names = sorted(self._data)
+
+    def _read(self, namespace, signature=None):
+        '''(namespace, signature, manifest) for _set(), from the file.'''
+        path = os.path.join(self.topdir, namespace)
+        try:
+            if signature is None:
+                st = os.stat(path)
+                signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+            manifest = ManifestDestiny(
+                os.path.dirname(path), os.path.basename(path), self.BP)
+        except FileNotFoundError:
+            return (namespace, None, None)
+        except Exception as e:      # Invalid: don't parse it again unchanged
+            manifest = None
+        return (namespace, signature, manifest)
+
+    def update(self, namespace):
+        '''(Re)read one manifest file; drop the entry if it's gone or bad.'''
+        change = self._read(os.path.normpath(namespace).strip('/'))
+        self._set([ change ])
+        return change[2]
+
+    def remove(self, namespace):
+        self._set([ (os.path.normpath(namespace).strip('/'), None, None) ])
+
+    def rescan(self):
+        '''stat() every file, read only the new and changed ones.'''
+        seen = set()
+        changes = []
+        for dirpath, dirnames, fnames in os.walk(self.topdir):
+            # Hidden: write_many() staging, editor droppings
+            dirnames[:] = [ d for d in dirnames if not d.startswith('.') ]
+            for fname in fnames:
+                if fname.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                namespace = self._namespace(path)
+                seen.add(namespace)
+                signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+                if self._stats.get(namespace) != signature:
+                    changes.append(self._read(namespace, signature))
+        for namespace in set(self._stats) - seen:
+            changes.append((namespace, None, None))
+        if changes:
+            self._set(changes)
+
+    def _check_namespace(self, namespace, staged):
+        '''The normalized namespace, if it can be written as a file.'''
+        namespace = os.path.normpath(namespace).strip('/')
+        elems = namespace.split('/')
+        assert len(elems) < 10, 'Really? %d deep? Get a life.' % len(elems)
+        for e in elems:
+            assert e and e == werkzeug.utils.secure_filename(e) and \
+                not e.startswith('.'), \
+                'Illegal namespace component "%s"' % e
+        assert namespace not in staged, 'Given more than once'
+        path = os.path.join(self.topdir, namespace)
+        assert not os.path.isdir(path), 'A namespace directory of that name'
+        parent = self.topdir
+        for e in elems[:-1]:
+            parent = os.path.join(parent, e)
+            assert not os.path.isfile(parent), \
+                '"%s" is a manifest, not a namespace' % e
+        return namespace
+
+    def write_many(self, entries):
+        '''
+            Bulk upload: validate everything, then write everything, then
+        update the index once.  Files are staged in a hidden directory and
+        renamed into place, so no reader sees a partial manifest, and the
+        ones already renamed are put back if a later one fails.
+
+        :param 'entries': [ (namespace, JSON string), ... ]
+        :return: [dict] 'created' and 'overwritten' namespaces, or only
+                 'errors' (and nothing was written) if any entry is bad.
+        '''
+        staged = collections.OrderedDict()     # namespace: canonical form
+        errors = []
+        for namespace, contentstr in entries:
+            try:
+                namespace = self._check_namespace(namespace, staged)
+                thedict = ManifestDestiny.validate_manifest(contentstr)
+                assert os.path.basename(namespace) == thedict['name'], \
+                    'File name is not the manifest name "%s"' % thedict['name']
+                staged[namespace] = json.dumps(thedict, indent=4, sort_keys=True)
+            except Exception as e:
+                errors.append({ 'namespace': namespace, 'error': str(e) })
+        if errors:
+            return { 'errors': errors }
+
+        result = { 'created': [], 'overwritten': [] }
+        done = []       # (path, hard link to what it replaced or None)
+        staging = tempfile.mkdtemp(prefix='.bulk.', dir=self.topdir)
+        try:
+            for i, content in enumerate(staged.values()):
+                with open('%s/%d' % (staging, i), 'w') as f:
+                    f.write(content)
+            for i, namespace in enumerate(staged):
+                path = os.path.join(self.topdir, namespace)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                backup = None
+                if os.path.exists(path):
+                    backup = '%s/%d.old' % (staging, i)
+                    os.link(path, backup)
+                os.replace('%s/%d' % (staging, i), path)
+                done.append((path, backup))
+                result['created' if backup is None else
+                       'overwritten'].append(namespace)
+        except Exception:
+            for path, backup in reversed(done):     # All or nothing
+                if backup is None:
+                    os.unlink(path)
+                else:
+                    os.replace(backup, path)
+            raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+            # Whatever is in place now, even if the rollback failed too
+            self._set([ self._read(namespace) for namespace in staged ])
+        return result
+
+    def export(self, prefix=''):
+        '''Yield (namespace, ManifestDestiny) for names(prefix).'''
+        for namespace in self.names(prefix):
+            manifest = self._data.get(namespace, None)
+            if manifest is not None:    # Unless deleted meanwhile
+                yield namespace, manifest
+
+    def _poller(self):
+        while True:
+            time.sleep(self._poll)
+            try:
+                self.rescan()
+            except Exception as err:
+                self.BP.logger.error('manifest store: %s' % str(err))
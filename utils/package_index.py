@@ -0,0 +1,313 @@
+#!/usr/bin/python3 -tt
+'''
+    On-disk index of the Debian "Packages" files of all configured mirrors.
+Only the fields the API and the dependency checks use are kept, in SQLite
+(WAL mode, so readers are never blocked by a refresh).  refresh() asks
+for each dists/<release>/Release with If-None-Match/If-Modified-Since and
+only downloads a Packages.gz whose SHA256 in the Release file changed.
+A refresh is one transaction: readers keep the old index until it commits.
+When several mirrors carry a package the last mirror in the list wins,
+as it did with the in-memory dictionary.
+'''
+
+import gzip
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from debian.deb822 import Packages as debPackages
+import requests as HTTP_REQUESTS
+
+from pdb import set_trace
+
+from tmms.utils import core_utils
+
+# Debian field names, in the order the API shows them.
+FIELDS = (
+    'Package', 'Version', 'Architecture', 'Section', 'Priority',
+    'Installed-Size', 'Size', 'Maintainer', 'Source', 'Homepage',
+    'Depends', 'Pre-Depends', 'Recommends', 'Provides', 'Conflicts',
+    'Breaks', 'Filename', 'Description',
+)
+_INTEGERS = frozenset(('Installed-Size', 'Size'))
+_COLUMNS = tuple(f.lower().replace('-', '_') for f in FIELDS)
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS releases (
+    url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, checked REAL);
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY, url TEXT UNIQUE, rank INTEGER, sha256 TEXT,
+    fetched REAL);
+CREATE TABLE IF NOT EXISTS packages (
+    origin INTEGER REFERENCES sources(id), %s,
+    PRIMARY KEY (package, origin));
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+''' % ', '.join('%s %s' % (c, 'INTEGER' if f in _INTEGERS else 'TEXT')
+                for f, c in zip(FIELDS, _COLUMNS))
+
+
+def _release_hashes(text):
+    '''{ "main/binary-arm64/Packages.gz": sha256, ... } from a Release file'''
+    hashes = {}
+    section = None
+    for line in text.splitlines():
+        if not line.startswith(' '):
+            section = line.split(':')[0]
+            continue
+        if section == 'SHA256':
+            try:
+                digest, _, relpath = line.split()
+                hashes[relpath] = digest
+            except ValueError:
+                pass
+    return hashes
+
+
+class PackageIndex(object):
+
+    def __init__(self, path, logger=None):
+        '''
+        :param 'path': [str] SQLite file, created if needed.
+        :param 'logger': where to say things, default is the root logger.
+        '''
+        self.path = path
+        self._logger = logger or logging
+        self._local = threading.local()     # One connection per thread
+        self._refreshing = threading.Lock()
+
+    @property
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(_SCHEMA)
+            self._local.db = db
+        return db
+
+    #----------------------------------------------------------------------
+    # Read side: duck-types enough of the old dictionary.
+
+    _SELECT = 'SELECT %s FROM packages p JOIN sources s ON p.origin = s.id' \
+        % ', '.join('p.' + c for c in _COLUMNS)
+
+    @staticmethod
+    def _todict(row):
+        return dict((f, v) for f, v in zip(FIELDS, row) if v is not None)
+
+    def __contains__(self, name):
+        return self._db.execute(
+            'SELECT 1 FROM packages WHERE package = ? LIMIT 1',
+            (name, )).fetchone() is not None
+
+    def __len__(self):
+        return self._db.execute(
+            'SELECT COUNT(DISTINCT package) FROM packages').fetchone()[0]
+
+    def __getitem__(self, name):
+        pkg = self.get(name)
+        if pkg is None:
+            raise KeyError(name)
+        return pkg
+
+    def get(self, name, default=None):
+        row = self._db.execute(
+            self._SELECT + ' WHERE p.package = ? ORDER BY s.rank DESC LIMIT 1',
+            (name, )).fetchone()
+        return default if row is None else self._todict(row)
+
+    def keys(self):
+        return [r[0] for r in self._db.execute(
+            'SELECT DISTINCT package FROM packages ORDER BY package')]
+
+    def values(self):
+        '''Every package as a dict, one per name, ordered by name.'''
+        last = None
+        for row in self._db.execute(self._SELECT + ' ORDER BY p.package, s.rank'):
+            if last is not None and last[0] != row[0]:
+                yield self._todict(last)
+            last = row
+        if last is not None:
+            yield self._todict(last)
+
+    @property
+    def refreshing(self):
+        return self._refreshing.locked()
+
+    def meta(self, key, default=None):
+        row = self._db.execute(
+            'SELECT value FROM meta WHERE key = ?', (key, )).fetchone()
+        return default if row is None else row[0]
+
+    #----------------------------------------------------------------------
+    # Write side
+
+    def _set_meta(self, db, **kwargs):
+        db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                       [(k, str(v)) for k, v in kwargs.items()])
+
+    def _plan(self, sources, arch):
+        '''[ (Release URL, relative path of a Packages.gz, its URL) ]'''
+        plan = []
+        for full_source in sources:
+            components = core_utils.deb_components(full_source)
+            components.areas = [ a for a in components.areas if a.strip() ]
+            if not components.url:
+                msg = ' - Wrong mirror format!\n'
+                msg += '  - Expected "deb http://mirror.url release ares"\n'
+                msg += '  - Mirror provided: %s' % (full_source)
+                raise RuntimeError(msg)
+            dists = '%s/dists/%s' % (
+                components.url.rstrip('/'), components.release)
+            for area in components.areas:
+                for binary in ('binary-all', 'binary-' + arch):
+                    relpath = '%s/%s/Packages.gz' % (area, binary)
+                    plan.append((dists + '/Release', relpath,
+                                 '%s/%s' % (dists, relpath)))
+        return plan
+
+    def _get_release(self, db, url, force=False):
+        '''
+            Conditional GET of a Release file.
+        :return: (Release text or None if unchanged, row for "releases")
+        '''
+        headers = {}
+        row = db.execute('SELECT etag, last_modified FROM releases '
+                         'WHERE url = ?', (url, )).fetchone()
+        if row is not None and not force:
+            if row[0]:
+                headers['If-None-Match'] = row[0]
+            if row[1]:
+                headers['If-Modified-Since'] = row[1]
+        resp = HTTP_REQUESTS.get(url, headers=headers, timeout=60)
+        if resp.status_code == 304:
+            return None, None
+        if resp.status_code != 200:
+            raise RuntimeError('%s: status %d' % (url, resp.status_code))
+        return resp.text, (url, resp.headers.get('ETag'),
+                           resp.headers.get('Last-Modified'), time.time())
+
+    def _rows(self, origin, url):
+        '''Download one Packages.gz, return an iterator over its rows.'''
+        self._logger.info('Loading/processing "%s"' % url)
+        resp = HTTP_REQUESTS.get(url, timeout=300)
+        if resp.status_code != 200:
+            raise RuntimeError('%s: status %d' % (url, resp.status_code))
+        stream = gzip.GzipFile(fileobj=io.BytesIO(resp.content))
+        for pkg in debPackages.iter_paragraphs(
+                stream, fields=FIELDS, use_apt_pkg=False):
+            row = [origin]
+            for f in FIELDS:
+                val = pkg.get(f, None)
+                if val is not None and f in _INTEGERS:
+                    val = int(val)
+                row.append(val)
+            yield row
+
+    def _load_packages(self, db, origin, url):
+        '''Replace the rows of one Packages.gz inside the open transaction.'''
+        db.execute('SAVEPOINT packages_file')
+        try:
+            db.execute('DELETE FROM packages WHERE origin = ?', (origin, ))
+            db.executemany('INSERT OR REPLACE INTO packages VALUES (%s)' %
+                ', '.join('?' * (len(FIELDS) + 1)), self._rows(origin, url))
+        except Exception:
+            db.execute('ROLLBACK TO packages_file')
+            raise
+        finally:
+            db.execute('RELEASE packages_file')
+
+    def refresh(self, sources, arch, force=False):
+        '''
+            Bring the index up to date with the mirrors.  Concurrent calls
+        are serialized.  Everything is written in one transaction, so
+        readers keep seeing the previous index until it is complete.  A
+        mirror that can't be reached keeps its old rows and is retried
+        in full next time.
+
+        :param 'sources': [list] sources.list lines, later ones win.
+        :param 'arch': [str] Debian architecture, eg, "arm64".
+        :param 'force': [bool] ignore ETag/Last-Modified and hashes.
+        :return: [dict] summary of what was done.
+        '''
+        with self._refreshing:
+            start = time.time()
+            db = self._db
+            plan = self._plan(sources, arch)
+            stats = { 'releases_changed': 0, 'files_loaded': 0, 'errors': [] }
+
+            releases = {}       # URL: { relpath: sha256 } or None if same
+            validators = {}     # URL: row for the "releases" table
+            for release in sorted(set(p[0] for p in plan)):
+                try:
+                    text, validators[release] = self._get_release(
+                        db, release, force)
+                except Exception as err:
+                    self._logger.error('Release check failed: %s' % str(err))
+                    stats['errors'].append(str(err))
+                    text = None
+                if text is not None:
+                    stats['releases_changed'] += 1
+                    releases[release] = _release_hashes(text)
+                else:
+                    releases[release] = None
+
+            failed = set()      # Release URLs with a file that didn't load
+            with db:
+                db.execute('UPDATE sources SET rank = -1')
+                for rank, (_, _, url) in enumerate(plan):
+                    db.execute('INSERT OR IGNORE INTO sources (url) VALUES (?)',
+                               (url, ))
+                    db.execute('UPDATE sources SET rank = ? WHERE url = ?',
+                               (rank, url))
+                db.execute('DELETE FROM packages WHERE origin IN '
+                           '(SELECT id FROM sources WHERE rank < 0)')
+                db.execute('DELETE FROM sources WHERE rank < 0')
+
+                for release, relpath, url in plan:
+                    origin, sha256, fetched = db.execute(
+                        'SELECT id, sha256, fetched FROM sources WHERE url = ?',
+                        (url, )).fetchone()
+                    hashes = releases[release]
+                    if fetched and not force:
+                        if hashes is None:
+                            continue                # Release unchanged
+                        if sha256 and hashes.get(relpath) == sha256:
+                            continue                # This file unchanged
+                    elif hashes is None:
+                        hashes = {}
+                    if hashes and relpath not in hashes:
+                        continue    # Release says it isn't there (binary-all)
+                    try:
+                        self._load_packages(db, origin, url)
+                    except Exception as err:
+                        self._logger.error('%s not loaded: %s' % (
+                            url, str(err)))
+                        stats['errors'].append(str(err))
+                        failed.add(release)
+                        continue
+                    db.execute('UPDATE sources SET sha256 = ?, fetched = ? '
+                               'WHERE id = ?',
+                               (hashes.get(relpath), time.time(), origin))
+                    stats['files_loaded'] += 1
+
+                for release, validator in validators.items():
+                    if validator is not None and release not in failed:
+                        db.execute('INSERT OR REPLACE INTO releases '
+                                   'VALUES (?, ?, ?, ?)', validator)
+
+                stats['packages'] = len(self)
+                stats['seconds'] = round(time.time() - start, 3)
+                self._set_meta(db, refreshed=time.time(),
+                               refresh_seconds=stats['seconds'])
+                if stats['files_loaded']:
+                    self._set_meta(db, built=time.time(),
+                                   build_seconds=stats['seconds'])
+            self._logger.info('Package index: %d packages, %d files loaded '
+                'in %.1f seconds' % (stats['packages'], stats['files_loaded'],
+                                     stats['seconds']))
+            return stats
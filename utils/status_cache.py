@@ -0,0 +1,245 @@
+#!/usr/bin/python3 -tt
+'''
+    In-memory copy of every TFTP_IMAGES/<hostname>/status.json, so listing
+the nodes doesn't open and parse a file per node per request.  Builds run
+in other processes, so changes are picked up with inotify (through ctypes,
+only standard python3 libraries) or, where that is not available, by a
+thread that stat()s the files every few seconds.
+
+update_status() writes status.json.new and renames it over status.json,
+so a rename into place (IN_MOVED_TO) is the usual event.  Every change
+bumps a per-node version number that wait() blocks on, for long polls.
+'''
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+from pdb import set_trace
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM =  0x00000040
+_IN_MOVED_TO =    0x00000080
+_IN_CREATE =      0x00000100
+_IN_DELETE =      0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW =  0x00004000
+_IN_IGNORED =     0x00008000
+_IN_ISDIR =       0x40000000
+_IN_CLOEXEC =     0o2000000
+
+_ROOT_MASK = _IN_CREATE | _IN_MOVED_TO | _IN_DELETE | _IN_MOVED_FROM
+_NODE_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_DELETE | _IN_MOVED_FROM | \
+    _IN_DELETE_SELF
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len; then the name
+
+
+class _Inotify(object):
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32)
+        self.fd = libc.inotify_init1(_IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def read(self):
+        '''Block for events, return [ (wd, mask, name), ... ]'''
+        buf = os.read(self.fd, 64 << 10)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+
+class StatusCache(object):
+
+    def __init__(self, topdir, filename='status.json', poll=5, logger=None):
+        '''
+        :param 'topdir': [str] TFTP_IMAGES, one subdirectory per hostname.
+        :param 'poll': [int] seconds between scans if inotify is unusable.
+        '''
+        self.topdir = topdir
+        self.filename = filename
+        self._poll = poll
+        self._logger = logger or logging
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._data = {}         # hostname: (stat signature, parsed status)
+        self._versions = {}     # hostname: count of changes, never removed
+        self._watches = {}      # wd: hostname or None for topdir
+        self._inotify = None
+        try:
+            self._inotify = _Inotify()
+            os.makedirs(topdir, exist_ok=True)
+            self._watches[self._inotify.add_watch(topdir, _ROOT_MASK)] = None
+        except (OSError, AttributeError) as err:   # No inotify in libc?
+            self._logger.warning('status cache: polling, inotify failed: %s'
+                                 % str(err))
+            self._inotify = None
+        self.rescan()
+        threading.Thread(target=self._watcher if self._inotify else
+                         self._poller, name='status_cache', daemon=True).start()
+
+    @property
+    def watching(self):
+        return self._inotify is not None
+
+    def get(self, hostname):
+        '''The parsed status of a node, None if it has none.'''
+        return self.lookup(hostname)[1]
+
+    def lookup(self, hostname):
+        '''(version, status) of a node, read together.'''
+        with self._lock:
+            entry = self._data.get(hostname)
+            return (self._versions.get(hostname, 0),
+                    None if entry is None else entry[1])
+
+    def wait(self, hostname, since, timeout):
+        '''
+            Block until the version of a node is not "since".
+        :return: [bool] False if it timed out.
+        '''
+        return self.wait_any({ hostname: since }, timeout)
+
+    def wait_any(self, since, timeout):
+        '''
+            Block until the version of any node in "since", a dict of
+        hostname: version, is not the one given.  One waiter for many nodes.
+        :return: [bool] False if it timed out.
+        '''
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: any(self._versions.get(hostname, 0) != version
+                            for hostname, version in since.items()),
+                timeout)
+
+    def _update(self, hostname, entry):
+        '''Store (or with None, drop) an entry and wake up waiters; lock held.'''
+        if entry is None:
+            if self._data.pop(hostname, None) is None:
+                return
+        else:
+            self._data[hostname] = entry
+        self._versions[hostname] = self._versions.get(hostname, 0) + 1
+        self._changed.notify_all()
+
+    @staticmethod
+    def _signature(path):
+        try:
+            st = os.stat(path)
+        except OSError:     # Unbound
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def reload(self, hostname):
+        '''
+            Re-read one node, eg, after this process wrote its status.
+        Request threads and the watcher may race here: an entry is only
+        stored if the file still has the signature it was read with, else
+        it's read again.  An older read never replaces a newer one.
+        '''
+        path = '%s/%s/%s' % (self.topdir, hostname, self.filename)
+        while True:
+            signature = self._signature(path)
+            with self._lock:
+                old = self._data.get(hostname)
+                if signature == (None if old is None else old[0]):
+                    return
+            status = None
+            if signature is not None:
+                try:
+                    with open(path, 'r') as file_obj:
+                        status = json.loads(file_obj.read())
+                except FileNotFoundError:
+                    continue
+                except Exception as err:       # TCNH =)
+                    status = {
+                        'message':  'Failed to parse status file: %s ' % str(err),
+                        'manifest': 'unknown',
+                        'status':   'error'
+                    }
+            with self._changed:
+                if self._signature(path) != signature:
+                    continue    # Rewritten while it was read
+                self._update(hostname, None if signature is None else
+                             (signature, status))
+                return
+
+    def _watch(self, hostname):
+        try:
+            wd = self._inotify.add_watch(
+                '%s/%s' % (self.topdir, hostname), _NODE_MASK)
+            self._watches[wd] = hostname
+        except OSError:
+            pass    # Gone already; its IN_DELETE will be along.
+
+    def rescan(self):
+        '''Read every node from scratch.'''
+        try:
+            hostnames = [ e.name for e in os.scandir(self.topdir)
+                          if e.is_dir() ]
+        except OSError:
+            hostnames = []
+        if self._inotify is not None:
+            for hostname in hostnames:
+                self._watch(hostname)   # Same wd if already watched
+        for hostname in hostnames:
+            self.reload(hostname)
+        for hostname in set(self._data) - set(hostnames):
+            self.reload(hostname)
+
+    def _watcher(self):
+        while True:
+            try:
+                events = self._inotify.read()
+            except Exception as err:
+                self._logger.error('status cache: %s' % str(err))
+                time.sleep(self._poll)
+                continue
+            for wd, mask, name in events:
+                if mask & _IN_Q_OVERFLOW:
+                    self.rescan()
+                    continue
+                if mask & _IN_IGNORED:
+                    self._watches.pop(wd, None)
+                    continue
+                if wd not in self._watches:
+                    continue
+                hostname = self._watches[wd]
+                if hostname is None:                    # topdir
+                    if mask & _IN_ISDIR:
+                        if mask & (_IN_CREATE | _IN_MOVED_TO):
+                            self._watch(name)
+                        self.reload(name)
+                elif mask & _IN_DELETE_SELF or name == self.filename:
+                    self.reload(hostname)
+
+    def _poller(self):
+        while True:
+            time.sleep(self._poll)
+            try:
+                self.rescan()
+            except Exception as err:
+                self._logger.error('status cache: %s' % str(err))